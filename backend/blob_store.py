@@ -0,0 +1,146 @@
+"""
+Binary storage backed by GridFS.
+
+Vehicle images are content-addressed: the GridFS file id is the SHA-256 of the
+bytes, so the same picture uploaded twice is stored once and can be cached
+forever by clients. Vehicle documents only keep `/api/images/<hash>` references.
+
+Reservation documents (driver license, ID) are private: they live in a separate
+bucket under ObjectId file ids, tagged with the id of the user who uploaded them.
+"""
+import base64
+import binascii
+import hashlib
+import re
+from typing import List, Optional, Tuple
+
+from bson import ObjectId
+from gridfs.errors import FileExists, NoFile
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from pymongo.errors import DuplicateKeyError
+
+IMAGE_BUCKET = "images"
+IMAGE_URL_PREFIX = "/api/images/"
+IMAGE_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+DOCUMENT_BUCKET = "documents"
+DOCUMENT_CHUNK_SIZE = 256 * 1024
+DATA_URI_RE = re.compile(r"^data:(?P<mime>[^;,]*)(?P<params>(;[^;,]*)*);base64,", re.IGNORECASE)
+
+def image_bucket(db) -> AsyncIOMotorGridFSBucket:
+    return AsyncIOMotorGridFSBucket(db, bucket_name=IMAGE_BUCKET)
+
+def parse_data_uri(value: str) -> Optional[Tuple[str, bytes]]:
+    """Return (content_type, bytes) for a base64 data URI, None for anything else"""
+    match = DATA_URI_RE.match(value)
+    if not match:
+        return None
+    try:
+        data = base64.b64decode(value[match.end():], validate=False)
+    except (binascii.Error, ValueError):
+        raise ValueError("Invalid base64 image data")
+    return match.group("mime") or "application/octet-stream", data
+
+def image_ref(image_hash: str) -> str:
+    return f"{IMAGE_URL_PREFIX}{image_hash}"
+
+async def store_image_bytes(db, data: bytes, content_type: str) -> str:
+    """Store image bytes once per content hash and return the hash"""
+    image_hash = hashlib.sha256(data).hexdigest()
+    if await db[f"{IMAGE_BUCKET}.files"].find_one({"_id": image_hash}, {"_id": 1}):
+        return image_hash
+    try:
+        await image_bucket(db).upload_from_stream_with_id(
+            image_hash,
+            image_hash,
+            data,
+            metadata={"content_type": content_type}
+        )
+    except (FileExists, DuplicateKeyError):
+        # Stored concurrently by another request: same hash, same bytes
+        pass
+    return image_hash
+
+async def store_image(db, value: str) -> str:
+    """Move an inline data URI into the store; references and URLs pass through"""
+    parsed = parse_data_uri(value)
+    if parsed is None:
+        return value
+    content_type, data = parsed
+    return image_ref(await store_image_bytes(db, data, content_type))
+
+async def store_images(db, values: List[str]) -> List[str]:
+    return [await store_image(db, value) for value in values]
+
+async def open_image(db, image_hash: str):
+    try:
+        return await image_bucket(db).open_download_stream(image_hash)
+    except NoFile:
+        return None
+
+def document_bucket(db) -> AsyncIOMotorGridFSBucket:
+    return AsyncIOMotorGridFSBucket(db, bucket_name=DOCUMENT_BUCKET, chunk_size_bytes=DOCUMENT_CHUNK_SIZE)
+
+def decode_base64_document(value: str) -> Tuple[str, bytes]:
+    """Decode a document sent inline as a data URI or bare base64 string"""
+    parsed = parse_data_uri(value)
+    if parsed is not None:
+        return parsed
+    try:
+        return "application/octet-stream", base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        raise ValueError("Invalid base64 document")
+
+async def store_document_bytes(db, data: bytes, content_type: str, owner_id: str, filename: str = "document") -> str:
+    file_id = await document_bucket(db).upload_from_stream(
+        filename,
+        data,
+        metadata={"owner_id": owner_id, "content_type": content_type}
+    )
+    return str(file_id)
+
+async def store_upload(db, upload, owner_id: str, max_bytes: int) -> str:
+    """Copy an uploaded file into the document bucket chunk by chunk.
+
+    Raises ValueError, leaving nothing stored, once more than max_bytes were read.
+    """
+    grid_in = document_bucket(db).open_upload_stream(
+        upload.filename or "document",
+        metadata={"owner_id": owner_id, "content_type": upload.content_type or "application/octet-stream"}
+    )
+    size = 0
+    try:
+        while True:
+            chunk = await upload.read(DOCUMENT_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise ValueError(f"Document larger than {max_bytes} bytes")
+            await grid_in.write(chunk)
+    except BaseException:
+        await grid_in.abort()
+        raise
+    await grid_in.close()
+    return str(grid_in._id)
+
+async def delete_document(db, document_id: str):
+    try:
+        await document_bucket(db).delete(ObjectId(document_id))
+    except NoFile:
+        pass
+
+async def open_document(db, document_id: str):
+    if not ObjectId.is_valid(document_id):
+        return None
+    try:
+        return await document_bucket(db).open_download_stream(ObjectId(document_id))
+    except NoFile:
+        return None
+
+async def iter_grid_out(grid_out):
+    """Yield a GridFS file chunk by chunk without loading it whole"""
+    while True:
+        chunk = await grid_out.readchunk()
+        if not chunk:
+            break
+        yield chunk
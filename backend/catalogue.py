@@ -0,0 +1,145 @@
+"""
+Catalogue digest grounding the chat assistant in the actual fleet.
+
+Every vehicle is reduced once, when it changes, to a one-line description and
+the set of its normalized words, indexed by word. Per message, the question's
+words select the few best matching vehicles (weighted by word rarity) whose
+lines go into the prompt next to a short fleet overview. Prompt size depends
+on top_k, never on the fleet size.
+"""
+import heapq
+import math
+from typing import Dict, List, Optional, Set
+
+from chat_cache import STOP_WORDS as FUNCTION_WORDS, normalize_text
+
+CATALOGUE_PROJECTION = {
+    "name": 1,
+    "brand": 1,
+    "category": 1,
+    "type": 1,
+    "price_sale": 1,
+    "price_per_day": 1,
+    "year": 1,
+    "transmission": 1,
+    "fuel": 1,
+    "mileage": 1,
+    "features": 1,
+    "available": 1
+}
+
+STOP_WORDS = FUNCTION_WORDS | {
+    "a", "y", "d", "l", "j", "c", "s", "t", "n", "m", "voiture", "voitures", "vehicule", "vehicules"
+}
+
+def format_amount(value: float) -> str:
+    return f"{value:,.0f}".replace(",", " ")
+
+def vehicle_line(vehicle: dict) -> str:
+    offers = []
+    if vehicle.get("type") in ("location", "both") and vehicle.get("price_per_day"):
+        offers.append(f"location {format_amount(vehicle['price_per_day'])} €/jour")
+    if vehicle.get("type") in ("vente", "both") and vehicle.get("price_sale"):
+        offers.append(f"vente {format_amount(vehicle['price_sale'])} €")
+    details = ", ".join(str(value) for value in (
+        vehicle.get("category"), vehicle.get("year"), vehicle.get("fuel"), vehicle.get("transmission")
+    ) if value)
+    if vehicle.get("mileage") is not None:
+        details += f", {format_amount(vehicle['mileage'])} km"
+    line = f"{vehicle.get('brand', '')} {vehicle.get('name', '')} ({details})".strip()
+    if offers:
+        line += " : " + ", ".join(offers)
+    if not vehicle.get("available", True):
+        line += " [indisponible]"
+    return line
+
+def words(text: str) -> Set[str]:
+    return {word for word in normalize_text(text).split() if word not in STOP_WORDS}
+
+def vehicle_words(vehicle: dict) -> Set[str]:
+    fields = [vehicle.get(field) for field in ("brand", "name", "category", "type", "fuel", "transmission", "year")]
+    fields.extend(vehicle.get("features") or [])
+    return words(" ".join(str(field) for field in fields if field))
+
+class CatalogueDigest:
+    def __init__(self):
+        self.lines: Dict[str, str] = {}
+        self.vehicle_words: Dict[str, Set[str]] = {}
+        self.index: Dict[str, Set[str]] = {}  # word -> vehicle ids
+        self.vehicles: Dict[str, dict] = {}  # overview fields by vehicle id
+        self.overview_text: Optional[str] = None  # rebuilt lazily after changes
+
+    def put(self, vehicle_id: str, vehicle: dict):
+        self.remove(vehicle_id)
+        self.lines[vehicle_id] = vehicle_line(vehicle)
+        self.vehicle_words[vehicle_id] = vehicle_words(vehicle)
+        for word in self.vehicle_words[vehicle_id]:
+            self.index.setdefault(word, set()).add(vehicle_id)
+        self.vehicles[vehicle_id] = {
+            "category": vehicle.get("category"),
+            "type": vehicle.get("type"),
+            "available": vehicle.get("available", True),
+            "price_per_day": vehicle.get("price_per_day"),
+            "price_sale": vehicle.get("price_sale")
+        }
+        self.overview_text = None
+
+    def remove(self, vehicle_id: str):
+        for word in self.vehicle_words.pop(vehicle_id, ()):
+            vehicle_ids = self.index[word]
+            vehicle_ids.discard(vehicle_id)
+            if not vehicle_ids:
+                del self.index[word]
+        self.lines.pop(vehicle_id, None)
+        if self.vehicles.pop(vehicle_id, None) is not None:
+            self.overview_text = None
+
+    def replace_all(self, vehicles: List[dict]):
+        self.lines.clear()
+        self.vehicle_words.clear()
+        self.index.clear()
+        self.vehicles.clear()
+        for vehicle in vehicles:
+            self.put(str(vehicle["_id"]), vehicle)
+        self.overview_text = None
+
+    def overview(self) -> str:
+        if self.overview_text is None:
+            available = [vehicle for vehicle in self.vehicles.values() if vehicle["available"]]
+            categories: Dict[str, int] = {}
+            for vehicle in available:
+                categories[vehicle["category"]] = categories.get(vehicle["category"], 0) + 1
+            parts = [f"{len(available)} véhicules disponibles sur {len(self.vehicles)}"]
+            if categories:
+                parts.append("catégories : " + ", ".join(
+                    f"{category} ({count})" for category, count in sorted(categories.items(), key=lambda item: -item[1])
+                ))
+            for field, label, unit in (("price_per_day", "location", " €/jour"), ("price_sale", "vente", " €")):
+                prices = [vehicle[field] for vehicle in available if vehicle.get(field)]
+                if prices:
+                    parts.append(f"{label} de {format_amount(min(prices))} à {format_amount(max(prices))}{unit}")
+            self.overview_text = "; ".join(parts)
+        return self.overview_text
+
+    def relevant(self, question: str, top_k: int) -> List[str]:
+        """Ids of the top_k vehicles sharing the rarest words with the question"""
+        scores: Dict[str, float] = {}
+        total = len(self.lines)
+        for word in words(question):
+            vehicle_ids = self.index.get(word)
+            # Words shared by most of a large fleet select nothing and cost a full scan
+            if not vehicle_ids or (total > 2 * top_k and len(vehicle_ids) > total // 2):
+                continue
+            weight = math.log(1 + total / len(vehicle_ids))
+            for vehicle_id in vehicle_ids:
+                scores[vehicle_id] = scores.get(vehicle_id, 0.0) + weight
+        best = heapq.nsmallest(top_k, scores.items(), key=lambda item: (-item[1], item[0]))
+        return [vehicle_id for vehicle_id, _ in best]
+
+    def prompt_section(self, vehicle_ids: List[str]) -> str:
+        """Overview plus the lines of vehicle_ids, as picked by relevant()"""
+        section = f"Catalogue de l'agence : {self.overview()}. Ne cite que des véhicules de ce catalogue."
+        lines = [self.lines[vehicle_id] for vehicle_id in vehicle_ids if vehicle_id in self.lines]
+        if lines:
+            section += "\nVéhicules correspondant à la demande :\n" + "\n".join(f"- {line}" for line in lines)
+        return section
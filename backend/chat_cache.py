@@ -0,0 +1,95 @@
+"""
+Response cache for context-free chat questions.
+
+Questions are keyed on their normalized text (case, accents, punctuation and
+spacing removed) together with the catalogue lines retrieved for them, since
+the reply was grounded in those. When a similarity threshold is set, a
+question missing the exact key may also reuse the reply of a cached question
+whose character trigram vector is close enough, provided both use the same
+numbers and the same content words: trigrams alone score "3 jours" / "30
+jours" or "Classe C" / "Classe E" above 0.95, so the fallback only absorbs
+differences in spelling, word order and function words, such as
+"Quels documents faut-il ?" / "quels sont les documents qu'il faut".
+"""
+import re
+import unicodedata
+import zlib
+from typing import FrozenSet, Optional, Sequence, Tuple
+
+import numpy as np
+from cachetools import TTLCache
+
+EMBEDDING_DIMENSIONS = 512
+NON_WORD_RE = re.compile(r"[^\w]+")
+DIGITS_RE = re.compile(r"\d+")
+
+# French function words; single letters are kept as they name models (Classe A, Série 3)
+STOP_WORDS = {
+    "au", "aux", "avec", "ce", "ces", "de", "des", "du", "en", "est", "et", "il", "je", "la", "le",
+    "les", "ma", "mes", "mon", "ne", "ou", "par", "pas", "pour", "qu", "que", "quel", "quelle", "quels",
+    "quelles", "qui", "sa", "se", "ses", "sur", "un", "une", "vos", "votre", "vous", "avez", "sont"
+}
+
+def normalize_text(text: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    without_accents = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return " ".join(NON_WORD_RE.sub(" ", without_accents).split())
+
+def trigram_embedding(normalized: str) -> np.ndarray:
+    """L2-normalized hashed bag of character trigrams"""
+    vector = np.zeros(EMBEDDING_DIMENSIONS)
+    padded = f" {normalized} "
+    for index in range(len(padded) - 2):
+        vector[zlib.crc32(padded[index:index + 3].encode()) % EMBEDDING_DIMENSIONS] += 1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def signature(normalized: str, context: Tuple[str, ...]) -> Tuple[Tuple[str, ...], Tuple[str, ...], FrozenSet[str]]:
+    """What two questions must share for one to reuse the other's reply: the
+    grounding context, the numbers and the content words"""
+    digits = tuple(sorted(DIGITS_RE.findall(normalized)))
+    vocabulary = frozenset(word for word in normalized.split() if word not in STOP_WORDS)
+    return context, digits, vocabulary
+
+class ResponseCache:
+    """TTL/LRU cache of replies by normalized question and grounding context"""
+
+    def __init__(self, max_size: int, ttl_seconds: int, similarity_threshold: float = 0.0):
+        # (normalized question, context) -> (reply, embedding, signature)
+        self.cache = TTLCache(maxsize=max_size, ttl=ttl_seconds)
+        self.similarity_threshold = similarity_threshold
+        self.counters = {"hits": 0, "misses": 0, "similar_hits": 0, "invalidations": 0}
+
+    def get(self, question: str, context: Sequence[str] = ()) -> Optional[str]:
+        """context: ids of the catalogue lines the reply would be grounded in"""
+        key = normalize_text(question)
+        context = tuple(context)
+        entry = self.cache.get((key, context))
+        if entry is None and self.similarity_threshold > 0 and self.cache:
+            entry = self.most_similar(trigram_embedding(key), signature(key, context))
+            if entry is not None:
+                self.counters["similar_hits"] += 1
+        if entry is None:
+            self.counters["misses"] += 1
+            return None
+        self.counters["hits"] += 1
+        return entry[0]
+
+    def most_similar(self, embedding: np.ndarray, required: tuple):
+        entries = [entry for entry in self.cache.values() if entry[2] == required]
+        if not entries:
+            return None
+        similarities = np.stack([entry[1] for entry in entries]) @ embedding
+        best = int(np.argmax(similarities))
+        return entries[best] if similarities[best] >= self.similarity_threshold else None
+
+    def put(self, question: str, reply: str, context: Sequence[str] = ()):
+        key = normalize_text(question)
+        context = tuple(context)
+        if key:
+            self.cache[(key, context)] = (reply, trigram_embedding(key), signature(key, context))
+
+    def clear(self):
+        if self.cache:
+            self.cache.clear()
+            self.counters["invalidations"] += 1
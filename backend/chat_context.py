@@ -0,0 +1,99 @@
+"""
+Bounded conversation context for the chat assistant.
+
+Each session keeps its last turns verbatim in `chat_sessions`, along with a
+rolling summary of everything older. The prompt gets the summary plus as many
+recent turns as fit in a token budget, so its size stays flat however long
+the conversation gets. Turns pushed out of the window are folded into the
+summary by the chat model, off the request path; `summary_version` counts
+the folds so that one never overwrites a summary written in the meantime.
+"""
+import logging
+from datetime import datetime
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = "chat_sessions"
+SUMMARY_SYSTEM_MESSAGE = "Tu résumes des conversations entre un client et l'assistant d'une agence de location et vente de voitures. Conserve les faits utiles pour la suite : véhicules, dates, budget, demandes du client. Réponds uniquement par le résumé, en français, en quelques phrases."
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count, about 4 characters per token"""
+    return len(text) // 4 + 1
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rsplit(" ", 1)[0] + "…"
+
+def format_turn(turn: dict) -> str:
+    return f"Client : {turn['user']}\nAssistant : {turn['assistant']}"
+
+async def load_session(db, session_id: str) -> dict:
+    session = await db[COLLECTION].find_one({"_id": session_id})
+    return session or {"_id": session_id, "summary": "", "turns": []}
+
+def build_system_message(base: str, session: dict, token_budget: int) -> str:
+    """base followed by the session summary (at most a third of the budget) and
+    the most recent turns that fit in what is left"""
+    parts = [base]
+    budget = token_budget
+    summary = session.get("summary")
+    if summary:
+        summary = truncate_tokens(summary, token_budget // 3)
+        parts.append(f"Résumé de la conversation jusqu'ici :\n{summary}")
+        budget -= estimate_tokens(summary)
+
+    recent = []
+    for turn in reversed(session.get("turns", [])):
+        text = format_turn(turn)
+        cost = estimate_tokens(text)
+        if cost > budget:
+            break
+        recent.append(text)
+        budget -= cost
+    if recent:
+        parts.append("Derniers échanges :\n" + "\n\n".join(reversed(recent)))
+    return "\n\n".join(parts)
+
+async def record_turn(db, session: dict, message: str, reply: str, max_turns: int) -> List[dict]:
+    """Append a turn to the session window and return the turns it pushed out"""
+    turn = {"user": message, "assistant": reply, "created_at": datetime.utcnow()}
+    await db[COLLECTION].update_one(
+        {"_id": session["_id"]},
+        {
+            "$push": {"turns": {"$each": [turn], "$slice": -max_turns}},
+            "$set": {"updated_at": turn["created_at"]},
+            "$setOnInsert": {"summary": "", "summary_version": 0}
+        },
+        upsert=True
+    )
+    turns = session.get("turns", []) + [turn]
+    return turns[:-max_turns] if len(turns) > max_turns else []
+
+async def fold_into_summary(db, model, session: dict, evicted: List[dict], max_tokens: int, attempts: int = 3):
+    """Merge turns that left the window into the session summary, as stored now:
+    an earlier fold may have landed since the session was loaded. Retried when
+    another fold lands while the model is summarizing."""
+    for _ in range(attempts):
+        current = await db[COLLECTION].find_one({"_id": session["_id"]}, {"summary": 1, "summary_version": 1})
+        if current is None:
+            return
+        version = current.get("summary_version", 0)
+        sections = [f"Résumé précédent :\n{current['summary']}"] if current.get("summary") else []
+        sections.extend(format_turn(turn) for turn in evicted)
+        text = "\n\n".join(sections)
+        try:
+            summary = await model.complete(f"{session['_id']}:summary", SUMMARY_SYSTEM_MESSAGE, text)
+        except Exception:
+            # Keep the raw exchanges rather than losing them; truncated below
+            summary = text
+        result = await db[COLLECTION].update_one(
+            # Sessions created before versioning have no summary_version yet
+            {"_id": session["_id"], "summary_version": version if version else {"$in": [0, None]}},
+            {"$set": {"summary": truncate_tokens(summary, max_tokens)}, "$inc": {"summary_version": 1}}
+        )
+        if result.matched_count:
+            return
+    logger.warning(f"Gave up summarizing session {session['_id']}: concurrent updates")
@@ -0,0 +1,241 @@
+"""
+Chat model backends for the assistant, selected with LLM_PROVIDER.
+
+`emergent` goes through emergentintegrations' LlmChat. It has no incremental
+API, so its stream is the whole reply as a single chunk. `local` is a
+deterministic stand-in answering without any network call, for development
+and tests.
+
+GuardedChatModel wraps a backend with a deadline per call, a cap on calls in
+flight and a circuit breaker.
+"""
+import abc
+import asyncio
+import random
+import time
+from collections import deque
+from typing import AsyncIterator, Optional
+
+class ChatModel(abc.ABC):
+    name = "base"
+
+    @abc.abstractmethod
+    def stream(self, session_id: str, system_message: str, text: str) -> AsyncIterator[str]:
+        """Yield the reply to text in chunks as they are generated"""
+
+    async def complete(self, session_id: str, system_message: str, text: str) -> str:
+        return "".join([chunk async for chunk in self.stream(session_id, system_message, text)])
+
+class EmergentChatModel(ChatModel):
+    name = "emergent"
+
+    def __init__(self, api_key: str, model: str):
+        # Only needed by this backend, so the local one runs without the package
+        from emergentintegrations.llm.chat import LlmChat, UserMessage
+        self.llm_chat = LlmChat
+        self.user_message = UserMessage
+        self.api_key = api_key
+        self.provider, self.model = model.split("/", 1)
+
+    async def complete(self, session_id: str, system_message: str, text: str) -> str:
+        chat = self.llm_chat(
+            api_key=self.api_key,
+            session_id=session_id,
+            system_message=system_message
+        ).with_model(self.provider, self.model)
+        return await chat.send_message(self.user_message(text=text))
+
+    async def stream(self, session_id: str, system_message: str, text: str) -> AsyncIterator[str]:
+        yield await self.complete(session_id, system_message, text)
+
+class LocalChatModel(ChatModel):
+    """Echoes the question back word by word, token_delay_seconds apart, failing
+    a failure_rate share of the calls"""
+    name = "local"
+
+    def __init__(self, token_delay_seconds: float = 0.0, failure_rate: float = 0.0):
+        self.token_delay_seconds = token_delay_seconds
+        self.failure_rate = failure_rate
+
+    def reply(self, system_message: str, text: str) -> str:
+        return f"[modèle local] Vous avez demandé : {' '.join(text.split())}"
+
+    async def stream(self, session_id: str, system_message: str, text: str) -> AsyncIterator[str]:
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise RuntimeError("Simulated local model failure")
+        for index, word in enumerate(self.reply(system_message, text).split(" ")):
+            if self.token_delay_seconds:
+                await asyncio.sleep(self.token_delay_seconds)
+            yield word if index == 0 else f" {word}"
+
+class ChatModelSaturated(Exception):
+    """Every call slot is taken; the caller should retry later"""
+
+class ChatModelUnavailable(Exception):
+    """The call failed, timed out or was short-circuited by the breaker"""
+
+class CircuitBreaker:
+    """Opens when at least failure_ratio of the last window calls failed (once
+    min_calls were seen), then lets a single trial call through after cooldown_seconds.
+
+    allow() hands each admitted call a token naming the period it started in;
+    outcomes of calls from an earlier period (e.g. started before the breaker
+    opened) are ignored, and only the trial call's outcome moves an open breaker.
+    """
+
+    def __init__(self, failure_ratio: float, cooldown_seconds: float, window: int = 20, min_calls: int = 10):
+        self.failure_ratio = failure_ratio
+        self.cooldown_seconds = cooldown_seconds
+        self.min_calls = min_calls
+        self.outcomes = deque(maxlen=window)
+        self.opened_at = None
+        self.generation = 0  # bumped whenever the breaker opens, closes or starts a trial
+        self.trial = None  # token of the running trial call
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown_seconds else "open"
+
+    def allow(self) -> Optional[int]:
+        """Token for record()/abandon(), or None if the call must not be made"""
+        state = self.state
+        if state == "closed":
+            return self.generation
+        if state == "half_open" and self.trial is None:
+            self.generation += 1
+            self.trial = self.generation
+            return self.trial
+        return None
+
+    def open(self):
+        self.opened_at = time.monotonic()
+        self.generation += 1
+
+    def record(self, token: int, success: bool):
+        if self.opened_at is not None:
+            if token != self.trial:
+                return
+            self.trial = None
+            if success:
+                self.opened_at = None
+                self.outcomes.clear()
+                self.generation += 1
+            else:
+                self.open()
+            return
+        if token != self.generation:
+            return
+        self.outcomes.append(success)
+        failures = self.outcomes.count(False)
+        if len(self.outcomes) >= self.min_calls and failures / len(self.outcomes) >= self.failure_ratio:
+            self.open()
+
+    def abandon(self, token: int):
+        """A call ended without an outcome (cancelled): if it was the trial, let another through"""
+        if token == self.trial:
+            self.trial = None
+
+class GuardedChatModel(ChatModel):
+    """Deadline, bounded concurrency and circuit breaking around another model.
+
+    Calls beyond max_concurrency raise ChatModelSaturated at once instead of
+    queueing. Errors and calls exceeding timeout_seconds raise
+    ChatModelUnavailable, as does any call while the breaker is open.
+    """
+
+    def __init__(self, model: ChatModel, timeout_seconds: float, max_concurrency: int, breaker: CircuitBreaker):
+        self.model = model
+        self.name = model.name
+        self.timeout_seconds = timeout_seconds
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.breaker = breaker
+        self.counters = {"calls": 0, "failures": 0, "timeouts": 0, "rejected": 0, "short_circuited": 0}
+
+    def saturated(self) -> bool:
+        return self.in_flight >= self.max_concurrency
+
+    def admit(self) -> int:
+        """Take a call slot and return the breaker token; callers release the slot
+        with self.in_flight -= 1"""
+        if self.saturated():
+            self.counters["rejected"] += 1
+            raise ChatModelSaturated()
+        token = self.breaker.allow()
+        if token is None:
+            self.counters["short_circuited"] += 1
+            raise ChatModelUnavailable("circuit open")
+        self.counters["calls"] += 1
+        self.in_flight += 1
+        return token
+
+    def failed(self, token: int, error: Exception) -> ChatModelUnavailable:
+        self.breaker.record(token, False)
+        self.counters["failures"] += 1
+        if isinstance(error, asyncio.TimeoutError):
+            self.counters["timeouts"] += 1
+        return ChatModelUnavailable(type(error).__name__)
+
+    async def complete(self, session_id: str, system_message: str, text: str) -> str:
+        token = self.admit()
+        try:
+            reply = await asyncio.wait_for(
+                self.model.complete(session_id, system_message, text), self.timeout_seconds
+            )
+        except asyncio.CancelledError:
+            self.breaker.abandon(token)
+            raise
+        except Exception as e:
+            raise self.failed(token, e) from e
+        finally:
+            self.in_flight -= 1
+        self.breaker.record(token, True)
+        return reply
+
+    async def stream(self, session_id: str, system_message: str, text: str) -> AsyncIterator[str]:
+        """The deadline covers the whole reply, not each chunk"""
+        token = self.admit()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout_seconds
+        chunks = self.model.stream(session_id, system_message, text).__aiter__()
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), max(deadline - loop.time(), 0))
+                except StopAsyncIteration:
+                    break
+                yield chunk
+        except (asyncio.CancelledError, GeneratorExit):
+            # Client gone: no verdict on the upstream
+            self.breaker.abandon(token)
+            raise
+        except Exception as e:
+            raise self.failed(token, e) from e
+        finally:
+            self.in_flight -= 1
+            await chunks.aclose()
+        self.breaker.record(token, True)
+
+    def metrics(self) -> dict:
+        return {
+            **self.counters,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "timeout_seconds": self.timeout_seconds,
+            "circuit": self.breaker.state
+        }
+
+def create_chat_model(
+    provider: str,
+    api_key: str,
+    model: str,
+    token_delay_seconds: float = 0.0,
+    failure_rate: float = 0.0
+) -> ChatModel:
+    if provider == "local":
+        return LocalChatModel(token_delay_seconds, failure_rate)
+    if provider == "emergent":
+        return EmergentChatModel(api_key, model)
+    raise ValueError(f"Unknown LLM_PROVIDER: {provider}")
@@ -0,0 +1,259 @@
+"""
+Geometry helpers for GPS positions. Coordinates are WGS84 degrees; bounding
+boxes use GeoJSON order (min_lng, min_lat, max_lng, max_lat).
+"""
+import math
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+BBox = Tuple[float, float, float, float]
+
+EARTH_RADIUS_M = 6371008.8
+
+def parse_bbox(value: str) -> BBox:
+    """Parse "min_lng,min_lat,max_lng,max_lat"; raises ValueError"""
+    parts = [float(part) for part in value.split(",")]
+    if len(parts) != 4:
+        raise ValueError("bbox needs 4 comma separated numbers")
+    min_lng, min_lat, max_lng, max_lat = parts
+    if not (-180 <= min_lng <= max_lng <= 180 and -90 <= min_lat <= max_lat <= 90):
+        raise ValueError("bbox must be min_lng,min_lat,max_lng,max_lat within world bounds")
+    return min_lng, min_lat, max_lng, max_lat
+
+def in_bbox(latitude: float, longitude: float, bbox: Optional[BBox]) -> bool:
+    """True when the point is inside bbox; no bbox means the whole world"""
+    if bbox is None:
+        return True
+    min_lng, min_lat, max_lng, max_lat = bbox
+    return min_lat <= latitude <= max_lat and min_lng <= longitude <= max_lng
+
+def parse_lat_lng(value: str) -> Tuple[float, float]:
+    """Parse "lat,lng"; raises ValueError"""
+    parts = [float(part) for part in value.split(",")]
+    if len(parts) != 2 or not (-90 <= parts[0] <= 90 and -180 <= parts[1] <= 180):
+        raise ValueError("expected lat,lng")
+    return parts[0], parts[1]
+
+def geo_point(latitude: float, longitude: float) -> dict:
+    return {"type": "Point", "coordinates": [longitude, latitude]}
+
+# A polygon wider than a hemisphere is read by 2dsphere as its complement, and at a
+# pole every longitude is the same point (duplicate vertices)
+MAX_POLYGON_WIDTH_DEGREES = 90.0
+POLE_LATITUDE = 89.99
+# East-west edges get a vertex every EDGE_STEP_DEGREES so that, although 2dsphere
+# edges are great circles, they stay within BBOX_PAD_DEGREES of the parallel
+EDGE_STEP_DEGREES = 1.0
+BBOX_PAD_DEGREES = 0.01
+
+def bbox_polygons(bbox: BBox) -> List[dict]:
+    """GeoJSON polygons covering bbox for $geoWithin on a 2dsphere index: slices
+    at most MAX_POLYGON_WIDTH_DEGREES wide, padded so they contain the whole box;
+    pair them with an exact range filter (see in_bbox). Raises ValueError for a
+    box without area."""
+    min_lng, min_lat, max_lng, max_lat = bbox
+    if min_lng >= max_lng or min_lat >= max_lat:
+        raise ValueError("bbox must have a non-zero width and height")
+    south = max(min_lat - BBOX_PAD_DEGREES, -POLE_LATITUDE)
+    north = min(max_lat + BBOX_PAD_DEGREES, POLE_LATITUDE)
+    slices = math.ceil((max_lng - min_lng) / MAX_POLYGON_WIDTH_DEGREES)
+    width = (max_lng - min_lng) / slices
+    polygons = []
+    for index in range(slices):
+        west = min_lng + index * width
+        east = max_lng if index == slices - 1 else west + width
+        steps = math.ceil((east - west) / EDGE_STEP_DEGREES)
+        # Counterclockwise: along the south edge eastward, back along the north edge
+        ring = [[west + (east - west) * step / steps, south] for step in range(steps + 1)]
+        ring += [[east - (east - west) * step / steps, north] for step in range(steps + 1)]
+        ring.append(ring[0])
+        polygons.append({"type": "Polygon", "coordinates": [ring]})
+    return polygons
+
+def cluster_cell_size(zoom: int, cells_per_tile: int) -> float:
+    """Cell width in degrees so a 256px map tile at zoom holds cells_per_tile cells across"""
+    return 360.0 / (2 ** zoom) / cells_per_tile
+
+def project_meters(latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+    """Equirectangular projection around the mean latitude, in meters: accurate
+    enough to compare distances within a trip"""
+    scale = np.radians(1.0) * EARTH_RADIUS_M
+    x = longitudes * scale * np.cos(np.radians(latitudes.mean()))
+    y = latitudes * scale
+    return np.column_stack((x, y))
+
+def haversine_m(
+    latitudes1: np.ndarray, longitudes1: np.ndarray, latitudes2: np.ndarray, longitudes2: np.ndarray
+) -> np.ndarray:
+    """Great-circle distances in meters between paired points"""
+    lat1, lng1, lat2, lng2 = (np.radians(values) for values in (latitudes1, longitudes1, latitudes2, longitudes2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+def distance_m(latitude1: float, longitude1: float, latitude2: float, longitude2: float) -> float:
+    """Scalar haversine, cheaper than numpy for a single pair"""
+    lat1, lat2 = math.radians(latitude1), math.radians(latitude2)
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(a, 1.0)))
+
+def circle_bbox(latitude: float, longitude: float, radius_m: float) -> BBox:
+    """Bounding box of a circle, clamped to the world bounds"""
+    lat_delta = math.degrees(radius_m / EARTH_RADIUS_M)
+    cos_lat = math.cos(math.radians(latitude))
+    lng_delta = 180.0 if cos_lat < 1e-9 else min(180.0, lat_delta / cos_lat)
+    return (
+        max(-180.0, longitude - lng_delta), max(-90.0, latitude - lat_delta),
+        min(180.0, longitude + lng_delta), min(90.0, latitude + lat_delta)
+    )
+
+def ring_bbox(ring: Sequence[Sequence[float]]) -> BBox:
+    longitudes = [point[0] for point in ring]
+    latitudes = [point[1] for point in ring]
+    return min(longitudes), min(latitudes), max(longitudes), max(latitudes)
+
+def in_ring(latitude: float, longitude: float, ring: Sequence[Sequence[float]]) -> bool:
+    """Ray casting point-in-polygon test; ring is a list of [lng, lat]"""
+    inside = False
+    previous_lng, previous_lat = ring[-1][0], ring[-1][1]
+    for lng, lat in ring:
+        if (lat > latitude) != (previous_lat > latitude):
+            crossing = lng + (latitude - lat) * (previous_lng - lng) / (previous_lat - lat)
+            if longitude < crossing:
+                inside = not inside
+        previous_lng, previous_lat = lng, lat
+    return inside
+
+def ring_cells(x: int, y: int, ring: int) -> Iterator[Tuple[int, int]]:
+    """Grid cells at Chebyshev distance ring from (x, y)"""
+    if ring == 0:
+        yield x, y
+        return
+    for cell_x in range(x - ring, x + ring + 1):
+        yield cell_x, y - ring
+        yield cell_x, y + ring
+    for cell_y in range(y - ring + 1, y + ring):
+        yield x - ring, cell_y
+        yield x + ring, cell_y
+
+class PointGrid:
+    """Points bucketed in cell_degrees cells for nearest neighbour searches
+    that only look at the cells around the query point"""
+
+    def __init__(self, cell_degrees: float):
+        self.cell_degrees = cell_degrees
+        self.cells: Dict[Tuple[int, int], Set[str]] = {}
+        self.positions: Dict[str, Tuple[float, float, Tuple[int, int]]] = {}
+
+    def cell(self, latitude: float, longitude: float) -> Tuple[int, int]:
+        return math.floor(longitude / self.cell_degrees), math.floor(latitude / self.cell_degrees)
+
+    def move(self, item_id: str, latitude: float, longitude: float):
+        self.remove(item_id)
+        cell = self.cell(latitude, longitude)
+        self.cells.setdefault(cell, set()).add(item_id)
+        self.positions[item_id] = (latitude, longitude, cell)
+
+    def remove(self, item_id: str):
+        position = self.positions.pop(item_id, None)
+        if position is not None:
+            items = self.cells[position[2]]
+            items.discard(item_id)
+            if not items:
+                del self.cells[position[2]]
+
+    def clear(self):
+        self.cells.clear()
+        self.positions.clear()
+
+    def ring_reach_m(self, latitude: float, ring: int) -> float:
+        """Lower bound of the distance from a point to any cell beyond ring, using
+        the narrowest (poleward) longitude span reached by the ring"""
+        poleward = min(89.9, abs(latitude) + ring * self.cell_degrees)
+        return math.radians(ring * self.cell_degrees) * EARTH_RADIUS_M * math.cos(math.radians(poleward))
+
+    def nearest(
+        self,
+        latitude: float,
+        longitude: float,
+        k: int,
+        accept: Optional[Callable[[str], bool]] = None,
+        max_distance_m: Optional[float] = None
+    ) -> List[Tuple[float, str]]:
+        """Up to k (distance in meters, id) pairs, closest first, among the accepted items.
+
+        Rings of cells are visited outwards until k items are found closer than
+        anything the next ring could hold. Once a ring would have more cells than
+        the grid has occupied cells, the remaining items are scanned directly.
+        Longitudes are not wrapped around the antimeridian.
+        """
+        x, y = self.cell(latitude, longitude)
+        found: List[Tuple[float, str]] = []
+        visited = 0
+        ring = 0
+
+        def collect(item_ids):
+            for item_id in item_ids:
+                if accept is not None and not accept(item_id):
+                    continue
+                item_latitude, item_longitude, _ = self.positions[item_id]
+                distance = distance_m(latitude, longitude, item_latitude, item_longitude)
+                if max_distance_m is None or distance <= max_distance_m:
+                    found.append((distance, item_id))
+
+        while visited < len(self.positions):
+            if 8 * ring > len(self.cells):
+                collect(
+                    item_id for item_id, (_, _, (cell_x, cell_y)) in self.positions.items()
+                    if max(abs(cell_x - x), abs(cell_y - y)) >= ring
+                )
+                break
+            item_ids = [item_id for cell in ring_cells(x, y, ring) for item_id in self.cells.get(cell, ())]
+            visited += len(item_ids)
+            collect(item_ids)
+            reach = self.ring_reach_m(latitude, ring)
+            if max_distance_m is not None and reach > max_distance_m:
+                break
+            if len(found) >= k:
+                found.sort()
+                if found[k - 1][0] <= reach:
+                    break
+            ring += 1
+
+        found.sort()
+        return found[:k]
+
+def simplify_track(points: Sequence[Tuple[float, float]], tolerance_m: float) -> List[int]:
+    """Douglas-Peucker simplification of (lat, lng) points.
+
+    Returns the indices of the points to keep: the first, the last, and every
+    point farther than tolerance_m from the simplified line.
+    """
+    count = len(points)
+    if count < 3:
+        return list(range(count))
+    coordinates = np.asarray(points, dtype=float)
+    xy = project_meters(coordinates[:, 0], coordinates[:, 1])
+
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        origin = xy[start]
+        direction = xy[end] - origin
+        offsets = xy[start + 1:end] - origin
+        length = np.hypot(direction[0], direction[1])
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(direction[0] * offsets[:, 1] - direction[1] * offsets[:, 0]) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance_m:
+            split = start + 1 + farthest
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return np.flatnonzero(keep).tolist()
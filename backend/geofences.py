@@ -0,0 +1,183 @@
+"""
+In-memory geofence evaluation.
+
+Geofences are polygons (a ring of [lng, lat] points) or circles (a [lng, lat]
+center and a radius in meters), optionally restricted to some vehicles. They are
+registered in a uniform grid so a ping is only tested against the few fences
+whose bounding box covers its cell. The monitor remembers which fences each
+vehicle is inside and reports enter/exit events on transitions only.
+"""
+import math
+from datetime import datetime
+from typing import Dict, List, Set, Tuple
+
+from geo import BBox, circle_bbox, distance_m, in_bbox, in_ring, ring_bbox
+
+POLYGON = "polygon"
+CIRCLE = "circle"
+MAX_RING_POINTS = 1000
+
+class Geofence:
+    def __init__(self, document: dict):
+        self.id = str(document["_id"])
+        self.name = document["name"]
+        self.kind = document["kind"]
+        self.vehicle_ids = set(document.get("vehicle_ids") or [])  # empty means every vehicle
+        if self.kind == CIRCLE:
+            self.center_lng, self.center_lat = document["center"]
+            self.radius_m = document["radius_m"]
+            self.bbox = circle_bbox(self.center_lat, self.center_lng, self.radius_m)
+        else:
+            self.ring = [tuple(point) for point in document["points"]]
+            self.bbox = ring_bbox(self.ring)
+
+    def applies_to(self, vehicle_id: str) -> bool:
+        return not self.vehicle_ids or vehicle_id in self.vehicle_ids
+
+    def contains(self, latitude: float, longitude: float) -> bool:
+        if not in_bbox(latitude, longitude, self.bbox):
+            return False
+        if self.kind == CIRCLE:
+            return distance_m(self.center_lat, self.center_lng, latitude, longitude) <= self.radius_m
+        return in_ring(latitude, longitude, self.ring)
+
+def validate_geofence(kind: str, points, center, radius_m) -> dict:
+    """Shape fields of a geofence document; raises ValueError"""
+    if kind == CIRCLE:
+        if not center or len(center) != 2 or not radius_m or radius_m <= 0:
+            raise ValueError("A circle needs center [lng, lat] and a positive radius_m")
+        if not (-180 <= center[0] <= 180 and -90 <= center[1] <= 90):
+            raise ValueError("center must be [lng, lat] within world bounds")
+        return {"kind": CIRCLE, "center": list(center), "radius_m": radius_m, "points": None}
+    if kind == POLYGON:
+        if not points or len(points) < 3 or len(points) > MAX_RING_POINTS:
+            raise ValueError(f"A polygon needs 3 to {MAX_RING_POINTS} [lng, lat] points")
+        if any(len(point) != 2 or not (-180 <= point[0] <= 180 and -90 <= point[1] <= 90) for point in points):
+            raise ValueError("points must be [lng, lat] pairs within world bounds")
+        return {"kind": POLYGON, "points": [list(point) for point in points], "center": None, "radius_m": None}
+    raise ValueError("kind must be polygon or circle")
+
+class GridIndex:
+    """Uniform grid of cell_degrees cells listing the fences whose bbox overlaps them.
+
+    Fences spanning more than max_cells cells are kept aside and always tested
+    by bbox, so one country-sized fence cannot blow up the grid.
+    """
+
+    def __init__(self, cell_degrees: float, max_cells: int = 10000):
+        self.cell_degrees = cell_degrees
+        self.max_cells = max_cells
+        self.cells: Dict[Tuple[int, int], Set[str]] = {}
+        self.fence_cells: Dict[str, List[Tuple[int, int]]] = {}
+        self.large: Set[str] = set()
+
+    def cell(self, latitude: float, longitude: float) -> Tuple[int, int]:
+        return math.floor(longitude / self.cell_degrees), math.floor(latitude / self.cell_degrees)
+
+    def insert(self, fence_id: str, bbox: BBox):
+        self.remove(fence_id)
+        min_x, min_y = self.cell(bbox[1], bbox[0])
+        max_x, max_y = self.cell(bbox[3], bbox[2])
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > self.max_cells:
+            self.large.add(fence_id)
+            return
+        cells = [(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)]
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(fence_id)
+        self.fence_cells[fence_id] = cells
+
+    def remove(self, fence_id: str):
+        self.large.discard(fence_id)
+        for cell in self.fence_cells.pop(fence_id, []):
+            fences = self.cells[cell]
+            fences.discard(fence_id)
+            if not fences:
+                del self.cells[cell]
+
+    def candidates(self, latitude: float, longitude: float) -> Set[str]:
+        return self.cells.get(self.cell(latitude, longitude), set()) | self.large
+
+class GeofenceMonitor:
+    def __init__(self, cell_degrees: float):
+        self.fences: Dict[str, Geofence] = {}
+        self.index = GridIndex(cell_degrees)
+        self.inside: Dict[str, Set[str]] = {}  # fences each vehicle is in
+        self.evaluated_at: Dict[str, datetime] = {}  # last ping evaluated per vehicle
+        self.counters = {"pings": 0, "events": 0, "late": 0}
+
+    def put(self, document: dict):
+        fence = Geofence(document)
+        self.fences[fence.id] = fence
+        self.index.insert(fence.id, fence.bbox)
+
+    def remove(self, fence_id: str):
+        self.fences.pop(fence_id, None)
+        self.index.remove(fence_id)
+        for fences in self.inside.values():
+            fences.discard(fence_id)
+
+    def replace_all(self, documents: List[dict]):
+        ids = {str(document["_id"]) for document in documents}
+        for fence_id in list(self.fences):
+            if fence_id not in ids:
+                self.remove(fence_id)
+        for document in documents:
+            self.put(document)
+
+    def containing(self, vehicle_id: str, latitude: float, longitude: float) -> Set[str]:
+        return {
+            fence_id
+            for fence_id in self.index.candidates(latitude, longitude)
+            if self.fences[fence_id].applies_to(vehicle_id) and self.fences[fence_id].contains(latitude, longitude)
+        }
+
+    def prime(self, vehicle_id: str, latitude: float, longitude: float, timestamp: datetime):
+        """Set the starting state of a vehicle without reporting events"""
+        if vehicle_id not in self.evaluated_at:
+            self.inside[vehicle_id] = self.containing(vehicle_id, latitude, longitude)
+            self.evaluated_at[vehicle_id] = timestamp
+
+    def forget(self, vehicle_id: str):
+        self.inside.pop(vehicle_id, None)
+        self.evaluated_at.pop(vehicle_id, None)
+
+    def evaluate(self, pings: List[dict]) -> List[dict]:
+        """Enter/exit events caused by pings, in ping order per vehicle"""
+        events = []
+        for ping in sorted(pings, key=lambda ping: ping["timestamp"]):
+            vehicle_id = ping["vehicle_id"]
+            self.counters["pings"] += 1
+            evaluated_at = self.evaluated_at.get(vehicle_id)
+            if evaluated_at is not None and ping["timestamp"] < evaluated_at:
+                # An older position must not flip the state back
+                self.counters["late"] += 1
+                continue
+            self.evaluated_at[vehicle_id] = ping["timestamp"]
+            previous = self.inside.get(vehicle_id, set())
+            current = self.containing(vehicle_id, ping["latitude"], ping["longitude"])
+            if current == previous:
+                continue
+            self.inside[vehicle_id] = current
+            for event, fence_ids in (("enter", current - previous), ("exit", previous - current)):
+                for fence_id in fence_ids:
+                    fence = self.fences.get(fence_id)
+                    events.append({
+                        "geofence_id": fence_id,
+                        "geofence_name": fence.name if fence else None,
+                        "vehicle_id": vehicle_id,
+                        "event": event,
+                        "latitude": ping["latitude"],
+                        "longitude": ping["longitude"],
+                        "timestamp": ping["timestamp"]
+                    })
+        self.counters["events"] += len(events)
+        return events
+
+    def metrics(self) -> dict:
+        return {
+            **self.counters,
+            "geofences": len(self.fences),
+            "grid_cells": len(self.index.cells),
+            "large_geofences": len(self.index.large),
+            "vehicles": len(self.inside)
+        }
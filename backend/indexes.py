@@ -0,0 +1,148 @@
+"""
+Registry of the MongoDB indexes the API queries rely on, applied at startup
+Run: python indexes.py [--dry-run]
+"""
+import asyncio
+import logging
+import os
+import sys
+from pathlib import Path
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE, IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Options that make two indexes on the same keys different
+INDEX_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression")
+
+INDEXES = {
+    "users": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("role", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)], name="role_created_at"),
+    ],
+    "vehicles": [
+        IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)], name="created_at"),
+        IndexModel([("available", ASCENDING)], name="available"),
+        IndexModel([("category", ASCENDING)], name="category"),
+        IndexModel([("available", ASCENDING), ("current_location.point", GEOSPHERE)], name="available_location"),
+    ],
+    "reservations": [
+        # Reservation conflict check
+        IndexModel(
+            [("vehicle_id", ASCENDING), ("status", ASCENDING), ("start_date", ASCENDING), ("end_date", ASCENDING)],
+            name="vehicle_status_dates"
+        ),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)], name="user_created_at"),
+        IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)], name="created_at"),
+        # Rental windows the GPS odometer attributes distance to
+        IndexModel([("status", ASCENDING), ("end_date", ASCENDING)], name="status_end_date"),
+    ],
+    "reservation_slots": [
+        # One document per vehicle per booked night: the uniqueness is the conflict check
+        IndexModel([("vehicle_id", ASCENDING), ("day", ASCENDING)], name="vehicle_day_unique", unique=True),
+        IndexModel([("reservation_id", ASCENDING)], name="reservation_id"),
+        # Vehicles booked during an interval, answered from the index alone
+        IndexModel([("day", ASCENDING), ("vehicle_id", ASCENDING)], name="day_vehicle"),
+        # Past days can no longer conflict
+        IndexModel([("day", ASCENDING)], name="day_ttl", expireAfterSeconds=2 * 24 * 3600),
+    ],
+    "purchases": [
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)], name="user_created_at"),
+        IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)], name="created_at"),
+    ],
+    "location_buckets": [
+        # One bucket per vehicle, resolution and time window; history reads walk start
+        IndexModel(
+            [("vehicle_id", ASCENDING), ("start", ASCENDING), ("resolution", ASCENDING)],
+            name="vehicle_start_resolution_unique",
+            unique=True
+        ),
+        IndexModel([("resolution", ASCENDING), ("start", ASCENDING)], name="resolution_start"),
+    ],
+    "geofence_events": [
+        IndexModel([("timestamp", DESCENDING), ("_id", DESCENDING)], name="timestamp"),
+        IndexModel([("vehicle_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)], name="vehicle_timestamp"),
+        IndexModel([("geofence_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)], name="geofence_timestamp"),
+    ],
+    "gps_devices": [
+        IndexModel([("token_hash", ASCENDING)], name="token_hash_unique", unique=True),
+    ],
+    "chat_messages": [
+        IndexModel([("session_id", ASCENDING), ("created_at", ASCENDING), ("_id", ASCENDING)], name="session_created_at"),
+    ],
+}
+
+def index_options(spec: dict) -> dict:
+    return {option: spec[option] for option in INDEX_OPTIONS if option in spec}
+
+async def plan_indexes(db) -> list:
+    """Compare the registry with the database.
+
+    Returns (collection, action, index name, IndexModel or None) tuples where action
+    is "create" (declared, missing), "conflict" (same keys, different options) or
+    "extra" (present, not declared). Extra and conflicting indexes are only reported.
+    """
+    plan = []
+    for collection, models in INDEXES.items():
+        existing = await db[collection].index_information()
+        existing_by_key = {tuple(info["key"]): (name, info) for name, info in existing.items()}
+        declared_keys = set()
+
+        for model in models:
+            spec = model.document
+            key = tuple(spec["key"].items())
+            declared_keys.add(key)
+            found = existing_by_key.get(key)
+            if found is None:
+                plan.append((collection, "create", spec["name"], model))
+            elif index_options(found[1]) != index_options(spec):
+                plan.append((collection, "conflict", found[0], model))
+
+        for key, (name, _) in existing_by_key.items():
+            if name != "_id_" and key not in declared_keys:
+                plan.append((collection, "extra", name, None))
+    return plan
+
+async def ensure_indexes(db) -> list:
+    """Create missing declared indexes; idempotent, never drops anything"""
+    plan = await plan_indexes(db)
+    for collection, action, name, model in plan:
+        if action == "create":
+            try:
+                await db[collection].create_indexes([model])
+                logger.info(f"Created index {collection}.{name}")
+            except OperationFailure as e:
+                # e.g. duplicate emails preventing the unique index
+                logger.error(f"Could not create index {collection}.{name}: {e}")
+        elif action == "conflict":
+            logger.warning(f"Index {collection}.{name} differs from the registry, left unchanged")
+    return plan
+
+def format_plan(plan: list) -> str:
+    if not plan:
+        return "Indexes are up to date"
+    lines = []
+    for collection, action, name, model in plan:
+        detail = ""
+        if model is not None:
+            spec = model.document
+            detail = f" {dict(spec['key'])} {index_options(spec) or ''}".rstrip()
+        lines.append(f"{action:8} {collection}.{name}{detail}")
+    return "\n".join(lines)
+
+async def main(dry_run: bool):
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+
+    plan = await plan_indexes(db) if dry_run else await ensure_indexes(db)
+    print(format_plan(plan))
+
+    client.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(dry_run="--dry-run" in sys.argv))
@@ -0,0 +1,193 @@
+"""
+Bucketed GPS history.
+
+Raw pings are stored as one `location_buckets` document per vehicle per hour,
+holding parallel arrays (millisecond offsets from the bucket start, latitude,
+longitude, speed, heading). Once older than the raw retention period they are
+rolled up into one document per vehicle per day holding one averaged point per
+minute, which are themselves deleted after the rollup retention period.
+"""
+from datetime import datetime, timedelta
+from itertools import groupby
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+COLLECTION = "location_buckets"
+RAW = "raw"
+ROLLUP = "1m"
+BUCKET_SPANS = {RAW: timedelta(hours=1), ROLLUP: timedelta(days=1)}
+DUPLICATE_KEY_ERROR = 11000
+
+def bucket_start(timestamp: datetime, resolution: str) -> datetime:
+    span = BUCKET_SPANS[resolution]
+    return datetime.min + ((timestamp - datetime.min) // span) * span
+
+def offset_ms(timestamp: datetime, start: datetime) -> int:
+    return (timestamp - start) // timedelta(milliseconds=1)
+
+def bucket_update(vehicle_id: str, resolution: str, start: datetime, points: List[dict], sources=None) -> UpdateOne:
+    """Upsert appending points (dicts with latitude, longitude, speed, heading, timestamp)"""
+    timestamps = [point["timestamp"] for point in points]
+    bucket_filter = {"vehicle_id": vehicle_id, "resolution": resolution, "start": start}
+    update = {
+        "$push": {
+            "t": {"$each": [offset_ms(timestamp, start) for timestamp in timestamps]},
+            "lat": {"$each": [point["latitude"] for point in points]},
+            "lng": {"$each": [point["longitude"] for point in points]},
+            "speed": {"$each": [point.get("speed") or 0.0 for point in points]},
+            "heading": {"$each": [point.get("heading") or 0.0 for point in points]}
+        },
+        "$inc": {"count": len(points)},
+        "$min": {"first": min(timestamps)},
+        "$max": {"last": max(timestamps)}
+    }
+    if sources is not None:
+        # Applying the same sources twice hits the unique index instead
+        bucket_filter["sources"] = {"$nin": sources}
+        update["$addToSet"] = {"sources": {"$each": sources}}
+    return UpdateOne(bucket_filter, update, upsert=True)
+
+async def write_bucket_updates(db, operations: List[UpdateOne]):
+    """bulk_write upserts, retrying those that lost an upsert race to another writer"""
+    try:
+        await db[COLLECTION].bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details["writeErrors"]
+        if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+            raise
+        await db[COLLECTION].bulk_write([operations[error["index"]] for error in errors], ordered=False)
+
+def group_pings(pings: List[dict]) -> Dict[Tuple[str, datetime], List[dict]]:
+    """Pings by (vehicle id, raw bucket start)"""
+    grouped: Dict[Tuple[str, datetime], List[dict]] = {}
+    for ping in pings:
+        key = (ping["vehicle_id"], bucket_start(ping["timestamp"], RAW))
+        grouped.setdefault(key, []).append(ping)
+    return grouped
+
+async def append_pings(db, pings: List[dict]):
+    """Append pings to the raw hourly buckets of their vehicles"""
+    await write_bucket_updates(db, [
+        bucket_update(vehicle_id, RAW, start, points)
+        for (vehicle_id, start), points in group_pings(pings).items()
+    ])
+
+async def move_pings(db, pings: List[dict]) -> int:
+    """Append stored pings to the raw buckets, recording their _id in the buckets'
+    sources; pings already moved by an interrupted or concurrent run are skipped.
+    Returns the number of pings appended"""
+    grouped = group_pings(pings)
+    moved = set()
+    async for bucket in db[COLLECTION].find(
+        {
+            "$or": [{"vehicle_id": vehicle_id, "start": start} for vehicle_id, start in grouped],
+            "resolution": RAW,
+            "sources": {"$in": [ping["_id"] for ping in pings]}
+        },
+        {"sources": 1}
+    ):
+        moved.update(bucket["sources"])
+
+    operations = []
+    appended = 0
+    for (vehicle_id, start), points in grouped.items():
+        points = [point for point in points if point["_id"] not in moved]
+        if points:
+            appended += len(points)
+            operations.append(bucket_update(vehicle_id, RAW, start, points, sources=[point["_id"] for point in points]))
+    if operations:
+        try:
+            await write_bucket_updates(db, operations)
+        except BulkWriteError as e:
+            # Moved by a concurrent run in the meantime
+            if any(error["code"] != DUPLICATE_KEY_ERROR for error in e.details["writeErrors"]):
+                raise
+    return appended
+
+def explode(bucket: dict) -> List[dict]:
+    """Points of a bucket as location dicts, oldest first"""
+    start = bucket["start"]
+    points = [
+        {
+            "vehicle_id": bucket["vehicle_id"],
+            "latitude": latitude,
+            "longitude": longitude,
+            "speed": speed,
+            "heading": heading,
+            "timestamp": start + timedelta(milliseconds=offset)
+        }
+        for offset, latitude, longitude, speed, heading in zip(
+            bucket["t"], bucket["lat"], bucket["lng"], bucket["speed"], bucket["heading"]
+        )
+    ]
+    points.sort(key=lambda point: point["timestamp"])
+    return points
+
+async def iter_points(
+    db,
+    vehicle_id: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    newest_first: bool = False
+):
+    """Yield the points of a vehicle within [start, end], one bucket in memory at a time"""
+    query = {"vehicle_id": vehicle_id}
+    if end is not None:
+        query["start"] = {"$lte": end}
+    if start is not None:
+        query["last"] = {"$gte": start}
+    direction = -1 if newest_first else 1
+
+    async for bucket in db[COLLECTION].find(query).sort([("start", direction), ("resolution", direction)]):
+        points = explode(bucket)
+        if newest_first:
+            points.reverse()
+        for point in points:
+            if (start is None or point["timestamp"] >= start) and (end is None or point["timestamp"] <= end):
+                yield point
+
+def minute_averages(points: List[dict]) -> List[dict]:
+    averaged = []
+    for minute, group in groupby(points, key=lambda point: point["timestamp"].replace(second=0, microsecond=0)):
+        group = list(group)
+        count = len(group)
+        averaged.append({
+            "latitude": sum(point["latitude"] for point in group) / count,
+            "longitude": sum(point["longitude"] for point in group) / count,
+            "speed": sum(point["speed"] for point in group) / count,
+            "heading": group[-1]["heading"],
+            "timestamp": minute
+        })
+    return averaged
+
+async def roll_up(db, before: datetime, batch_size: int = 500) -> int:
+    """Fold raw buckets older than `before` into daily per-minute buckets, then delete them"""
+    rolled = 0
+    while True:
+        buckets = await db[COLLECTION].find(
+            {"resolution": RAW, "start": {"$lt": bucket_start(before, RAW)}}
+        ).limit(batch_size).to_list(batch_size)
+        if not buckets:
+            return rolled
+        for bucket in buckets:
+            points = minute_averages(explode(bucket))
+            if points:
+                start = bucket_start(bucket["start"], ROLLUP)
+                try:
+                    await db[COLLECTION].bulk_write(
+                        [bucket_update(bucket["vehicle_id"], ROLLUP, start, points, sources=[bucket["_id"]])]
+                    )
+                except (BulkWriteError, DuplicateKeyError) as e:
+                    # Already folded in by an interrupted earlier run
+                    errors = e.details.get("writeErrors", []) if isinstance(e, BulkWriteError) else []
+                    if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+                        raise
+            await db[COLLECTION].delete_one({"_id": bucket["_id"]})
+            rolled += 1
+
+async def expire_rollups(db, before: datetime) -> int:
+    """Delete daily rollup buckets that ended before `before`"""
+    result = await db[COLLECTION].delete_many({"resolution": ROLLUP, "start": {"$lt": bucket_start(before, ROLLUP) - BUCKET_SPANS[ROLLUP]}})
+    return result.deleted_count
@@ -0,0 +1,92 @@
+"""
+One-shot data migrations, safe to run several times
+Run: python migrate.py
+"""
+import asyncio
+from motor.motor_asyncio import AsyncIOMotorClient
+from dotenv import load_dotenv
+from pathlib import Path
+import os
+
+from bson import ObjectId
+
+from blob_store import store_images, decode_base64_document, store_document_bytes
+from location_buckets import move_pings
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+async def migrate_vehicle_images(db) -> int:
+    """Replace inline base64 vehicle images with image store references"""
+    migrated = 0
+    async for vehicle in db.vehicles.find({"images": {"$regex": "^data:"}}, {"images": 1}):
+        images = await store_images(db, vehicle["images"])
+        await db.vehicles.update_one({"_id": vehicle["_id"]}, {"$set": {"images": images}})
+        migrated += 1
+    return migrated
+
+async def migrate_reservation_documents(db) -> int:
+    """Replace base64 driver license / ID documents inside reservations with document store ids"""
+    migrated = 0
+    async for reservation in db.reservations.find({}, {"user_id": 1, "driver_license": 1, "id_document": 1}):
+        updates = {}
+        for field in ("driver_license", "id_document"):
+            value = reservation.get(field)
+            if not value or ObjectId.is_valid(value):
+                continue
+            try:
+                content_type, data = decode_base64_document(value)
+            except ValueError:
+                print(f"✗ Reservation {reservation['_id']}: unreadable {field}, left in place")
+                continue
+            updates[field] = await store_document_bytes(db, data, content_type, reservation["user_id"], field)
+        if updates:
+            await db.reservations.update_one({"_id": reservation["_id"]}, {"$set": updates})
+            migrated += 1
+    return migrated
+
+async def migrate_vehicle_location_points(db) -> int:
+    """Add the GeoJSON point used by geospatial queries to vehicle locations"""
+    result = await db.vehicles.update_many(
+        {"current_location.latitude": {"$exists": True}, "current_location.point": {"$exists": False}},
+        [{"$set": {"current_location.point": {
+            "type": "Point",
+            "coordinates": ["$current_location.longitude", "$current_location.latitude"]
+        }}}]
+    )
+    return result.modified_count
+
+async def migrate_location_history(db, batch_size: int = 5000) -> int:
+    """Move one-document-per-ping vehicle_locations into location buckets. Raw
+    buckets keep the ids of the pings moved into them (until rolled up), so a
+    batch appended but not deleted by an interrupted run is not appended twice"""
+    moved = 0
+    while True:
+        pings = await db.vehicle_locations.find().sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not pings:
+            return moved
+        moved += await move_pings(db, pings)
+        await db.vehicle_locations.delete_many({"_id": {"$in": [ping["_id"] for ping in pings]}})
+
+async def run_migrations():
+    # MongoDB connection
+    mongo_url = os.environ['MONGO_URL']
+    client = AsyncIOMotorClient(mongo_url)
+    db = client[os.environ['DB_NAME']]
+
+    vehicles = await migrate_vehicle_images(db)
+    print(f"✓ Moved images of {vehicles} vehicles to the image store")
+
+    located = await migrate_vehicle_location_points(db)
+    print(f"✓ Added GeoJSON points to {located} vehicle locations")
+
+    pings = await migrate_location_history(db)
+    print(f"✓ Moved {pings} GPS pings into location buckets")
+
+    reservations = await migrate_reservation_documents(db)
+    print(f"✓ Moved documents of {reservations} reservations to the document store")
+
+    client.close()
+
+if __name__ == "__main__":
+    asyncio.run(run_migrations())
@@ -0,0 +1,214 @@
+"""
+GPS odometer.
+
+Distance is measured per vehicle as pings are accepted: each batch is chained
+to the last fix of its vehicle and measured with a vectorized haversine, and
+fixes implying an impossible speed are dropped as GPS noise. Distances wait in
+memory until flushed as increments of `vehicle_odometers.pending_m` and of the
+per-reservation `reservation_trips` summaries; apply_mileage then moves whole
+kilometres from pending_m into `vehicles.mileage`.
+
+The last fix of each vehicle lives in the worker that received its pings, so
+with several API workers a vehicle should report to a single one.
+"""
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from geo import haversine_m
+
+ODOMETERS = "vehicle_odometers"
+TRIPS = "reservation_trips"
+
+Fix = Tuple[datetime, float, float]  # timestamp, latitude, longitude
+ReservationWindow = Tuple[str, datetime, datetime]  # reservation id, start, end
+
+def plausible_fixes(latitudes: np.ndarray, longitudes: np.ndarray, seconds: np.ndarray, max_speed_ms: float) -> np.ndarray:
+    """Indices of the fixes kept once every fix reached from the previous kept one
+    faster than max_speed_ms, or not after it, is dropped. The first fix is kept."""
+    kept = np.arange(len(seconds))
+    while len(kept) > 1:
+        distances = haversine_m(latitudes[kept[:-1]], longitudes[kept[:-1]], latitudes[kept[1:]], longitudes[kept[1:]])
+        elapsed = np.diff(seconds[kept])
+        bad = (elapsed <= 0) | (distances > max_speed_ms * elapsed)
+        if not bad.any():
+            break
+        # Only drop the end of a bad segment following a good one: the segment
+        # leaving an outlier is bad as well, but its end is not to blame
+        first_bad = bad & ~np.concatenate(([False], bad[:-1]))
+        kept = np.delete(kept, np.flatnonzero(first_bad) + 1)
+    return kept
+
+def merge_trip(trips: Dict[str, dict], reservation_id: str, trip: dict):
+    current = trips.get(reservation_id)
+    if current is None:
+        trips[reservation_id] = dict(trip)
+        return
+    current["distance_m"] += trip["distance_m"]
+    current["started_at"] = min(current["started_at"], trip["started_at"])
+    current["ended_at"] = max(current["ended_at"], trip["ended_at"])
+    current["max_speed_kmh"] = max(current["max_speed_kmh"], trip["max_speed_kmh"])
+
+class Odometer:
+    """Per-vehicle distance accumulator fed with accepted pings"""
+
+    def __init__(self, max_speed_kmh: float):
+        self.max_speed_ms = max_speed_kmh / 3.6
+        self.last_fix: Dict[str, Fix] = {}
+        self.pending: Dict[str, float] = {}  # meters per vehicle, not flushed yet
+        self.trips: Dict[str, dict] = {}  # trip increments per reservation, not flushed yet
+        self.counters = {"segments": 0, "rejected": 0, "late": 0, "flushes": 0}
+
+    def add(self, pings: List[dict], reservations: Dict[str, List[ReservationWindow]]):
+        """Measure pings; reservations maps vehicle ids to their rental windows"""
+        by_vehicle: Dict[str, List[Fix]] = {}
+        for ping in pings:
+            by_vehicle.setdefault(ping["vehicle_id"], []).append(
+                (ping["timestamp"], ping["latitude"], ping["longitude"])
+            )
+        for vehicle_id, fixes in by_vehicle.items():
+            self.measure(vehicle_id, fixes, reservations.get(vehicle_id, ()))
+
+    def measure(self, vehicle_id: str, fixes: List[Fix], reservations: Iterable[ReservationWindow]):
+        fixes.sort(key=lambda fix: fix[0])
+        last = self.last_fix.get(vehicle_id)
+        if last is not None:
+            # Pings older than the last fix arrived too late to be chained
+            newer = [fix for fix in fixes if fix[0] > last[0]]
+            self.counters["late"] += len(fixes) - len(newer)
+            fixes = [last] + newer
+        if len(fixes) < 2:
+            if fixes:
+                self.last_fix[vehicle_id] = fixes[-1]
+            return
+
+        origin = fixes[0][0]
+        seconds = np.array([(fix[0] - origin).total_seconds() for fix in fixes])
+        latitudes = np.array([fix[1] for fix in fixes])
+        longitudes = np.array([fix[2] for fix in fixes])
+        kept = plausible_fixes(latitudes, longitudes, seconds, self.max_speed_ms)
+        self.counters["rejected"] += len(fixes) - len(kept)
+        self.last_fix[vehicle_id] = fixes[kept[-1]]
+        if len(kept) < 2:
+            return
+
+        starts, ends = kept[:-1], kept[1:]
+        distances = haversine_m(latitudes[starts], longitudes[starts], latitudes[ends], longitudes[ends])
+        elapsed = seconds[ends] - seconds[starts]
+        self.counters["segments"] += len(distances)
+        self.pending[vehicle_id] = self.pending.get(vehicle_id, 0.0) + float(distances.sum())
+
+        # A segment belongs to the reservation running when it ends
+        for reservation_id, start, end in reservations:
+            inside = np.flatnonzero(
+                (seconds[ends] >= (start - origin).total_seconds()) & (seconds[ends] < (end - origin).total_seconds())
+            )
+            if len(inside) == 0:
+                continue
+            merge_trip(self.trips, reservation_id, {
+                "vehicle_id": vehicle_id,
+                "distance_m": float(distances[inside].sum()),
+                "started_at": fixes[starts[inside[0]]][0],
+                "ended_at": fixes[ends[inside[-1]]][0],
+                "max_speed_kmh": float((distances[inside] / elapsed[inside]).max() * 3.6)
+            })
+
+    def forget(self, vehicle_id: str):
+        self.last_fix.pop(vehicle_id, None)
+        self.pending.pop(vehicle_id, None)
+
+    async def load(self, db):
+        """Resume from the last fixes saved by previous flushes"""
+        async for odometer in db[ODOMETERS].find({"last_fix": {"$exists": True}}, {"last_fix": 1}):
+            fix = odometer["last_fix"]
+            self.last_fix.setdefault(odometer["_id"], (fix["timestamp"], fix["latitude"], fix["longitude"]))
+
+    async def flush(self, db):
+        """Write the accumulated distances; they are kept for the next flush on failure"""
+        pending, self.pending = self.pending, {}
+        trips, self.trips = self.trips, {}
+
+        if pending:
+            try:
+                operations = []
+                for vehicle_id, distance in pending.items():
+                    fix = self.last_fix.get(vehicle_id)
+                    if fix is None:
+                        # Forgotten (deleted) since the distance was measured
+                        continue
+                    timestamp, latitude, longitude = fix
+                    operations.append(UpdateOne(
+                        {"_id": vehicle_id},
+                        {
+                            "$inc": {"pending_m": distance, "total_m": distance},
+                            "$set": {"last_fix": {"timestamp": timestamp, "latitude": latitude, "longitude": longitude}}
+                        },
+                        upsert=True
+                    ))
+                if operations:
+                    await db[ODOMETERS].bulk_write(operations, ordered=False)
+            except Exception:
+                for vehicle_id, distance in pending.items():
+                    self.pending[vehicle_id] = self.pending.get(vehicle_id, 0.0) + distance
+                for reservation_id, trip in trips.items():
+                    merge_trip(self.trips, reservation_id, trip)
+                raise
+
+        if trips:
+            try:
+                await db[TRIPS].bulk_write([
+                    UpdateOne(
+                        {"_id": ObjectId(reservation_id)},
+                        {
+                            "$inc": {"distance_m": trip["distance_m"]},
+                            "$min": {"started_at": trip["started_at"]},
+                            "$max": {"ended_at": trip["ended_at"], "max_speed_kmh": trip["max_speed_kmh"]},
+                            "$setOnInsert": {"vehicle_id": trip["vehicle_id"]}
+                        },
+                        upsert=True
+                    )
+                    for reservation_id, trip in trips.items()
+                ], ordered=False)
+            except Exception:
+                for reservation_id, trip in trips.items():
+                    merge_trip(self.trips, reservation_id, trip)
+                raise
+
+        self.counters["flushes"] += 1
+
+    def metrics(self) -> dict:
+        return {
+            **self.counters,
+            "vehicles": len(self.last_fix),
+            "pending_vehicles": len(self.pending),
+            "pending_trips": len(self.trips)
+        }
+
+async def apply_mileage(db) -> int:
+    """Move whole kilometres of flushed distance into vehicles.mileage"""
+    applied = 0
+    async for odometer in db[ODOMETERS].find({"pending_m": {"$gte": 1000}}, {"pending_m": 1}):
+        kilometres = int(odometer["pending_m"] // 1000)
+        # The conditional decrement lets a single worker apply these kilometres
+        taken = await db[ODOMETERS].update_one(
+            {"_id": odometer["_id"], "pending_m": {"$gte": kilometres * 1000}},
+            {"$inc": {"pending_m": -kilometres * 1000}}
+        )
+        if taken.modified_count and ObjectId.is_valid(odometer["_id"]):
+            await db.vehicles.update_one({"_id": ObjectId(odometer["_id"])}, {"$inc": {"mileage": kilometres}})
+            applied += 1
+    return applied
+
+def trip_summary(trip: Optional[dict]) -> dict:
+    if trip is None:
+        return {"distance_km": 0.0, "duration_seconds": 0, "max_speed_kmh": 0.0, "started_at": None, "ended_at": None}
+    return {
+        "distance_km": round(trip["distance_m"] / 1000, 3),
+        "duration_seconds": int((trip["ended_at"] - trip["started_at"]).total_seconds()),
+        "max_speed_kmh": round(trip["max_speed_kmh"], 1),
+        "started_at": trip["started_at"],
+        "ended_at": trip["ended_at"]
+    }
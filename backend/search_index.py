@@ -0,0 +1,241 @@
+"""
+In-memory full-text index over vehicles.
+
+Text is folded (case, accents and punctuation removed) and split into terms,
+each posted with a weight depending on the field it came from. Query terms
+match indexed terms exactly, by prefix (the term being typed) or with one typo:
+every term of 4+ characters is also registered under each single-character
+deletion of itself, so a query term finds terms within one insertion,
+deletion, substitution or swap of adjacent characters by looking up its own
+deletions. Vehicles must match every query term and are ranked first by how
+many terms they match exactly or by prefix, then by the sum of their best
+per-term scores.
+
+Candidates are read best first from the postings of the most selective query
+term, kept sorted by weight, and only looked up in the other terms' postings;
+reading stops once no remaining candidate can enter the top limit.
+"""
+import heapq
+import math
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from chat_cache import normalize_text
+
+FIELD_WEIGHTS = (("name", 3.0), ("brand", 3.0), ("features", 1.5), ("description", 1.0))
+SEARCH_PROJECTION = {field: 1 for field, _ in FIELD_WEIGHTS}
+PREFIX_FACTOR = 0.7
+TYPO_FACTOR = 0.5
+MIN_PREFIX_LENGTH = 2
+MIN_TYPO_LENGTH = 4
+MAX_EXPANSIONS = 50  # candidate terms per query term, most frequent first
+# Match tiers: any exact or prefix match outranks a typo match
+TYPO_TIER = 0
+EXACT_TIER = 1
+
+Match = Tuple[int, float]  # (tier, score)
+
+def deletions(term: str) -> Set[str]:
+    return {term[:index] + term[index + 1:] for index in range(len(term))}
+
+def within_one_edit(a: str, b: str) -> bool:
+    """Damerau-Levenshtein distance <= 1 (swapping adjacent characters is one edit)"""
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    index = 0
+    while index < len(a) and a[index] == b[index]:
+        index += 1
+    if len(a) == len(b):
+        if a[index + 1:] == b[index + 1:]:
+            return True
+        return (
+            index + 1 < len(a)
+            and a[index] == b[index + 1]
+            and a[index + 1] == b[index]
+            and a[index + 2:] == b[index + 2:]
+        )
+    return a[index:] == b[index + 1:]
+
+def field_text(value) -> str:
+    if isinstance(value, list):
+        return " ".join(str(item) for item in value)
+    return str(value) if value is not None else ""
+
+class SearchIndex:
+    def __init__(self):
+        self.postings: Dict[str, Dict[str, float]] = {}  # term -> {vehicle id: weight}
+        self.doc_terms: Dict[str, Set[str]] = {}
+        self.prefixes: Dict[str, Set[str]] = {}  # proper prefix -> terms
+        self.deleted: Dict[str, Set[str]] = {}  # single deletion -> terms
+        self.ranked_postings: Dict[str, List[Tuple[float, str]]] = {}  # sorted lazily, dropped on change
+
+    def __len__(self) -> int:
+        return len(self.doc_terms)
+
+    def add_term(self, term: str):
+        for length in range(MIN_PREFIX_LENGTH, len(term)):
+            self.prefixes.setdefault(term[:length], set()).add(term)
+        if len(term) >= MIN_TYPO_LENGTH:
+            for variant in deletions(term):
+                self.deleted.setdefault(variant, set()).add(term)
+
+    def drop_term(self, term: str):
+        for length in range(MIN_PREFIX_LENGTH, len(term)):
+            self.discard(self.prefixes, term[:length], term)
+        if len(term) >= MIN_TYPO_LENGTH:
+            for variant in deletions(term):
+                self.discard(self.deleted, variant, term)
+
+    @staticmethod
+    def discard(mapping: Dict[str, Set[str]], key: str, term: str):
+        terms = mapping.get(key)
+        if terms is not None:
+            terms.discard(term)
+            if not terms:
+                del mapping[key]
+
+    def put(self, vehicle_id: str, vehicle: dict):
+        self.remove(vehicle_id)
+        weights: Dict[str, float] = {}
+        for field, weight in FIELD_WEIGHTS:
+            for term in normalize_text(field_text(vehicle.get(field))).split():
+                weights[term] = weights.get(term, 0.0) + weight
+        for term, weight in weights.items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = {}
+                self.add_term(term)
+            # Repeats count, with diminishing returns
+            posting[vehicle_id] = 1 + math.log(weight)
+            self.ranked_postings.pop(term, None)
+        self.doc_terms[vehicle_id] = set(weights)
+
+    def remove(self, vehicle_id: str):
+        for term in self.doc_terms.pop(vehicle_id, ()):
+            posting = self.postings[term]
+            posting.pop(vehicle_id, None)
+            self.ranked_postings.pop(term, None)
+            if not posting:
+                del self.postings[term]
+                self.drop_term(term)
+
+    def replace_all(self, vehicles: Iterable[dict]):
+        self.postings.clear()
+        self.doc_terms.clear()
+        self.prefixes.clear()
+        self.deleted.clear()
+        self.ranked_postings.clear()
+        for vehicle in vehicles:
+            self.put(str(vehicle["_id"]), vehicle)
+
+    def expansions(self, token: str) -> Dict[str, Match]:
+        """Indexed terms a query token stands for, with their tier and match factor"""
+        matches: Dict[str, Match] = {}
+        if len(token) >= MIN_TYPO_LENGTH:
+            candidates = set(self.deleted.get(token, ()))
+            for variant in deletions(token):
+                if variant in self.postings:
+                    candidates.add(variant)
+                candidates.update(self.deleted.get(variant, ()))
+            for term in candidates:
+                if within_one_edit(token, term):
+                    matches[term] = (TYPO_TIER, TYPO_FACTOR)
+        if len(token) >= MIN_PREFIX_LENGTH:
+            for term in self.prefixes.get(token, ()):
+                matches[term] = (EXACT_TIER, PREFIX_FACTOR)
+        if token in self.postings:
+            matches[token] = (EXACT_TIER, 1.0)
+        if len(matches) > MAX_EXPANSIONS:
+            kept = heapq.nlargest(MAX_EXPANSIONS, matches, key=lambda term: (matches[term], len(self.postings[term])))
+            matches = {term: matches[term] for term in kept}
+        return matches
+
+    def idf(self, term: str) -> float:
+        return math.log(1 + len(self.doc_terms) / len(self.postings[term]))
+
+    def ranked(self, term: str) -> List[Tuple[float, str]]:
+        """Postings of term as (weight, vehicle id), best first"""
+        ranked = self.ranked_postings.get(term)
+        if ranked is None:
+            ranked = sorted(((weight, vehicle_id) for vehicle_id, weight in self.postings[term].items()), reverse=True)
+            self.ranked_postings[term] = ranked
+        return ranked
+
+    def scored(self, term: str, tier: int, factor: float) -> Iterator[Tuple[int, float, str]]:
+        scale = self.idf(term) * factor
+        for weight, vehicle_id in self.ranked(term):
+            yield tier, weight * scale, vehicle_id
+
+    def candidates(self, matches: Dict[str, Match]) -> Iterator[Tuple[int, float, str]]:
+        """(tier, score, vehicle id) of every vehicle matching a token, best first,
+        reading the ranked postings of its terms only as far as consumed"""
+        streams = [self.scored(term, tier, factor) for term, (tier, factor) in matches.items()]
+        seen = set()
+        # A vehicle first shows up with its best match
+        for tier, score, vehicle_id in heapq.merge(*streams, reverse=True):
+            if vehicle_id not in seen:
+                seen.add(vehicle_id)
+                yield tier, score, vehicle_id
+
+    def lookups(self, matches: Dict[str, Match]) -> List[Tuple[Dict[str, float], int, float]]:
+        """(posting, tier, scale) of each term of a token, to score given vehicles"""
+        return [(self.postings[term], tier, self.idf(term) * factor) for term, (tier, factor) in matches.items()]
+
+    def ceiling(self, matches: Dict[str, Match]) -> Match:
+        """Best match any vehicle can get for a token"""
+        return max(
+            (tier, self.ranked(term)[0][0] * self.idf(term) * factor) for term, (tier, factor) in matches.items()
+        )
+
+    @staticmethod
+    def best_match(lookups: List[Tuple[Dict[str, float], int, float]], vehicle_id: str) -> Optional[Match]:
+        best = None
+        for posting, tier, scale in lookups:
+            weight = posting.get(vehicle_id)
+            if weight is not None and (best is None or (tier, weight * scale) > best):
+                best = (tier, weight * scale)
+        return best
+
+    def search(self, query: str, limit: int) -> List[Tuple[str, float]]:
+        """(vehicle id, score) of the best vehicles matching every query token"""
+        tokens = list(dict.fromkeys(normalize_text(query).split()))
+        per_token = [self.expansions(token) for token in tokens]
+        if not per_token or not all(per_token):
+            return []
+        # Candidates come from the most selective token, best first; the others are
+        # only looked up for them, until no candidate left can enter the top limit
+        per_token.sort(key=lambda matches: sum(len(self.postings[term]) for term in matches))
+        others = [self.lookups(matches) for matches in per_token[1:]]
+        ceiling_tier = ceiling_score = 0
+        for matches in per_token[1:]:
+            tier, score = self.ceiling(matches)
+            ceiling_tier += tier
+            ceiling_score += score
+        best: List[Tuple[int, float, str]] = []  # min-heap of the top limit
+        for tier, score, vehicle_id in self.candidates(per_token[0]):
+            if len(best) >= limit and (tier + ceiling_tier, score + ceiling_score, vehicle_id) < best[0]:
+                break
+            for lookups in others:
+                match = self.best_match(lookups, vehicle_id)
+                if match is None:
+                    break
+                tier += match[0]
+                score += match[1]
+            else:
+                entry = (tier, score, vehicle_id)
+                if len(best) < limit:
+                    heapq.heappush(best, entry)
+                elif entry > best[0]:
+                    heapq.heapreplace(best, entry)
+        return [(vehicle_id, score) for _, score, vehicle_id in sorted(best, reverse=True)]
+
+    def metrics(self) -> dict:
+        return {
+            "vehicles": len(self.doc_terms),
+            "terms": len(self.postings),
+            "prefixes": len(self.prefixes),
+            "deletions": len(self.deleted)
+        }
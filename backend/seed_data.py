@@ -4,6 +4,7 @@ from motor.motor_asyncio import AsyncIOMotorClient
 from datetime import datetime
 import bcrypt
 from dotenv import load_dotenv
+from migrate import migrate_vehicle_images, migrate_vehicle_location_points
 
 # Images placeholder base64 (small colored squares)
 PLACEHOLDER_IMAGES = {
@@ -27,6 +28,7 @@ async def seed_database():
     # Clear existing data
     await db.vehicles.delete_many({})
     await db.users.delete_many({})
+    await db.stats.delete_many({})  # recomputed by the API on next startup
     print("✅ Cleared existing data")
     
     # Create admin user
@@ -245,6 +247,12 @@ async def seed_database():
     result = await db.vehicles.insert_many(vehicles)
     print(f"✅ Created {len(result.inserted_ids)} vehicles")
     
+    # Move the inline placeholder images to the image store
+    migrated = await migrate_vehicle_images(db)
+    print(f"✅ Stored images of {migrated} vehicles")
+    located = await migrate_vehicle_location_points(db)
+    print(f"✅ Indexed locations of {located} vehicles")
+    
     print("\n🎉 Database seeded successfully!")
     print("\n📝 Test accounts:")
     print("   Admin: admin@autorent.com / admin123")
@@ -1,19 +1,51 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form, Header
+from fastapi import FastAPI, APIRouter, BackgroundTasks, HTTPException, Depends, UploadFile, File, Form, Header, Query, Request, WebSocket, WebSocketDisconnect
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
+from starlette.responses import Response, StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
-from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict, Any
-from datetime import datetime, timedelta
+from pymongo import UpdateOne, ReplaceOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pydantic import BaseModel, Field, EmailStr, ValidationError
+from typing import List, Optional, Dict, Any, Iterable, Set
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import os
+import asyncio
 import logging
 import uuid
+import json
+import hashlib
+import secrets
+import base64
+import binascii
 import jwt
 import bcrypt
 from bson import ObjectId
-from emergentintegrations.llm.chat import LlmChat, UserMessage
+from bson.errors import InvalidId
+from cachetools import TTLCache
+from blob_store import (
+    IMAGE_HASH_RE, open_image, iter_grid_out, store_images,
+    decode_base64_document, store_document_bytes, store_upload, delete_document, open_document
+)
+from indexes import ensure_indexes
+from geo import (
+    BBox, PointGrid, parse_bbox, parse_lat_lng, in_bbox, geo_point, bbox_polygons, cluster_cell_size, simplify_track
+)
+from migrate import migrate_vehicle_location_points, migrate_location_history
+from location_buckets import append_pings, iter_points, roll_up, expire_rollups
+from odometer import Odometer, ReservationWindow, apply_mileage, trip_summary
+from geofences import GeofenceMonitor, validate_geofence
+from chat_models import (
+    CircuitBreaker, GuardedChatModel, ChatModelSaturated, ChatModelUnavailable, create_chat_model
+)
+from chat_context import load_session, build_system_message, record_turn, fold_into_summary
+from chat_cache import ResponseCache
+from catalogue import CATALOGUE_PROJECTION, CatalogueDigest
+from search_index import SEARCH_PROJECTION, SearchIndex
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -28,8 +60,104 @@ SECRET_KEY = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production'
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
 
+# Reservation documents (driver license, ID)
+DOCUMENT_MAX_BYTES = int(os.environ.get('DOCUMENT_MAX_BYTES', 10 * 1024 * 1024))
+# Served back to browsers: only raster images and PDF, never SVG or HTML
+DOCUMENT_CONTENT_TYPES = {"image/jpeg", "image/png", "image/webp", "image/heic", "application/pdf"}
+# Longest reservation accepted; every booked day costs a ledger document
+RESERVATION_MAX_DAYS = int(os.environ.get('RESERVATION_MAX_DAYS', 365))
+
+# Password hashing runs in a bounded thread pool; requests beyond
+# PASSWORD_HASH_CONCURRENCY running + PASSWORD_HASH_MAX_QUEUE waiting get a 503
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+PASSWORD_HASH_CONCURRENCY = int(os.environ.get('PASSWORD_HASH_CONCURRENCY', 4))
+PASSWORD_HASH_MAX_QUEUE = int(os.environ.get('PASSWORD_HASH_MAX_QUEUE', 32))
+
+# GPS ingestion: pings are buffered in memory and written in bulk when
+# GPS_BUFFER_MAX_PINGS are waiting or every GPS_FLUSH_INTERVAL_SECONDS
+GPS_BUFFER_MAX_PINGS = int(os.environ.get('GPS_BUFFER_MAX_PINGS', 1000))
+GPS_FLUSH_INTERVAL_SECONDS = float(os.environ.get('GPS_FLUSH_INTERVAL_SECONDS', 1.0))
+# Pings whose write failed are retried on the next flushes; beyond
+# GPS_BUFFER_RETRY_MAX_PINGS waiting, the oldest are dropped
+GPS_BUFFER_RETRY_MAX_PINGS = int(os.environ.get('GPS_BUFFER_RETRY_MAX_PINGS', 100000))
+GPS_MAX_BATCH = int(os.environ.get('GPS_MAX_BATCH', 5000))
+# Ingestion bodies are read up to GPS_MAX_BODY_BYTES, then refused with a 413
+GPS_MAX_BODY_BYTES = int(os.environ.get('GPS_MAX_BODY_BYTES', 4 * 1024 * 1024))
+GPS_DEVICE_RELOAD_SECONDS = int(os.environ.get('GPS_DEVICE_RELOAD_SECONDS', 60))
+
+# Mileage from GPS: fixes implying more than GPS_MAX_SPEED_KMH are treated as noise;
+# distances are flushed with the GPS buffer and added to vehicle mileage periodically
+GPS_MAX_SPEED_KMH = float(os.environ.get('GPS_MAX_SPEED_KMH', 250))
+MILEAGE_UPDATE_INTERVAL_SECONDS = int(os.environ.get('MILEAGE_UPDATE_INTERVAL_SECONDS', 300))
+TRIP_RESERVATION_RELOAD_SECONDS = int(os.environ.get('TRIP_RESERVATION_RELOAD_SECONDS', 60))
+
+# Geofences are evaluated in memory on every ping; other workers' edits are
+# picked up every GEOFENCE_RELOAD_SECONDS
+GEOFENCE_GRID_CELL_DEGREES = float(os.environ.get('GEOFENCE_GRID_CELL_DEGREES', 0.05))
+GEOFENCE_RELOAD_SECONDS = int(os.environ.get('GEOFENCE_RELOAD_SECONDS', 60))
+
+# In-memory fleet used by the live map, reloaded to pick up other workers' changes
+FLEET_RELOAD_SECONDS = int(os.environ.get('FLEET_RELOAD_SECONDS', 60))
+# Grid cell size of the in-memory index answering nearest vehicle searches
+NEAREST_GRID_CELL_DEGREES = float(os.environ.get('NEAREST_GRID_CELL_DEGREES', 0.01))
+NEAREST_MAX_K = 50
+
+# Full-text vehicle search is served from memory and updated on every vehicle change
+# made through this worker; set SEARCH_INDEX_RELOAD_SECONDS when several workers write vehicles
+SEARCH_INDEX_RELOAD_SECONDS = int(os.environ.get('SEARCH_INDEX_RELOAD_SECONDS', 0))
+
+# Location history: tracks are simplified HISTORY_SIMPLIFY_CHUNK_POINTS points at a
+# time off the event loop; a simplified track over HISTORY_MAX_POINTS points is refused
+HISTORY_SIMPLIFY_CHUNK_POINTS = int(os.environ.get('HISTORY_SIMPLIFY_CHUNK_POINTS', 50000))
+HISTORY_MAX_POINTS = int(os.environ.get('HISTORY_MAX_POINTS', 200000))
+# Raw pings are kept this long, then averaged per minute; those averages expire too
+LOCATION_RAW_RETENTION_DAYS = int(os.environ.get('LOCATION_RAW_RETENTION_DAYS', 30))
+LOCATION_ROLLUP_RETENTION_DAYS = int(os.environ.get('LOCATION_ROLLUP_RETENTION_DAYS', 365))
+LOCATION_RETENTION_INTERVAL_SECONDS = int(os.environ.get('LOCATION_RETENTION_INTERVAL_SECONDS', 3600))
+
+# Map queries
+MAP_MAX_VEHICLES = 5000
+MAP_CLUSTER_CELLS_PER_TILE = int(os.environ.get('MAP_CLUSTER_CELLS_PER_TILE', 8))
+
+# Authenticated user cache: role changes and deletions made outside the API
+# are picked up after at most USER_CACHE_TTL_SECONDS
+USER_CACHE_TTL_SECONDS = int(os.environ.get('USER_CACHE_TTL_SECONDS', 60))
+USER_CACHE_MAX_SIZE = int(os.environ.get('USER_CACHE_MAX_SIZE', 10000))
+
+# Dashboard statistics are kept up to date incrementally; this only repairs drift
+STATS_RECONCILE_INTERVAL_SECONDS = int(os.environ.get('STATS_RECONCILE_INTERVAL_SECONDS', 24 * 3600))
+
 # Emergent LLM Key
 EMERGENT_LLM_KEY = os.environ.get('EMERGENT_LLM_KEY', '')
+# Chat assistant backend: emergent, or local for a deterministic offline stand-in
+LLM_PROVIDER = os.environ.get('LLM_PROVIDER', 'emergent')
+LLM_MODEL = os.environ.get('LLM_MODEL', 'openai/gpt-4o-mini')
+LOCAL_LLM_TOKEN_DELAY_SECONDS = float(os.environ.get('LOCAL_LLM_TOKEN_DELAY_SECONDS', 0))
+LOCAL_LLM_FAILURE_RATE = float(os.environ.get('LOCAL_LLM_FAILURE_RATE', 0))
+# LLM calls get LLM_TIMEOUT_SECONDS; beyond LLM_MAX_CONCURRENCY calls in flight requests
+# get an immediate 503, and once LLM_BREAKER_FAILURE_RATIO of recent calls failed the
+# canned fallback reply is served for LLM_BREAKER_COOLDOWN_SECONDS
+LLM_TIMEOUT_SECONDS = float(os.environ.get('LLM_TIMEOUT_SECONDS', 30))
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 16))
+LLM_BREAKER_FAILURE_RATIO = float(os.environ.get('LLM_BREAKER_FAILURE_RATIO', 0.5))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.environ.get('LLM_BREAKER_COOLDOWN_SECONDS', 30))
+# Conversation context: the last CHAT_CONTEXT_TURNS exchanges plus a rolling summary
+# of older ones, within CHAT_CONTEXT_TOKEN_BUDGET tokens on top of the system message
+CHAT_CONTEXT_TURNS = int(os.environ.get('CHAT_CONTEXT_TURNS', 6))
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.environ.get('CHAT_CONTEXT_TOKEN_BUDGET', 1500))
+CHAT_SUMMARY_MAX_TOKENS = int(os.environ.get('CHAT_SUMMARY_MAX_TOKENS', 300))
+# Replies to the first question of a session are cached by normalized text and the
+# catalogue lines retrieved for it. With CHAT_CACHE_SIMILARITY > 0 they are also reused
+# for questions with the same numbers and content words whose trigram similarity
+# reaches it (off by default); the cache is emptied whenever a vehicle changes
+CHAT_CACHE_TTL_SECONDS = int(os.environ.get('CHAT_CACHE_TTL_SECONDS', 3600))
+CHAT_CACHE_MAX_SIZE = int(os.environ.get('CHAT_CACHE_MAX_SIZE', 1000))
+CHAT_CACHE_SIMILARITY = float(os.environ.get('CHAT_CACHE_SIMILARITY', 0))
+# The prompt describes the fleet with an overview and the CHAT_CATALOGUE_TOP_K vehicles
+# most relevant to the question; other workers' vehicle changes are picked up
+# every CATALOGUE_RELOAD_SECONDS
+CHAT_CATALOGUE_TOP_K = int(os.environ.get('CHAT_CATALOGUE_TOP_K', 5))
+CATALOGUE_RELOAD_SECONDS = int(os.environ.get('CATALOGUE_RELOAD_SECONDS', 300))
 
 # Create the main app
 app = FastAPI()
@@ -84,7 +212,7 @@ class VehicleCreate(BaseModel):
     fuel: str  # essence, diesel, electric, hybrid
     mileage: int
     description: str
-    images: List[str] = []  # base64 images
+    images: List[str] = []  # image URLs; base64 data URIs are moved to the image store
     features: List[str] = []
     available: bool = True
 
@@ -100,8 +228,8 @@ class ReservationCreate(BaseModel):
     vehicle_id: str
     start_date: datetime
     end_date: datetime
-    driver_license: str  # base64
-    id_document: str  # base64
+    driver_license: str  # base64, moved to the document store
+    id_document: str  # base64, moved to the document store
 
 class Reservation(BaseModel):
     id: Optional[str] = Field(default=None, alias="_id")
@@ -109,8 +237,8 @@ class Reservation(BaseModel):
     vehicle_id: str
     start_date: datetime
     end_date: datetime
-    driver_license: str
-    id_document: str
+    driver_license: str  # document id
+    id_document: str  # document id
     status: str = "pending"  # pending, accepted, rejected, completed
     total_price: float
     created_at: datetime = Field(default_factory=datetime.utcnow)
@@ -151,6 +279,28 @@ class LocationUpdate(BaseModel):
     speed: Optional[float] = 0.0
     heading: Optional[float] = 0.0
 
+class GpsPing(BaseModel):
+    vehicle_id: str
+    latitude: float = Field(ge=-90, le=90)
+    longitude: float = Field(ge=-180, le=180)
+    speed: Optional[float] = 0.0
+    heading: Optional[float] = 0.0
+    timestamp: Optional[datetime] = None  # device time, defaults to reception time
+
+class DeviceCreate(BaseModel):
+    name: str
+    # Vehicles the tracker may report for; None lets it report for any vehicle
+    vehicle_ids: Optional[List[str]] = None
+
+class GeofenceCreate(BaseModel):
+    name: str
+    kind: str  # polygon, circle
+    points: Optional[List[List[float]]] = None  # polygon ring of [lng, lat]
+    center: Optional[List[float]] = None  # circle center [lng, lat]
+    radius_m: Optional[float] = None
+    vehicle_ids: List[str] = []  # empty applies to every vehicle
+    active: bool = True
+
 class VehicleLocation(BaseModel):
     id: Optional[str] = Field(default=None, alias="_id")
     vehicle_id: str
@@ -193,20 +343,470 @@ def verify_token(token: str) -> dict:
     except jwt.JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+# User records by id, least recently used evicted first once full
+user_cache = TTLCache(maxsize=USER_CACHE_MAX_SIZE, ttl=USER_CACHE_TTL_SECONDS)
+user_cache_counters = {"hits": 0, "misses": 0, "invalidations": 0}
+
+def invalidate_user(user_id: str):
+    """Drop a cached user record; call whenever a user document changes"""
+    if user_cache.pop(user_id, None) is not None:
+        user_cache_counters["invalidations"] += 1
+
+def cache_metrics(counters: dict, cache) -> dict:
+    lookups = counters["hits"] + counters["misses"]
+    return {
+        **counters,
+        "size": len(cache),
+        "max_size": cache.maxsize,
+        "hit_rate": counters["hits"] / lookups if lookups else 0.0
+    }
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
     token = credentials.credentials
     payload = verify_token(token)
-    user = await db.users.find_one({"_id": ObjectId(payload.get("user_id"))})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    user["_id"] = str(user["_id"])
-    return user
+    user_id = payload.get("user_id")
+    
+    user = user_cache.get(user_id)
+    if user is not None:
+        user_cache_counters["hits"] += 1
+    else:
+        user_cache_counters["misses"] += 1
+        user = await db.users.find_one({"_id": ObjectId(user_id)})
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        user["_id"] = str(user["_id"])
+        user_cache[user_id] = user
+    
+    # Handlers get their own copy so they cannot alter the cached record
+    return dict(user)
+
+password_executor = ThreadPoolExecutor(
+    max_workers=PASSWORD_HASH_CONCURRENCY,
+    thread_name_prefix="bcrypt"
+)
+password_hash_counters = {"in_flight": 0, "completed": 0, "rejected": 0, "rehashed": 0}
+
+async def run_password_job(func, *args):
+    """Run a bcrypt call off the event loop, rejecting when the queue is full"""
+    if password_hash_counters["in_flight"] >= PASSWORD_HASH_CONCURRENCY + PASSWORD_HASH_MAX_QUEUE:
+        password_hash_counters["rejected"] += 1
+        raise HTTPException(
+            status_code=503,
+            detail="Server busy, please retry",
+            headers={"Retry-After": "1"}
+        )
+    password_hash_counters["in_flight"] += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, func, *args)
+    finally:
+        password_hash_counters["in_flight"] -= 1
+        password_hash_counters["completed"] += 1
+
+def _hash_password(password: str) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
+
+def _check_password(password: str, hashed_password: str) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+async def hash_password(password: str) -> str:
+    return await run_password_job(_hash_password, password)
+
+async def verify_password(password: str, hashed_password: str) -> bool:
+    return await run_password_job(_check_password, password, hashed_password)
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    """True when the hash was made with another work factor than BCRYPT_ROUNDS"""
+    try:
+        return int(hashed_password.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
 
 async def get_admin_user(current_user: dict = Depends(get_current_user)) -> dict:
     if current_user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
     return current_user
 
+async def store_vehicle_images(images: List[str]) -> List[str]:
+    try:
+        return await store_images(db, images)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# ==================== PAGINATION ====================
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def encode_cursor(value, doc_id) -> str:
+    """Opaque keyset cursor holding the sort value and _id of the last item"""
+    payload = {"id": str(doc_id), "oid": isinstance(doc_id, ObjectId)}
+    if isinstance(value, datetime):
+        payload["t"] = value.isoformat()
+    else:
+        payload["v"] = value
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        value = datetime.fromisoformat(payload["t"]) if "t" in payload else payload["v"]
+        doc_id = ObjectId(payload["id"]) if payload["oid"] else payload["id"]
+    except (ValueError, KeyError, TypeError, binascii.Error, InvalidId):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return value, doc_id
+
+def parse_sort(sort: str, allowed_fields) -> tuple:
+    field = sort.lstrip("-")
+    if field not in allowed_fields:
+        raise HTTPException(status_code=400, detail=f"Invalid sort field: {field}")
+    return field, -1 if sort.startswith("-") else 1
+
+def page_query(query: dict, field: str, direction: int, cursor: Optional[str]) -> dict:
+    """Restrict query to the items after cursor in (field, _id) order"""
+    if not cursor:
+        return query
+    value, doc_id = decode_cursor(cursor)
+    op = "$gt" if direction == 1 else "$lt"
+    keyset = {"$or": [{field: {op: value}}, {field: value, "_id": {op: doc_id}}]}
+    return {"$and": [query, keyset]} if query else keyset
+
+def page_result(docs: list, field: str, limit: int) -> tuple:
+    """Trim the look-ahead item fetched past limit and build next_cursor from it"""
+    if len(docs) <= limit:
+        return docs, None
+    docs = docs[:limit]
+    return docs, encode_cursor(docs[-1].get(field), docs[-1]["_id"])
+
+async def find_page(
+    collection,
+    query: dict,
+    sort: str,
+    limit: int,
+    cursor: Optional[str],
+    projection: Optional[dict] = None,
+    sort_fields=("created_at",)
+) -> tuple:
+    field, direction = parse_sort(sort, sort_fields)
+    docs = await collection.find(
+        page_query(query, field, direction, cursor), projection
+    ).sort([(field, direction), ("_id", direction)]).limit(limit + 1).to_list(limit + 1)
+    return page_result(docs, field, limit)
+
+def build_vehicle_query(
+    type: Optional[str] = None,
+    category: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    transmission: Optional[str] = None,
+    fuel: Optional[str] = None
+) -> dict:
+    query = {}
+    
+    if type:
+        query["type"] = {"$in": [type, "both"]}
+    if category:
+        query["category"] = category
+    if transmission:
+        query["transmission"] = transmission
+    if fuel:
+        query["fuel"] = fuel
+    
+    # A vehicle's price is price_sale, or price_per_day when it has no sale price;
+    # vehicles without any price are never filtered out
+    price_range = {}
+    if min_price:
+        price_range["$gte"] = min_price
+    if max_price:
+        price_range["$lte"] = max_price
+    if price_range:
+        no_sale_price = {"price_sale": {"$in": [None, 0]}}
+        query["$or"] = [
+            {"price_sale": {"$gt": 0, **price_range}},
+            {**no_sale_price, "price_per_day": {"$gt": 0, **price_range}},
+            {**no_sale_price, "price_per_day": {"$in": [None, 0]}}
+        ]
+    
+    return query
+
+# ==================== REFERENCE POPULATION ====================
+
+# Only the fields list screens display
+VEHICLE_SUMMARY_PROJECTION = {
+    "name": 1,
+    "brand": 1,
+    "category": 1,
+    "type": 1,
+    "year": 1,
+    "transmission": 1,
+    "fuel": 1,
+    "price_sale": 1,
+    "price_per_day": 1,
+    "available": 1,
+    "images": {"$slice": 1}
+}
+USER_SUMMARY_PROJECTION = {"full_name": 1, "email": 1, "phone": 1}
+
+async def fetch_by_ids(collection, ids, projection: dict) -> Dict[str, dict]:
+    """Fetch documents for string ids in a single $in query, keyed by string id"""
+    object_ids = list({ObjectId(doc_id) for doc_id in ids if ObjectId.is_valid(doc_id)})
+    if not object_ids:
+        return {}
+    docs = await collection.find({"_id": {"$in": object_ids}}, projection).to_list(len(object_ids))
+    for doc in docs:
+        doc["_id"] = str(doc["_id"])
+    return {doc["_id"]: doc for doc in docs}
+
+async def populate_references(items: List[dict], include_user: bool = False) -> List[dict]:
+    """Attach vehicle (and user) summaries to reservations or purchases,
+    with one query per referenced collection whatever the number of items"""
+    vehicles = await fetch_by_ids(
+        db.vehicles, [item["vehicle_id"] for item in items], VEHICLE_SUMMARY_PROJECTION
+    )
+    users = {}
+    if include_user:
+        users = await fetch_by_ids(
+            db.users, [item["user_id"] for item in items], USER_SUMMARY_PROJECTION
+        )
+    
+    for item in items:
+        item["_id"] = str(item["_id"])
+        vehicle = vehicles.get(item["vehicle_id"])
+        if vehicle:
+            item["vehicle"] = vehicle
+        
+        user = users.get(item["user_id"])
+        if user:
+            item["user"] = {
+                "id": user["_id"],
+                "full_name": user["full_name"],
+                "email": user["email"],
+                "phone": user["phone"]
+            }
+    
+    return items
+
+# ==================== STATISTICS ====================
+
+# Dashboard counters live in the `stats` collection: one "global" document plus
+# "day:YYYY-MM-DD" and "month:YYYY-MM" rollups of revenue-generating reservations,
+# bucketed by reservation creation date. Writers apply $inc deltas as they go.
+STATS_GLOBAL_ID = "global"
+REVENUE_STATUSES = ("accepted", "completed")
+
+def stats_rollup_ids(at: datetime) -> List[str]:
+    return [f"day:{at:%Y-%m-%d}", f"month:{at:%Y-%m}"]
+
+async def bump_stats(
+    totals: Optional[dict] = None,
+    rollups: Optional[dict] = None,
+    rollups_at: Optional[datetime] = None
+):
+    """Atomically apply $inc deltas to the global stats and the rollups covering rollups_at"""
+    operations = []
+    if totals:
+        operations.append(UpdateOne({"_id": STATS_GLOBAL_ID}, {"$inc": totals}, upsert=True))
+    if rollups:
+        for rollup_id in stats_rollup_ids(rollups_at):
+            operations.append(UpdateOne({"_id": rollup_id}, {"$inc": rollups}, upsert=True))
+    if operations:
+        await db.stats.bulk_write(operations, ordered=False)
+
+async def bump_reservation_status_stats(reservation: dict, new_status: str):
+    """Stats deltas for a reservation moving from its stored status to new_status"""
+    old_status = reservation.get("status")
+    if old_status == new_status:
+        return
+    
+    totals = {}
+    if old_status == "pending":
+        totals["pending_reservations"] = -1
+    if new_status == "pending":
+        totals["pending_reservations"] = 1
+    
+    rollups = None
+    was_revenue = old_status in REVENUE_STATUSES
+    if was_revenue != (new_status in REVENUE_STATUSES):
+        sign = -1 if was_revenue else 1
+        price = reservation.get("total_price", 0)
+        totals["total_revenue"] = sign * price
+        rollups = {"reservations": sign, "revenue": sign * price}
+    
+    await bump_stats(totals, rollups, reservation.get("created_at") or datetime.utcnow())
+
+async def reconcile_stats() -> dict:
+    """Recompute all statistics documents from scratch with aggregations"""
+    vehicles = await db.vehicles.aggregate([
+        {"$group": {
+            "_id": None,
+            "total": {"$sum": 1},
+            "available": {"$sum": {"$cond": [{"$eq": ["$available", True]}, 1, 0]}}
+        }}
+    ]).to_list(1)
+    
+    def revenue_rollup(prefix: str, date_format: str) -> list:
+        return [
+            {"$group": {
+                "_id": {"$concat": [prefix, {"$dateToString": {"format": date_format, "date": "$created_at"}}]},
+                "reservations": {"$sum": 1},
+                "revenue": {"$sum": "$total_price"}
+            }}
+        ]
+    
+    reservations = await db.reservations.aggregate([
+        {"$facet": {
+            "totals": [{"$group": {
+                "_id": None,
+                "total": {"$sum": 1},
+                "pending": {"$sum": {"$cond": [{"$eq": ["$status", "pending"]}, 1, 0]}}
+            }}],
+            "rollups": [
+                {"$match": {"status": {"$in": list(REVENUE_STATUSES)}}},
+                {"$facet": {
+                    "days": revenue_rollup("day:", "%Y-%m-%d"),
+                    "months": revenue_rollup("month:", "%Y-%m")
+                }}
+            ]
+        }}
+    ]).to_list(1)
+    
+    vehicle_totals = vehicles[0] if vehicles else {}
+    reservation_totals = reservations[0]["totals"][0] if reservations[0]["totals"] else {}
+    rollup_facets = reservations[0]["rollups"][0] if reservations[0]["rollups"] else {}
+    rollups = rollup_facets.get("days", []) + rollup_facets.get("months", [])
+    
+    stats = {
+        "total_vehicles": vehicle_totals.get("total", 0),
+        "available_vehicles": vehicle_totals.get("available", 0),
+        "total_reservations": reservation_totals.get("total", 0),
+        "pending_reservations": reservation_totals.get("pending", 0),
+        "total_purchases": await db.purchases.count_documents({}),
+        "total_users": await db.users.count_documents({"role": "user"}),
+        "total_revenue": sum(r["revenue"] for r in rollup_facets.get("months", [])),
+        "reconciled_at": datetime.utcnow()
+    }
+    
+    operations = [ReplaceOne({"_id": STATS_GLOBAL_ID}, stats, upsert=True)]
+    operations += [ReplaceOne({"_id": r["_id"]}, r, upsert=True) for r in rollups]
+    await db.stats.bulk_write(operations, ordered=False)
+    await db.stats.delete_many({"_id": {"$nin": [STATS_GLOBAL_ID] + [r["_id"] for r in rollups]}})
+    
+    return stats
+
+# ==================== BOOKING LEDGER ====================
+
+# Bookings are recorded as one `reservation_slots` document per night (UTC date
+# from one midnight to the next) a vehicle is held, under a unique
+# (vehicle_id, day) index: taking a night that is already held fails at insert
+# time, so checking and booking are one operation costing one write per night,
+# as many as the days priced. The hand-over date is shared: a rental ending at
+# 10:00 and one starting at 14:00 hold different nights, and slots carry their
+# reservation's start and end so that overlapping hours on that date are caught
+# by a check made after inserting (two racing bookings both see each other's slots).
+HOLDING_STATUSES = ("pending", "accepted")
+DUPLICATE_KEY_ERROR = 11000
+
+def utc_naive(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def utc_midnight(value: datetime) -> datetime:
+    return utc_naive(value).replace(hour=0, minute=0, second=0, microsecond=0)
+
+def booking_days(start: datetime, end: datetime) -> List[datetime]:
+    """Nights of [start, end): the dates from start's up to, not including, end's"""
+    day = utc_midnight(start)
+    last = utc_midnight(end)
+    days = []
+    while day < last:
+        days.append(day)
+        day += timedelta(days=1)
+    return days
+
+def slot_conflicts(start: datetime, end: datetime) -> dict:
+    """Query for slots of other bookings overlapping [start, end)"""
+    start, end = utc_naive(start), utc_naive(end)
+    first_day, end_day = utc_midnight(start), utc_midnight(end)
+    return {"$or": [
+        {"day": {"$gte": first_day, "$lt": end_day}},
+        # Returned on the date this one starts, after it starts
+        {"day": first_day - timedelta(days=1), "end": {"$gt": start}},
+        # Picked up on the date this one ends, before it ends
+        {"day": end_day, "start": {"$lt": end}}
+    ]}
+
+def check_booking_length(start: datetime, end: datetime):
+    if (end - start).days > RESERVATION_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Reservations are limited to {RESERVATION_MAX_DAYS} days")
+
+async def booked_vehicle_ids(start: datetime, end: datetime) -> List[str]:
+    """Every vehicle booked during part of [start, end), from the booking ledger"""
+    check_booking_length(start, end)
+    return await db.reservation_slots.distinct("vehicle_id", slot_conflicts(start, end))
+
+async def release_slots(reservation_id: ObjectId, days: Optional[List[datetime]] = None):
+    """Give back the slots of reservation_id, or only those of days"""
+    query = {"reservation_id": reservation_id}
+    if days is not None:
+        query["day"] = {"$in": days}
+    await db.reservation_slots.delete_many(query)
+
+async def hold_slots(reservation_id: ObjectId, vehicle_id: str, start: datetime, end: datetime) -> bool:
+    """Take every night of the booking for reservation_id; False if another booking
+    holds one of them or overlaps the hand-over dates. Nights already held by
+    reservation_id itself (a concurrent call) count as taken for it."""
+    slots = [
+        {
+            "vehicle_id": vehicle_id,
+            "day": day,
+            "reservation_id": reservation_id,
+            "start": utc_naive(start),
+            "end": utc_naive(end)
+        }
+        for day in booking_days(start, end)
+    ]
+    inserted = [slot["day"] for slot in slots]
+    try:
+        await db.reservation_slots.insert_many(slots, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details["writeErrors"]
+        taken = [slots[error["index"]]["day"] for error in errors]
+        # Only give back what this call took: the rest may belong to a concurrent call
+        inserted = [day for day in inserted if day not in taken]
+        if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+            await release_slots(reservation_id, inserted)
+            raise
+        held = await db.reservation_slots.count_documents(
+            {"vehicle_id": vehicle_id, "day": {"$in": taken}, "reservation_id": reservation_id}
+        )
+        if held < len(taken):
+            await release_slots(reservation_id, inserted)
+            return False
+    
+    overlap = await db.reservation_slots.find_one(
+        {"vehicle_id": vehicle_id, "reservation_id": {"$ne": reservation_id}, **slot_conflicts(start, end)},
+        {"_id": 1}
+    )
+    if overlap is not None:
+        await release_slots(reservation_id, inserted)
+        return False
+    return True
+
+async def sync_booking_ledger():
+    """Record slots for current holding reservations that have none, e.g. made before the ledger existed"""
+    reservations = await db.reservations.find(
+        {"status": {"$in": list(HOLDING_STATUSES)}, "end_date": {"$gte": datetime.utcnow()}},
+        {"vehicle_id": 1, "start_date": 1, "end_date": 1}
+    ).to_list(None)
+    held = set(await db.reservation_slots.distinct(
+        "reservation_id", {"reservation_id": {"$in": [r["_id"] for r in reservations]}}
+    ))
+    for reservation in reservations:
+        if reservation["_id"] in held:
+            continue
+        if not await hold_slots(reservation["_id"], reservation["vehicle_id"], reservation["start_date"], reservation["end_date"]):
+            logger.warning(f"Reservation {reservation['_id']} overlaps another booking")
+
 # ==================== AUTH ROUTES ====================
 
 @api_router.post("/auth/register")
@@ -217,19 +817,24 @@ async def register(user_data: UserCreate):
         raise HTTPException(status_code=400, detail="Email already registered")
     
     # Hash password
-    hashed_password = bcrypt.hashpw(user_data.password.encode('utf-8'), bcrypt.gensalt())
+    hashed_password = await hash_password(user_data.password)
     
     # Create user
     user_dict = {
         "email": user_data.email,
-        "password": hashed_password.decode('utf-8'),
+        "password": hashed_password,
         "full_name": user_data.full_name,
         "phone": user_data.phone,
         "role": "user",
         "created_at": datetime.utcnow()
     }
     
-    result = await db.users.insert_one(user_dict)
+    try:
+        result = await db.users.insert_one(user_dict)
+    except DuplicateKeyError:
+        # Registered concurrently, caught by the unique email index
+        raise HTTPException(status_code=400, detail="Email already registered")
+    await bump_stats({"total_users": 1})
     
     # Create token
     token = create_access_token({"user_id": str(result.inserted_id)})
@@ -251,9 +856,20 @@ async def login(credentials: UserLogin):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     # Verify password
-    if not bcrypt.checkpw(credentials.password.encode('utf-8'), user["password"].encode('utf-8')):
+    if not await verify_password(credentials.password, user["password"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
+    # Upgrade the stored hash when the work factor setting changed
+    if password_needs_rehash(user["password"]):
+        try:
+            new_hash = await hash_password(credentials.password)
+        except HTTPException:
+            new_hash = None  # busy: the login still succeeds, rehash next time
+        if new_hash:
+            await db.users.update_one({"_id": user["_id"]}, {"$set": {"password": new_hash}})
+            invalidate_user(str(user["_id"]))
+            password_hash_counters["rehashed"] += 1
+    
     # Create token
     token = create_access_token({"user_id": str(user["_id"])})
     
@@ -280,38 +896,131 @@ async def get_vehicles(
     min_price: Optional[float] = None,
     max_price: Optional[float] = None,
     transmission: Optional[str] = None,
-    fuel: Optional[str] = None
+    fuel: Optional[str] = None,
+    sort: str = "-created_at",
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
 ):
-    query = {}
+    query = build_vehicle_query(type, category, min_price, max_price, transmission, fuel)
+    vehicles, next_cursor = await find_page(db.vehicles, query, sort, limit, cursor)
     
-    if type:
-        query["type"] = {"$in": [type, "both"]}
-    if category:
-        query["category"] = category
-    if transmission:
-        query["transmission"] = transmission
-    if fuel:
-        query["fuel"] = fuel
+    for vehicle in vehicles:
+        vehicle["_id"] = str(vehicle["_id"])
+    
+    return {"items": vehicles, "next_cursor": next_cursor}
+
+@api_router.get("/vehicles/available")
+async def get_available_vehicles(
+    start: datetime,
+    end: datetime,
+    type: Optional[str] = None,
+    category: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    transmission: Optional[str] = None,
+    fuel: Optional[str] = None,
+    sort: str = "-created_at",
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    """Vehicles that can be rented for the whole [start, end) interval, with their price"""
+    days = (end - start).days
+    if days <= 0:
+        raise HTTPException(status_code=400, detail="Invalid date range")
     
-    vehicles = await db.vehicles.find(query).to_list(1000)
-    
-    # Filter by price
-    if min_price is not None or max_price is not None:
-        filtered_vehicles = []
-        for vehicle in vehicles:
-            price = vehicle.get("price_sale") or vehicle.get("price_per_day")
-            if price:
-                if min_price and price < min_price:
-                    continue
-                if max_price and price > max_price:
-                    continue
-            filtered_vehicles.append(vehicle)
-        vehicles = filtered_vehicles
+    booked = await booked_vehicle_ids(start, end)
+    
+    query = build_vehicle_query(type or "location", category, min_price, max_price, transmission, fuel)
+    query["available"] = True
+    query["price_per_day"] = {"$gt": 0}
+    query["_id"] = {"$nin": [ObjectId(vehicle_id) for vehicle_id in booked if ObjectId.is_valid(vehicle_id)]}
+    
+    vehicles, next_cursor = await find_page(db.vehicles, query, sort, limit, cursor)
+    
+    for vehicle in vehicles:
+        vehicle["_id"] = str(vehicle["_id"])
+        vehicle["days"] = days
+        vehicle["total_price"] = vehicle["price_per_day"] * days
+    
+    return {"items": vehicles, "next_cursor": next_cursor}
+
+@api_router.get("/vehicles/categories")
+async def get_vehicle_categories():
+    """Number of vehicles in each category"""
+    counts = await db.vehicles.aggregate([
+        {"$group": {"_id": "$category", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1}}
+    ]).to_list(None)
+    return {"items": [{"category": doc["_id"], "count": doc["count"]} for doc in counts if doc["_id"]]}
+
+@api_router.get("/vehicles/sample")
+async def get_vehicle_sample(size: int = Query(6, ge=1, le=MAX_PAGE_SIZE)):
+    """size vehicles picked at random"""
+    vehicles = await db.vehicles.aggregate([{"$sample": {"size": size}}]).to_list(size)
     
     for vehicle in vehicles:
         vehicle["_id"] = str(vehicle["_id"])
     
-    return vehicles
+    return {"items": vehicles}
+
+@api_router.get("/vehicles/search")
+async def search_vehicles(
+    q: str = Query(min_length=1, max_length=200),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
+):
+    """Vehicles matching every word of q in their name, brand, description or
+    features, best first; accents are ignored, the words may be prefixes or
+    have one typo"""
+    ranked = search_index.search(q, limit)
+    vehicles = await fetch_by_ids(db.vehicles, [vehicle_id for vehicle_id, _ in ranked], None)
+    
+    items = []
+    for vehicle_id, score in ranked:
+        # Deleted by another worker since the index was loaded
+        if vehicle_id in vehicles:
+            items.append({**vehicles[vehicle_id], "score": round(score, 3)})
+    
+    return {"items": items}
+
+@api_router.get("/vehicles/nearest")
+async def get_nearest_vehicles(
+    lat: float = Query(ge=-90, le=90),
+    lng: float = Query(ge=-180, le=180),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    k: int = Query(10, ge=1, le=NEAREST_MAX_K),
+    radius: Optional[float] = Query(None, gt=0)
+):
+    """The k available vehicles closest to lat,lng (within radius meters), with their
+    distance in meters; with start and end, only vehicles that can be rented for
+    the whole [start, end) interval, with their price"""
+    days = None
+    booked = set()
+    if start or end:
+        if not (start and end) or (end - start).days <= 0:
+            raise HTTPException(status_code=400, detail="Invalid date range")
+        days = (end - start).days
+        booked = set(await booked_vehicle_ids(start, end))
+    
+    def rentable(vehicle_id: str) -> bool:
+        entry = fleet[vehicle_id]
+        return (
+            vehicle_id not in booked
+            and entry["type"] in ("location", "both")
+            and (entry.get("price_per_day") or 0) > 0
+        )
+    
+    nearest = fleet_grid.nearest(lat, lng, k, rentable if days else None, radius)
+    
+    vehicles = []
+    for distance, vehicle_id in nearest:
+        vehicle = {**fleet[vehicle_id], "distance": round(distance, 1)}
+        if days:
+            vehicle["days"] = days
+            vehicle["total_price"] = vehicle["price_per_day"] * days
+        vehicles.append(vehicle)
+    
+    return {"items": vehicles}
 
 @api_router.get("/vehicles/{vehicle_id}")
 async def get_vehicle(vehicle_id: str):
@@ -328,10 +1037,13 @@ async def get_vehicle(vehicle_id: str):
 @api_router.post("/vehicles", dependencies=[Depends(get_admin_user)])
 async def create_vehicle(vehicle_data: VehicleCreate):
     vehicle_dict = vehicle_data.model_dump()
+    vehicle_dict["images"] = await store_vehicle_images(vehicle_dict["images"])
     vehicle_dict["created_at"] = datetime.utcnow()
     
     result = await db.vehicles.insert_one(vehicle_dict)
     vehicle_dict["_id"] = str(result.inserted_id)
+    await bump_stats({"total_vehicles": 1, "available_vehicles": int(vehicle_dict["available"])})
+    on_vehicle_changed(vehicle_dict["_id"], vehicle_dict)
     
     return vehicle_dict
 
@@ -341,15 +1053,23 @@ async def update_vehicle(vehicle_id: str, vehicle_data: VehicleCreate):
         raise HTTPException(status_code=400, detail="Invalid vehicle ID")
     
     vehicle_dict = vehicle_data.model_dump()
+    vehicle_dict["images"] = await store_vehicle_images(vehicle_dict["images"])
     
-    result = await db.vehicles.update_one(
+    previous = await db.vehicles.find_one_and_update(
         {"_id": ObjectId(vehicle_id)},
-        {"$set": vehicle_dict}
+        {"$set": vehicle_dict},
+        projection={"available": 1, "current_location": 1}
     )
     
-    if result.matched_count == 0:
+    if previous is None:
         raise HTTPException(status_code=404, detail="Vehicle not found")
     
+    available_delta = int(vehicle_dict["available"]) - int(previous.get("available", False))
+    if available_delta:
+        await bump_stats({"available_vehicles": available_delta})
+    
+    on_vehicle_changed(vehicle_id, {**previous, **vehicle_dict, "_id": vehicle_id})
+    
     return {"message": "Vehicle updated successfully"}
 
 @api_router.delete("/vehicles/{vehicle_id}", dependencies=[Depends(get_admin_user)])
@@ -357,103 +1077,218 @@ async def delete_vehicle(vehicle_id: str):
     if not ObjectId.is_valid(vehicle_id):
         raise HTTPException(status_code=400, detail="Invalid vehicle ID")
     
-    result = await db.vehicles.delete_one({"_id": ObjectId(vehicle_id)})
+    deleted = await db.vehicles.find_one_and_delete(
+        {"_id": ObjectId(vehicle_id)},
+        projection={"available": 1}
+    )
     
-    if result.deleted_count == 0:
+    if deleted is None:
         raise HTTPException(status_code=404, detail="Vehicle not found")
     
+    await bump_stats({
+        "total_vehicles": -1,
+        "available_vehicles": -int(deleted.get("available", False))
+    })
+    on_vehicle_changed(vehicle_id, None)
+    
     return {"message": "Vehicle deleted successfully"}
 
+# ==================== IMAGE ROUTES ====================
+
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+@api_router.get("/images/{image_hash}")
+async def get_image(image_hash: str, if_none_match: Optional[str] = Header(default=None)):
+    """Stream a stored image; content-addressed so it never changes"""
+    if not IMAGE_HASH_RE.match(image_hash):
+        raise HTTPException(status_code=400, detail="Invalid image ID")
+    
+    etag = f'"{image_hash}"'
+    headers = {"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL}
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        if etag in tags or f"W/{etag}" in tags or "*" in tags:
+            return Response(status_code=304, headers=headers)
+    
+    grid_out = await open_image(db, image_hash)
+    if grid_out is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    headers["Content-Length"] = str(grid_out.length)
+    media_type = (grid_out.metadata or {}).get("content_type", "application/octet-stream")
+    return StreamingResponse(iter_grid_out(grid_out), media_type=media_type, headers=headers)
+
+# ==================== DOCUMENT ROUTES ====================
+
+@api_router.get("/documents/{document_id}")
+async def get_document(document_id: str, current_user: dict = Depends(get_current_user)):
+    """Stream a reservation document to the user who uploaded it or to an admin"""
+    grid_out = await open_document(db, document_id)
+    if grid_out is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+    
+    metadata = grid_out.metadata or {}
+    if current_user.get("role") != "admin" and metadata.get("owner_id") != current_user["_id"]:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    headers = {
+        "Content-Length": str(grid_out.length),
+        "Cache-Control": "private, no-store",
+        "Content-Disposition": "attachment",
+        "X-Content-Type-Options": "nosniff"
+    }
+    # Documents stored before the allow-list keep the client's content type
+    media_type = metadata.get("content_type")
+    if media_type not in DOCUMENT_CONTENT_TYPES:
+        media_type = "application/octet-stream"
+    return StreamingResponse(iter_grid_out(grid_out), media_type=media_type, headers=headers)
+
 # ==================== RESERVATION ROUTES ====================
 
-@api_router.post("/reservations")
-async def create_reservation(
-    reservation_data: ReservationCreate,
-    current_user: dict = Depends(get_current_user)
-):
+async def price_reservation(vehicle_id: str, start_date: datetime, end_date: datetime) -> float:
     # Check if vehicle exists
-    vehicle = await db.vehicles.find_one({"_id": ObjectId(reservation_data.vehicle_id)})
+    vehicle = await db.vehicles.find_one({"_id": ObjectId(vehicle_id)}, {"price_per_day": 1})
     if not vehicle:
         raise HTTPException(status_code=404, detail="Vehicle not found")
     
-    # Check availability
-    conflicting_reservations = await db.reservations.find_one({
-        "vehicle_id": reservation_data.vehicle_id,
-        "status": {"$in": ["pending", "accepted"]},
-        "$or": [
-            {
-                "start_date": {"$lte": reservation_data.end_date},
-                "end_date": {"$gte": reservation_data.start_date}
-            }
-        ]
-    })
-    
-    if conflicting_reservations:
-        raise HTTPException(status_code=400, detail="Vehicle not available for selected dates")
-    
     # Calculate total price
-    days = (reservation_data.end_date - reservation_data.start_date).days
+    days = (end_date - start_date).days
     if days <= 0:
         raise HTTPException(status_code=400, detail="Invalid date range")
+    check_booking_length(start_date, end_date)
     
-    total_price = vehicle.get("price_per_day", 0) * days
+    return vehicle.get("price_per_day", 0) * days
+
+async def insert_reservation(
+    user_id: str,
+    vehicle_id: str,
+    start_date: datetime,
+    end_date: datetime,
+    total_price: float,
+    driver_license_id: str,
+    id_document_id: str
+) -> dict:
+    # Check availability and book the dates in one step
+    reservation_id = ObjectId()
+    if not await hold_slots(reservation_id, vehicle_id, start_date, end_date):
+        raise HTTPException(status_code=400, detail="Vehicle not available for selected dates")
     
     # Create reservation
     reservation_dict = {
-        "user_id": current_user["_id"],
-        "vehicle_id": reservation_data.vehicle_id,
-        "start_date": reservation_data.start_date,
-        "end_date": reservation_data.end_date,
-        "driver_license": reservation_data.driver_license,
-        "id_document": reservation_data.id_document,
+        "_id": reservation_id,
+        "user_id": user_id,
+        "vehicle_id": vehicle_id,
+        "start_date": start_date,
+        "end_date": end_date,
+        "driver_license": driver_license_id,
+        "id_document": id_document_id,
         "status": "pending",
         "total_price": total_price,
         "created_at": datetime.utcnow()
     }
     
-    result = await db.reservations.insert_one(reservation_dict)
-    reservation_dict["_id"] = str(result.inserted_id)
+    try:
+        await db.reservations.insert_one(reservation_dict)
+    except Exception:
+        await release_slots(reservation_id)
+        raise
+    reservation_dict["_id"] = str(reservation_id)
+    await bump_stats({"total_reservations": 1, "pending_reservations": 1})
     
     return reservation_dict
 
+async def discard_documents(document_ids: List[str]):
+    for document_id in document_ids:
+        await delete_document(db, document_id)
+
+@api_router.post("/reservations")
+async def create_reservation(
+    reservation_data: ReservationCreate,
+    current_user: dict = Depends(get_current_user)
+):
+    """Create a reservation with documents sent inline as base64 (prefer /reservations/upload)"""
+    total_price = await price_reservation(
+        reservation_data.vehicle_id, reservation_data.start_date, reservation_data.end_date
+    )
+    
+    document_ids = []
+    try:
+        for value in (reservation_data.driver_license, reservation_data.id_document):
+            try:
+                content_type, data = decode_base64_document(value)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            if len(data) > DOCUMENT_MAX_BYTES:
+                raise HTTPException(status_code=413, detail="Document too large")
+            document_ids.append(await store_document_bytes(db, data, content_type, current_user["_id"]))
+        
+        return await insert_reservation(
+            current_user["_id"],
+            reservation_data.vehicle_id,
+            reservation_data.start_date,
+            reservation_data.end_date,
+            total_price,
+            *document_ids
+        )
+    except BaseException:
+        await discard_documents(document_ids)
+        raise
+
+@api_router.post("/reservations/upload")
+async def create_reservation_with_uploads(
+    vehicle_id: str = Form(...),
+    start_date: datetime = Form(...),
+    end_date: datetime = Form(...),
+    driver_license: UploadFile = File(...),
+    id_document: UploadFile = File(...),
+    current_user: dict = Depends(get_current_user)
+):
+    """Create a reservation with its documents sent as multipart file uploads"""
+    total_price = await price_reservation(vehicle_id, start_date, end_date)
+    
+    document_ids = []
+    try:
+        for upload in (driver_license, id_document):
+            if (upload.content_type or "").lower() not in DOCUMENT_CONTENT_TYPES:
+                raise HTTPException(status_code=415, detail="Documents must be images or PDF files")
+            try:
+                document_ids.append(await store_upload(db, upload, current_user["_id"], DOCUMENT_MAX_BYTES))
+            except ValueError:
+                raise HTTPException(status_code=413, detail="Document too large")
+        
+        return await insert_reservation(
+            current_user["_id"], vehicle_id, start_date, end_date, total_price, *document_ids
+        )
+    except BaseException:
+        await discard_documents(document_ids)
+        raise
+
 @api_router.get("/reservations/my")
-async def get_my_reservations(current_user: dict = Depends(get_current_user)):
-    reservations = await db.reservations.find({"user_id": current_user["_id"]}).to_list(1000)
+async def get_my_reservations(
+    sort: str = "-created_at",
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    reservations, next_cursor = await find_page(
+        db.reservations, {"user_id": current_user["_id"]}, sort, limit, cursor
+    )
     
-    # Populate vehicle data
-    for reservation in reservations:
-        reservation["_id"] = str(reservation["_id"])
-        vehicle = await db.vehicles.find_one({"_id": ObjectId(reservation["vehicle_id"])})
-        if vehicle:
-            vehicle["_id"] = str(vehicle["_id"])
-            reservation["vehicle"] = vehicle
+    await populate_references(reservations)
     
-    return reservations
+    return {"items": reservations, "next_cursor": next_cursor}
 
 @api_router.get("/reservations", dependencies=[Depends(get_admin_user)])
-async def get_all_reservations():
-    reservations = await db.reservations.find().to_list(1000)
+async def get_all_reservations(
+    sort: str = "-created_at",
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    reservations, next_cursor = await find_page(db.reservations, {}, sort, limit, cursor)
     
-    # Populate vehicle and user data
-    for reservation in reservations:
-        reservation["_id"] = str(reservation["_id"])
-        vehicle = await db.vehicles.find_one({"_id": ObjectId(reservation["vehicle_id"])})
-        user = await db.users.find_one({"_id": ObjectId(reservation["user_id"])})
-        
-        if vehicle:
-            vehicle["_id"] = str(vehicle["_id"])
-            reservation["vehicle"] = vehicle
-        
-        if user:
-            user["_id"] = str(user["_id"])
-            reservation["user"] = {
-                "id": user["_id"],
-                "full_name": user["full_name"],
-                "email": user["email"],
-                "phone": user["phone"]
-            }
+    await populate_references(reservations, include_user=True)
     
-    return reservations
+    return {"items": reservations, "next_cursor": next_cursor}
 
 @api_router.patch("/reservations/{reservation_id}/status", dependencies=[Depends(get_admin_user)])
 async def update_reservation_status(reservation_id: str, status: str):
@@ -463,16 +1298,59 @@ async def update_reservation_status(reservation_id: str, status: str):
     if status not in ["pending", "accepted", "rejected", "completed"]:
         raise HTTPException(status_code=400, detail="Invalid status")
     
-    result = await db.reservations.update_one(
-        {"_id": ObjectId(reservation_id)},
-        {"$set": {"status": status}}
+    reservation = await db.reservations.find_one({"_id": ObjectId(reservation_id)})
+    if reservation is None:
+        raise HTTPException(status_code=404, detail="Reservation not found")
+    
+    # Hold the dates again when a released reservation is reinstated
+    was_holding = reservation["status"] in HOLDING_STATUSES
+    holds = status in HOLDING_STATUSES
+    if holds and not was_holding:
+        if not await hold_slots(
+            reservation["_id"],
+            reservation["vehicle_id"],
+            reservation["start_date"],
+            reservation["end_date"]
+        ):
+            raise HTTPException(status_code=400, detail="Vehicle not available for selected dates")
+    
+    previous = await db.reservations.find_one_and_update(
+        {"_id": reservation["_id"], "status": reservation["status"]},
+        {"$set": {"status": status}},
+        projection={"status": 1, "total_price": 1, "created_at": 1}
     )
     
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Reservation not found")
+    if previous is None:
+        # The slots belong to the reservation, not to this call: keep them if a
+        # concurrent change made it hold
+        current = await db.reservations.find_one({"_id": reservation["_id"]}, {"status": 1})
+        if holds and not was_holding and (current is None or current["status"] not in HOLDING_STATUSES):
+            await release_slots(reservation["_id"])
+        raise HTTPException(status_code=409, detail="Reservation changed concurrently, please retry")
+    
+    if was_holding and not holds:
+        await release_slots(reservation["_id"])
+    
+    await bump_reservation_status_stats(previous, status)
+    await load_rental_windows()
     
     return {"message": "Reservation status updated"}
 
+@api_router.get("/reservations/{reservation_id}/trip")
+async def get_reservation_trip(reservation_id: str, current_user: dict = Depends(get_current_user)):
+    """Distance, duration and top speed driven during a reservation, from GPS"""
+    if not ObjectId.is_valid(reservation_id):
+        raise HTTPException(status_code=400, detail="Invalid reservation ID")
+    
+    reservation = await db.reservations.find_one({"_id": ObjectId(reservation_id)}, {"user_id": 1})
+    if reservation is None:
+        raise HTTPException(status_code=404, detail="Reservation not found")
+    if current_user.get("role") != "admin" and reservation["user_id"] != current_user["_id"]:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    trip = await db.reservation_trips.find_one({"_id": reservation["_id"]})
+    return {"reservation_id": reservation_id, **trip_summary(trip)}
+
 # ==================== PURCHASE ROUTES ====================
 
 @api_router.post("/purchases")
@@ -496,193 +1374,865 @@ async def create_purchase(
     
     result = await db.purchases.insert_one(purchase_dict)
     purchase_dict["_id"] = str(result.inserted_id)
+    await bump_stats({"total_purchases": 1})
     
     return purchase_dict
 
 @api_router.get("/purchases/my")
-async def get_my_purchases(current_user: dict = Depends(get_current_user)):
-    purchases = await db.purchases.find({"user_id": current_user["_id"]}).to_list(1000)
+async def get_my_purchases(
+    sort: str = "-created_at",
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    purchases, next_cursor = await find_page(
+        db.purchases, {"user_id": current_user["_id"]}, sort, limit, cursor
+    )
     
-    # Populate vehicle data
-    for purchase in purchases:
-        purchase["_id"] = str(purchase["_id"])
-        vehicle = await db.vehicles.find_one({"_id": ObjectId(purchase["vehicle_id"])})
-        if vehicle:
-            vehicle["_id"] = str(vehicle["_id"])
-            purchase["vehicle"] = vehicle
+    await populate_references(purchases)
     
-    return purchases
+    return {"items": purchases, "next_cursor": next_cursor}
 
 @api_router.get("/purchases", dependencies=[Depends(get_admin_user)])
-async def get_all_purchases():
-    purchases = await db.purchases.find().to_list(1000)
-    
-    # Populate vehicle and user data
-    for purchase in purchases:
-        purchase["_id"] = str(purchase["_id"])
-        vehicle = await db.vehicles.find_one({"_id": ObjectId(purchase["vehicle_id"])})
-        user = await db.users.find_one({"_id": ObjectId(purchase["user_id"])})
-        
-        if vehicle:
-            vehicle["_id"] = str(vehicle["_id"])
-            purchase["vehicle"] = vehicle
-        
-        if user:
-            user["_id"] = str(user["_id"])
-            purchase["user"] = {
-                "id": user["_id"],
-                "full_name": user["full_name"],
-                "email": user["email"],
-                "phone": user["phone"]
-            }
+async def get_all_purchases(
+    sort: str = "-created_at",
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    purchases, next_cursor = await find_page(db.purchases, {}, sort, limit, cursor)
+    
+    await populate_references(purchases, include_user=True)
     
-    return purchases
+    return {"items": purchases, "next_cursor": next_cursor}
 
 # ==================== ADMIN ROUTES ====================
 
+def user_activity_pipeline(field: str, direction: int, cursor: Optional[str], limit: int) -> list:
+    """Clients merged with their reservation and purchase counts in one pass:
+    users, reservations and purchases are unioned into one stream and grouped by user_id"""
+    return [
+        {"$match": {"role": "user"}},
+        {"$project": {
+            "_id": 0,
+            "user_id": {"$toString": "$_id"},
+            "email": 1,
+            "full_name": 1,
+            "phone": 1,
+            "created_at": 1,
+            "is_user": {"$literal": True}
+        }},
+        {"$unionWith": {"coll": "reservations", "pipeline": [
+            {"$project": {"_id": 0, "user_id": 1, "reservations": {"$literal": 1}}}
+        ]}},
+        {"$unionWith": {"coll": "purchases", "pipeline": [
+            {"$project": {"_id": 0, "user_id": 1, "purchases": {"$literal": 1}}}
+        ]}},
+        {"$group": {
+            "_id": "$user_id",
+            "is_user": {"$max": "$is_user"},
+            "email": {"$max": "$email"},
+            "full_name": {"$max": "$full_name"},
+            "phone": {"$max": "$phone"},
+            "created_at": {"$max": "$created_at"},
+            "reservations_count": {"$sum": "$reservations"},
+            "purchases_count": {"$sum": "$purchases"}
+        }},
+        {"$match": {"is_user": True}},
+        {"$addFields": {"activity": {"$add": ["$reservations_count", "$purchases_count"]}}},
+        {"$match": page_query({}, field, direction, cursor)},
+        {"$sort": {field: direction, "_id": direction}},
+        {"$limit": limit + 1}
+    ]
+
 @api_router.get("/admin/users", dependencies=[Depends(get_admin_user)])
-async def get_all_users():
-    """Get all users (clients) with their activity"""
-    users = await db.users.find({"role": "user"}).to_list(1000)
-    
-    user_list = []
-    for user in users:
-        user_id = str(user["_id"])
-        
-        # Count reservations and purchases for each user
-        reservations_count = await db.reservations.count_documents({"user_id": user_id})
-        purchases_count = await db.purchases.count_documents({"user_id": user_id})
-        
-        user_list.append({
-            "id": user_id,
+async def get_all_users(
+    sort: str = "-created_at",
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    """Get all users (clients) with their activity, sortable by created_at or activity"""
+    field, direction = parse_sort(sort, ("created_at", "activity"))
+    users = await db.users.aggregate(
+        user_activity_pipeline(field, direction, cursor, limit)
+    ).to_list(limit + 1)
+    users, next_cursor = page_result(users, field, limit)
+    
+    user_list = [
+        {
+            "id": user["_id"],
             "email": user["email"],
             "full_name": user["full_name"],
             "phone": user["phone"],
             "created_at": user["created_at"],
-            "reservations_count": reservations_count,
-            "purchases_count": purchases_count
-        })
+            "reservations_count": user["reservations_count"],
+            "purchases_count": user["purchases_count"],
+            "activity": user["activity"]
+        }
+        for user in users
+    ]
     
-    return user_list
+    return {"items": user_list, "next_cursor": next_cursor}
 
 @api_router.get("/admin/stats", dependencies=[Depends(get_admin_user)])
 async def get_admin_stats():
-    # Count documents
-    total_vehicles = await db.vehicles.count_documents({})
-    available_vehicles = await db.vehicles.count_documents({"available": True})
-    total_reservations = await db.reservations.count_documents({})
-    pending_reservations = await db.reservations.count_documents({"status": "pending"})
-    total_purchases = await db.purchases.count_documents({})
-    total_users = await db.users.count_documents({"role": "user"})
-    
-    # Calculate total revenue
-    reservations = await db.reservations.find({"status": {"$in": ["accepted", "completed"]}}).to_list(1000)
-    total_revenue = sum([r.get("total_price", 0) for r in reservations])
-    
-    # Calculate monthly stats (current month)
-    current_month_start = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    monthly_reservations = await db.reservations.count_documents({
-        "created_at": {"$gte": current_month_start},
-        "status": {"$in": ["accepted", "completed"]}
-    })
+    month_id = stats_rollup_ids(datetime.utcnow())[1]
+    docs = await db.stats.find({"_id": {"$in": [STATS_GLOBAL_ID, month_id]}}).to_list(2)
+    stats = {doc["_id"]: doc for doc in docs}
     
-    monthly_reservations_list = await db.reservations.find({
-        "created_at": {"$gte": current_month_start},
-        "status": {"$in": ["accepted", "completed"]}
-    }).to_list(1000)
-    monthly_revenue = sum([r.get("total_price", 0) for r in monthly_reservations_list])
+    if STATS_GLOBAL_ID not in stats:
+        stats[STATS_GLOBAL_ID] = await reconcile_stats()
+    
+    totals = stats[STATS_GLOBAL_ID]
+    month = stats.get(month_id, {})
     
     return {
-        "total_vehicles": total_vehicles,
-        "available_vehicles": available_vehicles,
-        "total_reservations": total_reservations,
-        "pending_reservations": pending_reservations,
-        "total_purchases": total_purchases,
-        "total_users": total_users,
-        "total_revenue": total_revenue,
-        "monthly_reservations": monthly_reservations,
-        "monthly_revenue": monthly_revenue
+        "total_vehicles": totals.get("total_vehicles", 0),
+        "available_vehicles": totals.get("available_vehicles", 0),
+        "total_reservations": totals.get("total_reservations", 0),
+        "pending_reservations": totals.get("pending_reservations", 0),
+        "total_purchases": totals.get("total_purchases", 0),
+        "total_users": totals.get("total_users", 0),
+        "total_revenue": totals.get("total_revenue", 0),
+        "monthly_reservations": month.get("reservations", 0),
+        "monthly_revenue": month.get("revenue", 0)
+    }
+
+@api_router.post("/admin/stats/reconcile", dependencies=[Depends(get_admin_user)])
+async def reconcile_admin_stats():
+    """Recompute dashboard statistics from the source collections"""
+    await reconcile_stats()
+    return await get_admin_stats()
+
+@api_router.get("/admin/metrics", dependencies=[Depends(get_admin_user)])
+async def get_admin_metrics():
+    """In-process cache and buffer counters of this API worker"""
+    return {
+        "user_cache": cache_metrics(user_cache_counters, user_cache),
+        "password_hashing": {
+            **password_hash_counters,
+            "concurrency": PASSWORD_HASH_CONCURRENCY,
+            "max_queue": PASSWORD_HASH_MAX_QUEUE
+        },
+        "gps_buffer": location_buffer.metrics(),
+        "odometer": odometer.metrics(),
+        "geofences": {**geofence_monitor.metrics(), "pending_events": len(pending_geofence_events)},
+        "llm": chat_model.metrics(),
+        "search_index": search_index.metrics(),
+        "chat_cache": {
+            **cache_metrics(response_cache.counters, response_cache.cache),
+            "similarity_threshold": response_cache.similarity_threshold
+        }
     }
 
 # ==================== CHAT AI ROUTES ====================
 
+chat_model = GuardedChatModel(
+    create_chat_model(LLM_PROVIDER, EMERGENT_LLM_KEY, LLM_MODEL, LOCAL_LLM_TOKEN_DELAY_SECONDS, LOCAL_LLM_FAILURE_RATE),
+    LLM_TIMEOUT_SECONDS,
+    LLM_MAX_CONCURRENCY,
+    CircuitBreaker(LLM_BREAKER_FAILURE_RATIO, LLM_BREAKER_COOLDOWN_SECONDS)
+)
+CHAT_FALLBACK_REPLY = "Notre assistant est momentanément indisponible. Vous pouvez consulter nos véhicules dans le catalogue ou réessayer dans quelques instants."
+CHAT_SYSTEM_MESSAGE = "Tu es un assistant virtuel pour une agence de location et vente de voitures. Tu aides les clients à trouver des véhicules, répondre à leurs questions sur les locations, les achats, les prix, et les conditions. Sois poli, professionnel et informatif. Réponds toujours en français."
+
+response_cache = ResponseCache(CHAT_CACHE_MAX_SIZE, CHAT_CACHE_TTL_SECONDS, CHAT_CACHE_SIMILARITY)
+# Compact description of every vehicle, maintained by on_vehicle_changed
+catalogue = CatalogueDigest()
+search_index = SearchIndex()
+
+# Vehicle changes made while an in-memory view is rebuilt, by view name
+rebuild_changes: Dict[str, Dict[str, Optional[dict]]] = {}
+
+def build_view(factory, vehicles: List[dict]):
+    view = factory()
+    view.replace_all(vehicles)
+    return view
+
+async def rebuild_view(name: str, factory, projection: dict):
+    """A fresh view of every vehicle, built in a worker thread so the event loop
+    keeps serving; changes made meanwhile are replayed on it before it is returned"""
+    changes = rebuild_changes[name] = {}
+    try:
+        vehicles = await db.vehicles.find({}, projection).to_list(None)
+        view = await asyncio.get_running_loop().run_in_executor(None, build_view, factory, vehicles)
+    finally:
+        del rebuild_changes[name]
+    for vehicle_id, vehicle in changes.items():
+        if vehicle is None:
+            view.remove(vehicle_id)
+        else:
+            view.put(vehicle_id, vehicle)
+    return view
+
+async def load_search_index():
+    global search_index
+    search_index = await rebuild_view("search_index", SearchIndex, SEARCH_PROJECTION)
+
+async def load_catalogue():
+    global catalogue
+    previous = catalogue
+    catalogue = await rebuild_view("catalogue", CatalogueDigest, CATALOGUE_PROJECTION)
+    # Vehicles changed by other workers: cached chat replies may describe them as they were
+    if (catalogue.lines, catalogue.vehicles) != (previous.lines, previous.vehicles):
+        response_cache.clear()
+
+def is_context_free(session: dict) -> bool:
+    """Only a session's first question can share a cached reply"""
+    return not session.get("turns") and not session.get("summary")
+
+async def store_chat_message(session_id: str, message: str, response: str):
+    await db.chat_messages.insert_one({
+        "session_id": session_id,
+        "user_message": message,
+        "bot_response": response,
+        "created_at": datetime.utcnow()
+    })
+
+def chat_system_message(session: dict, vehicle_ids: List[str]) -> str:
+    grounded = f"{CHAT_SYSTEM_MESSAGE}\n\n{catalogue.prompt_section(vehicle_ids)}"
+    return build_system_message(grounded, session, CHAT_CONTEXT_TOKEN_BUDGET)
+
+async def remember_exchange(session: dict, message: str, response: str) -> List[dict]:
+    """Store the exchange in the history and the session window; returns the turns
+    that left the window, to be summarized"""
+    await store_chat_message(session["_id"], message, response)
+    return await record_turn(db, session, message, response, CHAT_CONTEXT_TURNS)
+
+async def summarize_turns(session: dict, evicted: List[dict]):
+    await fold_into_summary(db, chat_model, session, evicted, CHAT_SUMMARY_MAX_TOKENS)
+
+def sse_event(payload: dict) -> str:
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def chat_busy() -> HTTPException:
+    return HTTPException(status_code=503, detail="Assistant busy, please retry", headers={"Retry-After": "1"})
+
 @api_router.post("/chat", response_model=ChatResponse)
-async def chat(chat_data: ChatMessage):
+async def chat(chat_data: ChatMessage, tasks: BackgroundTasks):
+    # Create session ID if not provided
+    session_id = chat_data.session_id or str(uuid.uuid4())
     try:
-        # Create session ID if not provided
-        session_id = chat_data.session_id or str(uuid.uuid4())
-        
-        # Initialize LLM Chat
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=session_id,
-            system_message="Tu es un assistant virtuel pour une agence de location et vente de voitures. Tu aides les clients à trouver des véhicules, répondre à leurs questions sur les locations, les achats, les prix, et les conditions. Sois poli, professionnel et informatif. Réponds toujours en français."
-        ).with_model("openai", "gpt-4o-mini")
+        session = await load_session(db, session_id)
+        context_free = is_context_free(session)
+        vehicle_ids = catalogue.relevant(chat_data.message, CHAT_CATALOGUE_TOP_K)
         
-        # Send message
-        user_message = UserMessage(text=chat_data.message)
-        response = await chat.send_message(user_message)
+        response = response_cache.get(chat_data.message, vehicle_ids) if context_free else None
+        if response is None:
+            response = await chat_model.complete(session_id, chat_system_message(session, vehicle_ids), chat_data.message)
+            if context_free:
+                response_cache.put(chat_data.message, response, vehicle_ids)
         
         # Store chat history in database
-        await db.chat_messages.insert_one({
-            "session_id": session_id,
-            "user_message": chat_data.message,
-            "bot_response": response,
-            "created_at": datetime.utcnow()
-        })
+        evicted = await remember_exchange(session, chat_data.message, response)
+        if evicted:
+            tasks.add_task(summarize_turns, session, evicted)
         
         return ChatResponse(response=response, session_id=session_id)
     
-    except Exception as e:
-        logger.error(f"Chat error: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Chat error: {str(e)}")
+    except ChatModelSaturated:
+        raise chat_busy()
+    except ChatModelUnavailable as e:
+        # Kept out of the cache and of the conversation context
+        logger.warning(f"Chat model unavailable: {e}")
+        await store_chat_message(session_id, chat_data.message, CHAT_FALLBACK_REPLY)
+        return ChatResponse(response=CHAT_FALLBACK_REPLY, session_id=session_id)
+    except Exception:
+        logger.exception("Chat error")
+        raise HTTPException(status_code=500, detail="Chat error")
+
+@api_router.post("/chat/stream")
+async def chat_stream(chat_data: ChatMessage):
+    """Server-sent events variant of /chat.
+    
+    Events are JSON: {"type": "session"} first, then {"type": "token", "text"}
+    chunks as the reply is generated, and finally {"type": "done"} or
+    {"type": "error"}. The exchange is stored once the stream is closed.
+    """
+    session_id = chat_data.session_id or str(uuid.uuid4())
+    session = await load_session(db, session_id)
+    context_free = is_context_free(session)
+    vehicle_ids = catalogue.relevant(chat_data.message, CHAT_CATALOGUE_TOP_K)
+    cached = response_cache.get(chat_data.message, vehicle_ids) if context_free else None
+    if cached is None and chat_model.saturated():
+        raise chat_busy()
+    reply: List[str] = []
+    fallback = False
+    
+    async def events():
+        nonlocal fallback
+        yield sse_event({"type": "session", "session_id": session_id})
+        if cached is not None:
+            reply.append(cached)
+            yield sse_event({"type": "token", "text": cached})
+            yield sse_event({"type": "done", "session_id": session_id})
+            return
+        try:
+            async for chunk in chat_model.stream(session_id, chat_system_message(session, vehicle_ids), chat_data.message):
+                reply.append(chunk)
+                yield sse_event({"type": "token", "text": chunk})
+        except ChatModelSaturated:
+            yield sse_event({"type": "error", "detail": "Assistant busy, please retry"})
+            return
+        except ChatModelUnavailable as e:
+            logger.warning(f"Chat model unavailable: {e}")
+            if reply:
+                yield sse_event({"type": "error", "detail": "Chat error"})
+                return
+            fallback = True
+            reply.append(CHAT_FALLBACK_REPLY)
+            yield sse_event({"type": "token", "text": CHAT_FALLBACK_REPLY})
+            yield sse_event({"type": "done", "session_id": session_id, "fallback": True})
+            return
+        except Exception:
+            logger.exception("Chat stream error")
+            yield sse_event({"type": "error", "detail": "Chat error"})
+            return
+        if context_free:
+            response_cache.put(chat_data.message, "".join(reply), vehicle_ids)
+        yield sse_event({"type": "done", "session_id": session_id})
+    
+    async def store_reply():
+        # Also runs when the client disconnects, keeping what was sent so far
+        if fallback:
+            await store_chat_message(session_id, chat_data.message, CHAT_FALLBACK_REPLY)
+        elif reply:
+            evicted = await remember_exchange(session, chat_data.message, "".join(reply))
+            if evicted:
+                await summarize_turns(session, evicted)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(store_reply)
+    )
 
 @api_router.get("/chat/history/{session_id}")
-async def get_chat_history(session_id: str):
-    messages = await db.chat_messages.find({"session_id": session_id}).to_list(1000)
+async def get_chat_history(
+    session_id: str,
+    sort: str = "created_at",
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    messages, next_cursor = await find_page(
+        db.chat_messages, {"session_id": session_id}, sort, limit, cursor
+    )
     for msg in messages:
         msg["_id"] = str(msg["_id"])
-    return messages
+    return {"items": messages, "next_cursor": next_cursor}
+
+# ==================== LIVE FLEET MAP ====================
+
+# Map entries of available vehicles by id, kept current by vehicle changes and
+# GPS pings so the live map never queries the database after startup; located
+# entries are also indexed in fleet_grid for nearest vehicle searches
+fleet: Dict[str, dict] = {}
+fleet_grid = PointGrid(NEAREST_GRID_CELL_DEGREES)
+# Ids of every vehicle, available or not: GPS pings for other ids are rejected
+known_vehicle_ids: Set[str] = set()
+MAP_ENTRY_PROJECTION = {
+    "name": 1,
+    "brand": 1,
+    "category": 1,
+    "type": 1,
+    "price_per_day": 1,
+    "images": {"$slice": 1},
+    "current_location": 1
+}
+
+def map_entry(vehicle: dict) -> dict:
+    return {
+        "_id": str(vehicle["_id"]),
+        "name": vehicle["name"],
+        "brand": vehicle["brand"],
+        "category": vehicle["category"],
+        "type": vehicle["type"],
+        "price_per_day": vehicle.get("price_per_day"),
+        "image": vehicle["images"][0] if vehicle.get("images") else None,
+        "location": vehicle.get("current_location")
+    }
+
+async def load_fleet():
+    """Replace the fleet with the stored one and tell map clients what changed.
+    A position newer than the stored one (a ping not flushed yet) is kept."""
+    known_vehicle_ids.clear()
+    known_vehicle_ids.update(str(vehicle_id) for vehicle_id in await db.vehicles.distinct("_id"))
+    vehicles = await db.vehicles.find({"available": True}, MAP_ENTRY_PROJECTION).to_list(None)
+    loaded = {str(vehicle["_id"]): map_entry(vehicle) for vehicle in vehicles}
+    for vehicle_id, entry in loaded.items():
+        known = fleet.get(vehicle_id, {}).get("location")
+        stored = entry["location"]
+        if known and (stored is None or stored["last_updated"] < known["last_updated"]):
+            entry["location"] = known
+    changed = [vehicle_id for vehicle_id in fleet.keys() | loaded.keys() if fleet.get(vehicle_id) != loaded.get(vehicle_id)]
+    fleet.clear()
+    fleet.update(loaded)
+    for vehicle_id in changed:
+        index_fleet_entry(vehicle_id, fleet.get(vehicle_id))
+        publish_fleet_change(vehicle_id)
+
+def index_fleet_entry(vehicle_id: str, entry: Optional[dict]):
+    location = entry.get("location") if entry else None
+    if location:
+        fleet_grid.move(vehicle_id, location["latitude"], location["longitude"])
+    else:
+        fleet_grid.remove(vehicle_id)
+
+class MapSubscriber:
+    """A live map client: only vehicles inside its bbox are sent, and updates
+    are coalesced per vehicle so a slow client gets the latest position
+    instead of a growing backlog"""
+    
+    def __init__(self, websocket: WebSocket, bbox: Optional[BBox]):
+        self.websocket = websocket
+        self.bbox = bbox
+        self.visible = set()  # vehicles the client is showing
+        self.dirty = set()  # vehicles changed since the last message
+        self.wakeup = asyncio.Event()
+    
+    def shows(self, vehicle_id: str) -> bool:
+        location = fleet.get(vehicle_id, {}).get("location")
+        return location is not None and in_bbox(location["latitude"], location["longitude"], self.bbox)
+    
+    def mark(self, vehicle_id: str):
+        if vehicle_id in self.visible or self.shows(vehicle_id):
+            self.dirty.add(vehicle_id)
+            self.wakeup.set()
+    
+    def set_bbox(self, bbox: Optional[BBox]):
+        self.bbox = bbox
+        self.dirty.update(self.visible)
+        self.dirty.update(vehicle_id for vehicle_id in fleet if self.shows(vehicle_id))
+        self.wakeup.set()
+    
+    def snapshot(self) -> dict:
+        self.visible = {vehicle_id for vehicle_id in fleet if self.shows(vehicle_id)}
+        self.dirty.clear()
+        return {"type": "snapshot", "vehicles": [fleet[vehicle_id] for vehicle_id in self.visible]}
+    
+    def delta(self) -> dict:
+        moved, entered, removed = [], [], []
+        dirty, self.dirty = self.dirty, set()
+        for vehicle_id in dirty:
+            was_visible = vehicle_id in self.visible
+            if self.shows(vehicle_id):
+                self.visible.add(vehicle_id)
+                if was_visible:
+                    moved.append({"_id": vehicle_id, "location": fleet[vehicle_id]["location"]})
+                else:
+                    entered.append(fleet[vehicle_id])
+            elif was_visible:
+                self.visible.discard(vehicle_id)
+                removed.append(vehicle_id)
+        return {"type": "delta", "moved": moved, "entered": entered, "removed": removed}
+    
+    async def send_loop(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                message = self.delta()
+                if message["moved"] or message["entered"] or message["removed"]:
+                    await self.websocket.send_json(jsonable_encoder(message))
+        except (WebSocketDisconnect, RuntimeError):
+            pass  # client gone, the receive side cleans up
+
+map_subscribers = set()
+
+def publish_fleet_change(vehicle_id: str):
+    for subscriber in map_subscribers:
+        subscriber.mark(vehicle_id)
+
+def on_vehicle_changed(vehicle_id: str, vehicle: Optional[dict]):
+    """Keep in-memory views of the fleet in step with a created, updated (vehicle)
+    or deleted (None) vehicle"""
+    if vehicle is not None:
+        known_vehicle_ids.add(vehicle_id)
+    else:
+        known_vehicle_ids.discard(vehicle_id)
+    if vehicle is not None and vehicle.get("available"):
+        fleet[vehicle_id] = map_entry(vehicle)
+    else:
+        fleet.pop(vehicle_id, None)
+    index_fleet_entry(vehicle_id, fleet.get(vehicle_id))
+    if vehicle is not None:
+        catalogue.put(vehicle_id, vehicle)
+        search_index.put(vehicle_id, vehicle)
+    else:
+        catalogue.remove(vehicle_id)
+        search_index.remove(vehicle_id)
+    for changes in rebuild_changes.values():
+        changes[vehicle_id] = vehicle
+    # Cached chat replies may describe the previous fleet
+    response_cache.clear()
+    if vehicle is None:
+        odometer.forget(vehicle_id)
+        geofence_monitor.forget(vehicle_id)
+    publish_fleet_change(vehicle_id)
+
+def update_fleet_positions(pings: List[dict]):
+    for ping in pings:
+        entry = fleet.get(ping["vehicle_id"])
+        if entry is None:
+            continue
+        location = entry.get("location")
+        if location is None or location["last_updated"] <= ping["timestamp"]:
+            entry["location"] = current_location_doc(ping)
+            index_fleet_entry(ping["vehicle_id"], entry)
+            publish_fleet_change(ping["vehicle_id"])
+
+@api_router.websocket("/vehicles/map/live")
+async def live_vehicle_map(websocket: WebSocket, bbox: Optional[str] = None):
+    """Live map feed: a snapshot of the vehicles in bbox, then deltas as they move.
+    
+    The client may send {"bbox": "min_lng,min_lat,max_lng,max_lat"} (or null) to
+    change its viewport.
+    """
+    try:
+        subscriber_bbox = parse_bbox(bbox) if bbox else None
+    except ValueError:
+        await websocket.close(code=1008)
+        return
+    
+    await websocket.accept()
+    subscriber = MapSubscriber(websocket, subscriber_bbox)
+    map_subscribers.add(subscriber)
+    sender = None
+    try:
+        await websocket.send_json(jsonable_encoder(subscriber.snapshot()))
+        sender = asyncio.create_task(subscriber.send_loop())
+        while True:
+            message = await websocket.receive_json()
+            if isinstance(message, dict) and "bbox" in message:
+                try:
+                    subscriber.set_bbox(parse_bbox(message["bbox"]) if message["bbox"] else None)
+                except (ValueError, AttributeError):
+                    await websocket.send_json({"type": "error", "detail": "Invalid bbox"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        map_subscribers.discard(subscriber)
+        if sender is not None:
+            sender.cancel()
 
 # ==================== GPS TRACKING ROUTES ====================
 
+def location_ping(
+    vehicle_id: str,
+    latitude: float,
+    longitude: float,
+    speed: Optional[float] = 0.0,
+    heading: Optional[float] = 0.0,
+    timestamp: Optional[datetime] = None
+) -> dict:
+    return {
+        "vehicle_id": vehicle_id,
+        "latitude": latitude,
+        "longitude": longitude,
+        "speed": speed or 0.0,
+        "heading": heading or 0.0,
+        "timestamp": timestamp or datetime.utcnow()
+    }
+
+async def apply_location_retention():
+    now = datetime.utcnow()
+    await roll_up(db, now - timedelta(days=LOCATION_RAW_RETENTION_DAYS))
+    await expire_rollups(db, now - timedelta(days=LOCATION_ROLLUP_RETENTION_DAYS))
+
+async def migrate_legacy_history():
+    """Move pings stored one per document by earlier versions into the buckets
+    the history endpoint reads, in the background since there may be many"""
+    try:
+        moved = await migrate_location_history(db)
+    except Exception:
+        logger.exception("Moving legacy GPS pings into location buckets failed")
+        return
+    if moved:
+        logger.info(f"Moved {moved} legacy GPS pings into location buckets")
+
+# Rental windows of accepted and completed reservations by vehicle id, used to
+# attribute driven distance to reservations without a query per ping
+odometer = Odometer(GPS_MAX_SPEED_KMH)
+rental_windows: Dict[str, List[ReservationWindow]] = {}
+TRIP_STATUSES = ["accepted", "completed"]
+
+async def load_rental_windows():
+    # Pings may arrive up to a day after the rental ended
+    reservations = await db.reservations.find(
+        {"status": {"$in": TRIP_STATUSES}, "end_date": {"$gte": datetime.utcnow() - timedelta(days=1)}},
+        {"vehicle_id": 1, "start_date": 1, "end_date": 1}
+    ).to_list(None)
+    windows: Dict[str, List[ReservationWindow]] = {}
+    for reservation in reservations:
+        windows.setdefault(reservation["vehicle_id"], []).append(
+            (str(reservation["_id"]), reservation["start_date"], reservation["end_date"])
+        )
+    rental_windows.clear()
+    rental_windows.update(windows)
+
+async def flush_odometer():
+    await odometer.flush(db)
+
+async def update_mileage():
+    await apply_mileage(db)
+
+def on_pings_accepted(pings: List[dict]):
+    """Feed accepted pings to the in-memory consumers, before they are persisted"""
+    update_fleet_positions(pings)
+    odometer.add(pings, rental_windows)
+    pending_geofence_events.extend(geofence_monitor.evaluate(pings))
+
+def current_location_doc(ping: dict) -> dict:
+    return {
+        "latitude": ping["latitude"],
+        "longitude": ping["longitude"],
+        "last_updated": ping["timestamp"],
+        # GeoJSON copy of the position for the 2dsphere index
+        "point": geo_point(ping["latitude"], ping["longitude"])
+    }
+
+def keep_latest(latest: Dict[str, dict], pings: Iterable[dict]):
+    """Record in latest the most recent of pings for each vehicle"""
+    for ping in pings:
+        current = latest.get(ping["vehicle_id"])
+        if current is None or ping["timestamp"] >= current["timestamp"]:
+            latest[ping["vehicle_id"]] = ping
+
+async def move_vehicles(latest: Dict[str, dict]):
+    """Move each vehicle to its latest ping"""
+    await db.vehicles.bulk_write([
+        UpdateOne(
+            # A late batch must not move a vehicle back to an older position
+            {"_id": ObjectId(vehicle_id), "current_location.last_updated": {"$not": {"$gt": ping["timestamp"]}}},
+            {"$set": {"current_location": current_location_doc(ping)}}
+        )
+        for vehicle_id, ping in latest.items()
+    ], ordered=False)
+
+class LocationBuffer:
+    """Write-behind buffer turning many small ping requests into bulk writes.
+    
+    Pings are stored in the history, then each vehicle is moved to its latest
+    one. Either write failing keeps its part for the next flush: pings go back
+    in front of the buffer (at most retry_max_pings, oldest dropped first) and
+    positions are merged with newer ones. While writes fail, only the periodic
+    flush retries, so ingestion requests are not held by a down database.
+    """
+    
+    def __init__(self, max_pings: int, retry_max_pings: int):
+        self.max_pings = max_pings
+        self.retry_max_pings = retry_max_pings
+        self.pings: List[dict] = []
+        self.positions: Dict[str, dict] = {}  # stored in the history, vehicle not moved yet
+        self.failing = False
+        self.lock = asyncio.Lock()
+        self.counters = {"received": 0, "written": 0, "flushes": 0, "retried": 0, "dropped": 0}
+    
+    async def add(self, pings: List[dict]):
+        self.pings.extend(pings)
+        self.counters["received"] += len(pings)
+        if len(self.pings) >= self.max_pings and not self.failing:
+            await self.flush()
+    
+    async def flush(self):
+        async with self.lock:
+            pings, self.pings = self.pings, []
+            positions, self.positions = self.positions, {}
+            if not pings and not positions:
+                return
+            self.failing = True
+            if pings:
+                try:
+                    await append_pings(db, pings)
+                except Exception:
+                    logger.exception(f"Failed to write {len(pings)} GPS pings, will retry")
+                    self.requeue(pings, positions)
+                    return
+                self.counters["written"] += len(pings)
+                keep_latest(positions, pings)
+            try:
+                await move_vehicles(positions)
+            except Exception:
+                logger.exception(f"Failed to move {len(positions)} vehicles, will retry")
+                self.requeue([], positions)
+                return
+            self.failing = False
+            self.counters["flushes"] += 1
+    
+    def requeue(self, pings: List[dict], positions: Dict[str, dict]):
+        self.counters["retried"] += len(pings)
+        self.pings[:0] = pings
+        overflow = len(self.pings) - self.retry_max_pings
+        if overflow > 0:
+            self.counters["dropped"] += overflow
+            logger.error(f"Dropped {overflow} GPS pings waiting for retry")
+            del self.pings[:overflow]
+        keep_latest(self.positions, positions.values())
+    
+    def metrics(self) -> dict:
+        return {
+            **self.counters,
+            "pending": len(self.pings),
+            "pending_positions": len(self.positions),
+            "failing": self.failing,
+            "max_pings": self.max_pings
+        }
+
+location_buffer = LocationBuffer(GPS_BUFFER_MAX_PINGS, GPS_BUFFER_RETRY_MAX_PINGS)
+
+# Trackers authenticate with a device token instead of a user JWT. Only token
+# hashes are stored; they are kept in memory so ingestion never reads the database.
+# Each entry is {"id", "vehicle_ids"}, vehicle_ids being the set of vehicles the
+# device may report for, or None for any.
+device_tokens: Dict[str, dict] = {}
+
+def hash_device_token(token: str) -> str:
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def device_entry(device: dict) -> dict:
+    bound = device.get("vehicle_ids")
+    return {"id": str(device["_id"]), "vehicle_ids": set(bound) if bound is not None else None}
+
+async def load_device_tokens():
+    devices = await db.gps_devices.find({"revoked": False}, {"token_hash": 1, "vehicle_ids": 1}).to_list(None)
+    device_tokens.clear()
+    device_tokens.update({device["token_hash"]: device_entry(device) for device in devices})
+
+async def get_gps_device(x_device_token: Optional[str] = Header(default=None)) -> dict:
+    device = device_tokens.get(hash_device_token(x_device_token)) if x_device_token else None
+    if device is None:
+        raise HTTPException(status_code=401, detail="Invalid device token")
+    return device
+
+@api_router.post("/admin/devices", dependencies=[Depends(get_admin_user)])
+async def create_gps_device(device_data: DeviceCreate):
+    """Register a GPS tracker; the token is only returned here"""
+    if device_data.vehicle_ids is not None:
+        if not all(ObjectId.is_valid(vehicle_id) for vehicle_id in device_data.vehicle_ids):
+            raise HTTPException(status_code=400, detail="Invalid vehicle ID")
+        found = await db.vehicles.count_documents(
+            {"_id": {"$in": [ObjectId(vehicle_id) for vehicle_id in set(device_data.vehicle_ids)]}}
+        )
+        if found != len(set(device_data.vehicle_ids)):
+            raise HTTPException(status_code=404, detail="Vehicle not found")
+    
+    token = secrets.token_urlsafe(32)
+    device_dict = {
+        "name": device_data.name,
+        "token_hash": hash_device_token(token),
+        "vehicle_ids": sorted(set(device_data.vehicle_ids)) if device_data.vehicle_ids is not None else None,
+        "revoked": False,
+        "created_at": datetime.utcnow()
+    }
+    result = await db.gps_devices.insert_one(device_dict)
+    device_tokens[device_dict["token_hash"]] = device_entry(device_dict)
+    
+    return {
+        "id": str(result.inserted_id),
+        "name": device_data.name,
+        "vehicle_ids": device_dict["vehicle_ids"],
+        "token": token
+    }
+
+@api_router.get("/admin/devices", dependencies=[Depends(get_admin_user)])
+async def get_gps_devices():
+    devices = await db.gps_devices.find({}, {"token_hash": 0}).sort("created_at", -1).to_list(None)
+    for device in devices:
+        device["_id"] = str(device["_id"])
+    return devices
+
+@api_router.delete("/admin/devices/{device_id}", dependencies=[Depends(get_admin_user)])
+async def revoke_gps_device(device_id: str):
+    if not ObjectId.is_valid(device_id):
+        raise HTTPException(status_code=400, detail="Invalid device ID")
+    
+    device = await db.gps_devices.find_one_and_update(
+        {"_id": ObjectId(device_id)},
+        {"$set": {"revoked": True}},
+        projection={"token_hash": 1}
+    )
+    if device is None:
+        raise HTTPException(status_code=404, detail="Device not found")
+    device_tokens.pop(device["token_hash"], None)
+    
+    return {"message": "Device revoked"}
+
 @api_router.post("/vehicles/{vehicle_id}/location", dependencies=[Depends(get_admin_user)])
 async def update_vehicle_location(vehicle_id: str, location: LocationUpdate):
     """Update vehicle GPS location (admin only - simulates GPS tracker)"""
     if not ObjectId.is_valid(vehicle_id):
         raise HTTPException(status_code=400, detail="Invalid vehicle ID")
     
-    # Verify vehicle exists
-    vehicle = await db.vehicles.find_one({"_id": ObjectId(vehicle_id)})
-    if not vehicle:
-        raise HTTPException(status_code=404, detail="Vehicle not found")
-    
-    # Store location in history
-    location_dict = {
-        "vehicle_id": vehicle_id,
-        "latitude": location.latitude,
-        "longitude": location.longitude,
-        "speed": location.speed,
-        "heading": location.heading,
-        "timestamp": datetime.utcnow()
-    }
+    ping = location_ping(vehicle_id, location.latitude, location.longitude, location.speed, location.heading)
     
-    await db.vehicle_locations.insert_one(location_dict)
-    
-    # Update vehicle's current location
-    await db.vehicles.update_one(
+    # Update vehicle's current location, which also verifies the vehicle exists
+    result = await db.vehicles.update_one(
         {"_id": ObjectId(vehicle_id)},
-        {"$set": {
-            "current_location": {
-                "latitude": location.latitude,
-                "longitude": location.longitude,
-                "last_updated": datetime.utcnow()
-            }
-        }}
+        {"$set": {"current_location": current_location_doc(ping)}}
     )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Vehicle not found")
+    
+    # Store location in history
+    await append_pings(db, [ping])
+    on_pings_accepted([ping])
     
     return {"message": "Location updated successfully"}
 
+@api_router.post("/gps/pings", status_code=202)
+async def ingest_gps_pings(request: Request, device: dict = Depends(get_gps_device)):
+    """Bulk GPS ingestion for trackers: a JSON array or NDJSON stream of pings for
+    existing vehicles the device is bound to.
+    
+    Pings are acknowledged once buffered; they reach the database within
+    GPS_FLUSH_INTERVAL_SECONDS.
+    """
+    too_large = HTTPException(status_code=413, detail=f"Body larger than {GPS_MAX_BODY_BYTES} bytes")
+    if int(request.headers.get("content-length") or 0) > GPS_MAX_BODY_BYTES:
+        raise too_large
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > GPS_MAX_BODY_BYTES:
+            raise too_large
+    try:
+        if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+            raw_pings = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            raw_pings = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+    if not isinstance(raw_pings, list):
+        raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+    if len(raw_pings) > GPS_MAX_BATCH:
+        raise HTTPException(status_code=413, detail=f"At most {GPS_MAX_BATCH} pings per request")
+    
+    pings = []
+    errors = []
+    now = datetime.utcnow()
+    for index, raw_ping in enumerate(raw_pings):
+        try:
+            ping = GpsPing.model_validate(raw_ping)
+        except ValidationError as e:
+            errors.append({"index": index, "error": e.errors(include_url=False)[0]["msg"]})
+            continue
+        if ping.vehicle_id not in known_vehicle_ids:
+            errors.append({"index": index, "error": "Unknown vehicle"})
+            continue
+        if device["vehicle_ids"] is not None and ping.vehicle_id not in device["vehicle_ids"]:
+            errors.append({"index": index, "error": "Vehicle not bound to this device"})
+            continue
+        # Never trust device clocks ahead of ours
+        timestamp = min(utc_naive(ping.timestamp), now) if ping.timestamp else now
+        pings.append(location_ping(
+            ping.vehicle_id, ping.latitude, ping.longitude, ping.speed, ping.heading, timestamp
+        ))
+    
+    on_pings_accepted(pings)
+    await location_buffer.add(pings)
+    
+    return {"accepted": len(pings), "rejected": len(errors), "errors": errors[:20]}
+
 @api_router.get("/vehicles/{vehicle_id}/location")
 async def get_vehicle_current_location(vehicle_id: str):
     """Get current vehicle GPS location"""
@@ -695,13 +2245,64 @@ async def get_vehicle_current_location(vehicle_id: str):
     
     return vehicle.get("current_location", {})
 
+async def ndjson_lines(documents):
+    async for document in documents:
+        if "_id" in document:
+            document["_id"] = str(document["_id"])
+        yield json.dumps(jsonable_encoder(document)) + "\n"
+
+async def take_points(points, limit: int) -> List[dict]:
+    taken = []
+    async for point in points:
+        taken.append(point)
+        if len(taken) >= limit:
+            break
+    return taken
+
+def simplify_chunk(points: List[dict], tolerance: float) -> List[dict]:
+    kept = simplify_track([(point["latitude"], point["longitude"]) for point in points], tolerance)
+    return [points[index] for index in kept]
+
+async def simplified_points(points, tolerance: float, max_points: int) -> Optional[List[dict]]:
+    """Douglas-Peucker over the whole stream of points, a chunk at a time in a worker
+    thread; each chunk starts with the last point of the previous one, which is
+    always kept. None once more than max_points are kept."""
+    loop = asyncio.get_running_loop()
+    kept: List[dict] = []
+    chunk: List[dict] = []
+    async for point in points:
+        chunk.append(point)
+        if len(chunk) >= HISTORY_SIMPLIFY_CHUNK_POINTS:
+            kept.extend((await loop.run_in_executor(None, simplify_chunk, chunk, tolerance))[:-1])
+            if len(kept) > max_points:
+                return None
+            chunk = [chunk[-1]]
+    if chunk:
+        kept.extend(await loop.run_in_executor(None, simplify_chunk, chunk, tolerance))
+    return kept if len(kept) <= max_points else None
+
+async def iter_documents(documents: list):
+    for document in documents:
+        yield document
+
 @api_router.get("/vehicles/{vehicle_id}/location/history")
 async def get_vehicle_location_history(
     vehicle_id: str,
     limit: int = 100,
+    from_: Optional[datetime] = Query(None, alias="from"),
+    to: Optional[datetime] = None,
+    tolerance: Optional[float] = Query(None, gt=0),
+    format: str = Query("json", pattern="^(json|ndjson)$"),
     current_user: dict = Depends(get_current_user)
 ):
-    """Get vehicle GPS location history"""
+    """Get vehicle GPS location history.
+    
+    By default returns the newest `limit` points of [from, to]. With tolerance
+    (meters) the whole range is simplified with Douglas-Peucker, oldest first
+    (400 if the result exceeds HISTORY_MAX_POINTS).
+    format=ndjson streams the points oldest first, at full resolution unless
+    tolerance is given, without any limit.
+    """
     if not ObjectId.is_valid(vehicle_id):
         raise HTTPException(status_code=400, detail="Invalid vehicle ID")
     
@@ -722,34 +2323,225 @@ async def get_vehicle_location_history(
     if not is_admin and not has_reservation:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    locations = await db.vehicle_locations.find(
-        {"vehicle_id": vehicle_id}
-    ).sort("timestamp", -1).limit(limit).to_list(limit)
-    
-    for loc in locations:
-        loc["_id"] = str(loc["_id"])
-    
+    start = utc_naive(from_) if from_ else None
+    end = utc_naive(to) if to else None
+    
+    if tolerance:
+        locations = await simplified_points(iter_points(db, vehicle_id, start, end), tolerance, HISTORY_MAX_POINTS)
+        if locations is None:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Simplified track exceeds {HISTORY_MAX_POINTS} points; narrow the range or raise tolerance"
+            )
+    elif format == "ndjson":
+        points = iter_points(db, vehicle_id, start, end)
+        return StreamingResponse(ndjson_lines(points), media_type="application/x-ndjson")
+    else:
+        locations = await take_points(iter_points(db, vehicle_id, start, end, newest_first=True), limit)
+    
+    if format == "ndjson":
+        return StreamingResponse(ndjson_lines(iter_documents(locations)), media_type="application/x-ndjson")
     return locations
 
+def cluster_pipeline(match: dict, zoom: int) -> list:
+    """Group vehicles into grid cells sized for the zoom level"""
+    cell = cluster_cell_size(zoom, MAP_CLUSTER_CELLS_PER_TILE)
+    coordinates = "$current_location.point.coordinates"
+    return [
+        {"$match": match},
+        {"$group": {
+            "_id": {
+                "x": {"$floor": {"$divide": [{"$arrayElemAt": [coordinates, 0]}, cell]}},
+                "y": {"$floor": {"$divide": [{"$arrayElemAt": [coordinates, 1]}, cell]}}
+            },
+            "count": {"$sum": 1},
+            "latitude": {"$avg": "$current_location.latitude"},
+            "longitude": {"$avg": "$current_location.longitude"},
+            "vehicle_id": {"$first": "$_id"}
+        }}
+    ]
+
 @api_router.get("/vehicles/map/all")
-async def get_all_vehicles_on_map():
-    """Get all vehicles with their current locations for map display"""
-    vehicles = await db.vehicles.find({"available": True}).to_list(1000)
+async def get_all_vehicles_on_map(
+    bbox: Optional[str] = None,
+    near: Optional[str] = None,
+    radius: Optional[float] = Query(None, gt=0),
+    k: int = Query(MAP_MAX_VEHICLES, ge=1, le=MAP_MAX_VEHICLES),
+    zoom: Optional[int] = Query(None, ge=0, le=22)
+):
+    """Get available vehicles with their current locations for map display.
     
-    vehicles_on_map = []
-    for vehicle in vehicles:
-        if "current_location" in vehicle:
-            vehicles_on_map.append({
-                "_id": str(vehicle["_id"]),
-                "name": vehicle["name"],
-                "brand": vehicle["brand"],
-                "category": vehicle["category"],
-                "type": vehicle["type"],
-                "image": vehicle["images"][0] if vehicle.get("images") else None,
-                "location": vehicle["current_location"]
-            })
-    
-    return vehicles_on_map
+    bbox=min_lng,min_lat,max_lng,max_lat keeps vehicles inside the box;
+    near=lat,lng (optionally radius in meters) returns the k nearest with their
+    distance; zoom switches to clusters of vehicles grouped per grid cell.
+    """
+    try:
+        box = parse_bbox(bbox) if bbox else None
+        polygons = bbox_polygons(box) if box else None
+        center = parse_lat_lng(near) if near else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if box and center:
+        raise HTTPException(status_code=400, detail="Use either bbox or near")
+    if radius and not center:
+        raise HTTPException(status_code=400, detail="radius requires near")
+    
+    match = {"available": True, "current_location.point": {"$exists": True}}
+    if box:
+        # The polygons narrow the search through the 2dsphere index; the ranges make
+        # it the same planar box as the live map's
+        min_lng, min_lat, max_lng, max_lat = box
+        match["$or"] = [{"current_location.point": {"$geoWithin": {"$geometry": polygon}}} for polygon in polygons]
+        match["current_location.latitude"] = {"$gte": min_lat, "$lte": max_lat}
+        match["current_location.longitude"] = {"$gte": min_lng, "$lte": max_lng}
+    
+    if zoom is not None:
+        if center:
+            raise HTTPException(status_code=400, detail="Clustering supports bbox only")
+        clusters = await db.vehicles.aggregate(cluster_pipeline(match, zoom)).to_list(None)
+        return [
+            {
+                "count": cluster["count"],
+                "location": {"latitude": cluster["latitude"], "longitude": cluster["longitude"]},
+                "vehicle_id": str(cluster["vehicle_id"]) if cluster["count"] == 1 else None
+            }
+            for cluster in clusters
+        ]
+    
+    if center:
+        geo_near = {
+            "near": geo_point(*center),
+            "distanceField": "distance",
+            "key": "current_location.point",
+            "query": {"available": True},
+            "spherical": True
+        }
+        if radius:
+            geo_near["maxDistance"] = radius
+        vehicles = await db.vehicles.aggregate([
+            {"$geoNear": geo_near},
+            {"$limit": k},
+            {"$project": {**MAP_ENTRY_PROJECTION, "distance": 1}}
+        ]).to_list(k)
+        return [{**map_entry(vehicle), "distance": vehicle["distance"]} for vehicle in vehicles]
+    
+    vehicles = await db.vehicles.find(match, MAP_ENTRY_PROJECTION).limit(k).to_list(k)
+    return [map_entry(vehicle) for vehicle in vehicles]
+
+# ==================== GEOFENCES ====================
+
+geofence_monitor = GeofenceMonitor(GEOFENCE_GRID_CELL_DEGREES)
+# Enter/exit events waiting to be written with the next flush
+pending_geofence_events: List[dict] = []
+
+async def load_geofences():
+    geofence_monitor.replace_all(await db.geofences.find({"active": True}).to_list(None))
+
+async def prime_geofence_states():
+    """Start every located vehicle in the fences it is currently inside"""
+    async for vehicle in db.vehicles.find({"current_location": {"$ne": None}}, {"current_location": 1}):
+        location = vehicle.get("current_location")
+        if location:
+            geofence_monitor.prime(
+                str(vehicle["_id"]), location["latitude"], location["longitude"], location["last_updated"]
+            )
+
+async def flush_geofence_events():
+    global pending_geofence_events
+    events, pending_geofence_events = pending_geofence_events, []
+    if not events:
+        return
+    try:
+        await db.geofence_events.insert_many(events, ordered=False)
+    except Exception:
+        pending_geofence_events = events + pending_geofence_events
+        raise
+
+def geofence_document(geofence_data: GeofenceCreate) -> dict:
+    try:
+        shape = validate_geofence(geofence_data.kind, geofence_data.points, geofence_data.center, geofence_data.radius_m)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not all(ObjectId.is_valid(vehicle_id) for vehicle_id in geofence_data.vehicle_ids):
+        raise HTTPException(status_code=400, detail="Invalid vehicle ID")
+    return {
+        "name": geofence_data.name,
+        **shape,
+        "vehicle_ids": geofence_data.vehicle_ids,
+        "active": geofence_data.active
+    }
+
+@api_router.post("/admin/geofences", dependencies=[Depends(get_admin_user)])
+async def create_geofence(geofence_data: GeofenceCreate):
+    geofence_dict = geofence_document(geofence_data)
+    geofence_dict["created_at"] = datetime.utcnow()
+    result = await db.geofences.insert_one(geofence_dict)
+    if geofence_dict["active"]:
+        geofence_monitor.put(geofence_dict)
+    
+    geofence_dict["_id"] = str(result.inserted_id)
+    return geofence_dict
+
+@api_router.get("/admin/geofences", dependencies=[Depends(get_admin_user)])
+async def get_geofences():
+    geofences = await db.geofences.find().sort("created_at", -1).to_list(None)
+    for geofence in geofences:
+        geofence["_id"] = str(geofence["_id"])
+    return geofences
+
+@api_router.get("/admin/geofences/events", dependencies=[Depends(get_admin_user)])
+async def get_geofence_events(
+    vehicle_id: Optional[str] = None,
+    geofence_id: Optional[str] = None,
+    sort: str = "-timestamp",
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    query = {}
+    if vehicle_id:
+        query["vehicle_id"] = vehicle_id
+    if geofence_id:
+        query["geofence_id"] = geofence_id
+    
+    events, next_cursor = await find_page(
+        db.geofence_events, query, sort, limit, cursor, sort_fields=("timestamp",)
+    )
+    for event in events:
+        event["_id"] = str(event["_id"])
+    
+    return {"items": events, "next_cursor": next_cursor}
+
+@api_router.put("/admin/geofences/{geofence_id}", dependencies=[Depends(get_admin_user)])
+async def update_geofence(geofence_id: str, geofence_data: GeofenceCreate):
+    if not ObjectId.is_valid(geofence_id):
+        raise HTTPException(status_code=400, detail="Invalid geofence ID")
+    
+    geofence = await db.geofences.find_one_and_update(
+        {"_id": ObjectId(geofence_id)},
+        {"$set": geofence_document(geofence_data)},
+        return_document=ReturnDocument.AFTER
+    )
+    if geofence is None:
+        raise HTTPException(status_code=404, detail="Geofence not found")
+    if geofence["active"]:
+        geofence_monitor.put(geofence)
+    else:
+        geofence_monitor.remove(geofence_id)
+    
+    geofence["_id"] = str(geofence["_id"])
+    return geofence
+
+@api_router.delete("/admin/geofences/{geofence_id}", dependencies=[Depends(get_admin_user)])
+async def delete_geofence(geofence_id: str):
+    if not ObjectId.is_valid(geofence_id):
+        raise HTTPException(status_code=400, detail="Invalid geofence ID")
+    
+    result = await db.geofences.delete_one({"_id": ObjectId(geofence_id)})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Geofence not found")
+    geofence_monitor.remove(geofence_id)
+    
+    return {"message": "Geofence deleted"}
 
 # ==================== MAIN APP SETUP ====================
 
@@ -769,6 +2561,55 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+background_tasks: List[asyncio.Task] = []
+
+async def run_periodically(interval_seconds: float, job):
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await job()
+        except Exception:
+            logger.exception(f"Periodic job {job.__name__} failed")
+
+def start_periodic_job(interval_seconds: float, job):
+    if interval_seconds > 0:
+        background_tasks.append(asyncio.create_task(run_periodically(interval_seconds, job)))
+
+@app.on_event("startup")
+async def start_background_jobs():
+    await ensure_indexes(db)
+    await sync_booking_ledger()
+    if not await db.stats.find_one({"_id": STATS_GLOBAL_ID}, {"_id": 1}):
+        await reconcile_stats()
+    start_periodic_job(STATS_RECONCILE_INTERVAL_SECONDS, reconcile_stats)
+    await load_device_tokens()
+    start_periodic_job(GPS_DEVICE_RELOAD_SECONDS, load_device_tokens)
+    start_periodic_job(GPS_FLUSH_INTERVAL_SECONDS, location_buffer.flush)
+    start_periodic_job(LOCATION_RETENTION_INTERVAL_SECONDS, apply_location_retention)
+    background_tasks.append(asyncio.create_task(migrate_legacy_history()))
+    await odometer.load(db)
+    await load_rental_windows()
+    start_periodic_job(TRIP_RESERVATION_RELOAD_SECONDS, load_rental_windows)
+    start_periodic_job(GPS_FLUSH_INTERVAL_SECONDS, flush_odometer)
+    start_periodic_job(MILEAGE_UPDATE_INTERVAL_SECONDS, update_mileage)
+    await load_geofences()
+    await prime_geofence_states()
+    start_periodic_job(GEOFENCE_RELOAD_SECONDS, load_geofences)
+    start_periodic_job(GPS_FLUSH_INTERVAL_SECONDS, flush_geofence_events)
+    await migrate_vehicle_location_points(db)
+    await load_fleet()
+    start_periodic_job(FLEET_RELOAD_SECONDS, load_fleet)
+    await load_catalogue()
+    start_periodic_job(CATALOGUE_RELOAD_SECONDS, load_catalogue)
+    await load_search_index()
+    start_periodic_job(SEARCH_INDEX_RELOAD_SECONDS, load_search_index)
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
+    await location_buffer.flush()
+    await odometer.flush(db)
+    await flush_geofence_events()
+    password_executor.shutdown(wait=False)
     client.close()
@@ -49,23 +49,20 @@ export default function HomeScreen() {
   const loadData = async () => {
     try {
       setLoading(true);
-      const vehicles = await vehicleService.getVehicles();
+      const [latest, recommended, categoryTotals] = await Promise.all([
+        vehicleService.getLatestVehicles(5),
+        vehicleService.getRandomVehicles(6),
+        vehicleService.getCategoryCounts(),
+      ]);
       
-      // Get new vehicles (last 5)
-      const sortedByDate = [...vehicles].sort(
-        (a, b) => new Date(b.created_at).getTime() - new Date(a.created_at).getTime()
-      );
-      setNewVehicles(sortedByDate.slice(0, 5));
-      
-      // Get recommended vehicles (random 6)
-      const shuffled = [...vehicles].sort(() => 0.5 - Math.random());
-      setRecommendedVehicles(shuffled.slice(0, 6));
+      setNewVehicles(latest);
+      setRecommendedVehicles(recommended);
       
       // Calculate category counts
       const counts = categories.map(cat => {
-        const count = vehicles.filter(v => 
-          v.category.toLowerCase().includes(cat.name.toLowerCase())
-        ).length;
+        const count = categoryTotals
+          .filter(total => total.category.toLowerCase().includes(cat.name.toLowerCase()))
+          .reduce((sum, total) => sum + total.count, 0);
         return { ...cat, count };
       });
       setCategoryCounts(counts);
@@ -13,6 +13,7 @@ import { Colors } from '../../constants/colors';
 import { Spacing, BorderRadius, FontSizes } from '../../constants/spacing';
 import { Badge } from '../common/Badge';
 import { Vehicle } from '../../types';
+import { resolveImageUrl } from '../../services/api';
 
 const { width } = Dimensions.get('window');
 const CARD_WIDTH = (width - Spacing.lg * 3) / 2;
@@ -30,7 +31,7 @@ export const VehicleCard: React.FC<VehicleCardProps> = ({ vehicle, onPress }) =>
   const priceLabel = vehicle.type === 'location' ? '/jour' : '';
 
   // Placeholder image URL
-  const imageUrl = vehicle.images?.[0] || 'https://via.placeholder.com/300x200/2C2C2E/FFFFFF?text=No+Image';
+  const imageUrl = resolveImageUrl(vehicle.images?.[0]) || 'https://via.placeholder.com/300x200/2C2C2E/FFFFFF?text=No+Image';
 
   return (
     <TouchableOpacity
@@ -13,6 +13,7 @@ import { Colors } from '../../constants/colors';
 import { Spacing, BorderRadius, FontSizes } from '../../constants/spacing';
 import { Badge } from '../common/Badge';
 import { Vehicle } from '../../types';
+import { resolveImageUrl } from '../../services/api';
 
 const { width } = Dimensions.get('window');
 const CARD_WIDTH = width * 0.75;
@@ -33,7 +34,7 @@ export const VehicleCardHorizontal: React.FC<VehicleCardHorizontalProps> = ({
   const priceLabel = vehicle.type === 'location' ? '/jour' : '';
 
   // Placeholder image URL
-  const imageUrl = vehicle.images?.[0] || 'https://via.placeholder.com/400x250/2C2C2E/FFFFFF?text=No+Image';
+  const imageUrl = resolveImageUrl(vehicle.images?.[0]) || 'https://via.placeholder.com/400x250/2C2C2E/FFFFFF?text=No+Image';
 
   return (
     <TouchableOpacity
@@ -38,4 +38,22 @@ api.interceptors.response.use(
   }
 );
 
+// List endpoints return pages of {items, next_cursor}; follow the cursor to the end
+const PAGE_SIZE = 200;
+
+export const getAllPages = async <T>(url: string, params?: object): Promise<T[]> => {
+  const items: T[] = [];
+  let cursor: string | null = null;
+  do {
+    const response = await api.get(url, { params: { ...params, limit: PAGE_SIZE, cursor: cursor ?? undefined } });
+    items.push(...response.data.items);
+    cursor = response.data.next_cursor;
+  } while (cursor);
+  return items;
+};
+
+// Images served by the backend image store are returned as /api/... paths
+export const resolveImageUrl = (uri?: string): string | undefined =>
+  uri && uri.startsWith('/') ? `${BACKEND_URL}${uri}` : uri;
+
 export default api;
@@ -1,4 +1,4 @@
-import api from './api';
+import api, { getAllPages } from './api';
 import { Purchase } from '../types';
 
 export interface CreatePurchaseData {
@@ -13,12 +13,10 @@ export const purchaseService = {
   },
 
   async getMyPurchases(): Promise<Purchase[]> {
-    const response = await api.get('/purchases/my');
-    return response.data;
+    return getAllPages<Purchase>('/purchases/my');
   },
 
   async getAllPurchases(): Promise<Purchase[]> {
-    const response = await api.get('/purchases');
-    return response.data;
+    return getAllPages<Purchase>('/purchases');
   },
 };
@@ -1,4 +1,4 @@
-import api from './api';
+import api, { getAllPages } from './api';
 import { Reservation } from '../types';
 
 export interface CreateReservationData {
@@ -16,13 +16,11 @@ export const reservationService = {
   },
 
   async getMyReservations(): Promise<Reservation[]> {
-    const response = await api.get('/reservations/my');
-    return response.data;
+    return getAllPages<Reservation>('/reservations/my');
   },
 
   async getAllReservations(): Promise<Reservation[]> {
-    const response = await api.get('/reservations');
-    return response.data;
+    return getAllPages<Reservation>('/reservations');
   },
 
   async updateReservationStatus(id: string, status: string): Promise<void> {
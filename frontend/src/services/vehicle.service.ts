@@ -1,4 +1,4 @@
-import api from './api';
+import api, { getAllPages } from './api';
 import { Vehicle } from '../types';
 
 export interface VehicleFilters {
@@ -10,10 +10,29 @@ export interface VehicleFilters {
   fuel?: string;
 }
 
+export interface CategoryCount {
+  category: string;
+  count: number;
+}
+
 export const vehicleService = {
   async getVehicles(filters?: VehicleFilters): Promise<Vehicle[]> {
-    const response = await api.get('/vehicles', { params: filters });
-    return response.data;
+    return getAllPages<Vehicle>('/vehicles', filters);
+  },
+
+  async getLatestVehicles(limit: number): Promise<Vehicle[]> {
+    const response = await api.get('/vehicles', { params: { sort: '-created_at', limit } });
+    return response.data.items;
+  },
+
+  async getRandomVehicles(size: number): Promise<Vehicle[]> {
+    const response = await api.get('/vehicles/sample', { params: { size } });
+    return response.data.items;
+  },
+
+  async getCategoryCounts(): Promise<CategoryCount[]> {
+    const response = await api.get('/vehicles/categories');
+    return response.data.items;
   },
 
   async getVehicle(id: string): Promise<Vehicle> {
@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("cachetools")
+
+from chat_cache import ResponseCache, normalize_text
+
+def test_normalize_text_drops_case_accents_and_punctuation():
+    assert normalize_text("  Quel est le PRIX de la Mégane ?! ") == "quel est le prix de la megane"
+
+def test_exact_hit_ignores_spelling_differences():
+    cache = ResponseCache(10, 60)
+    cache.put("Quel est le prix de la Mégane ?", "20 000 €", ["d"])
+    assert cache.get("quel est le prix de la megane", ["d"]) == "20 000 €"
+    assert cache.counters["hits"] == 1
+
+def test_context_is_part_of_the_key():
+    cache = ResponseCache(10, 60)
+    cache.put("Quel est le prix ?", "20 000 €", ["d"])
+    assert cache.get("Quel est le prix ?", ["c"]) is None
+    assert cache.get("Quel est le prix ?") is None
+    assert cache.counters["misses"] == 2
+
+def test_clear_invalidates_replies():
+    cache = ResponseCache(10, 60)
+    cache.put("Quels documents faut-il ?", "Permis et pièce d'identité")
+    cache.clear()
+    assert cache.get("Quels documents faut-il ?") is None
+    assert cache.counters["invalidations"] == 1
+    cache.clear()
+    assert cache.counters["invalidations"] == 1
+
+def test_entries_expire():
+    cache = ResponseCache(10, 0.05)
+    cache.put("Quels documents faut-il ?", "Permis et pièce d'identité")
+    time.sleep(0.1)
+    assert cache.get("Quels documents faut-il ?") is None
+
+def test_similar_question_reuses_reply():
+    cache = ResponseCache(10, 60, similarity_threshold=0.5)
+    cache.put("Quels documents faut-il ?", "Permis et pièce d'identité")
+    assert cache.get("quels sont les documents qu'il faut") == "Permis et pièce d'identité"
+    assert cache.counters["similar_hits"] == 1
+
+def test_similarity_requires_same_numbers_and_words():
+    cache = ResponseCache(10, 60, similarity_threshold=0.5)
+    cache.put("Prix de location pour 3 jours", "150 €")
+    cache.put("Prix de la Classe C", "45 000 €")
+    assert cache.get("Prix de location pour 30 jours") is None
+    assert cache.get("Prix de la Classe E") is None
+    assert cache.counters["similar_hits"] == 0
+
+def test_similarity_disabled_by_default():
+    cache = ResponseCache(10, 60)
+    cache.put("Quels documents faut-il ?", "Permis et pièce d'identité")
+    assert cache.get("quels sont les documents qu'il faut") is None
@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+
+from chat_models import (
+    ChatModelSaturated,
+    ChatModelUnavailable,
+    CircuitBreaker,
+    GuardedChatModel,
+    LocalChatModel
+)
+
+def guarded(model, timeout_seconds=1.0, max_concurrency=4, cooldown_seconds=0.05):
+    breaker = CircuitBreaker(0.5, cooldown_seconds, window=4, min_calls=2)
+    return GuardedChatModel(model, timeout_seconds, max_concurrency, breaker)
+
+def test_local_model_replies():
+    model = guarded(LocalChatModel())
+    reply = asyncio.run(model.complete("s", "", "Bonjour  tout le monde"))
+    assert reply == "[modèle local] Vous avez demandé : Bonjour tout le monde"
+
+def test_breaker_opens_then_half_opens_then_closes():
+    local = LocalChatModel(failure_rate=1.0)
+    model = guarded(local)
+
+    async def scenario():
+        for _ in range(2):
+            with pytest.raises(ChatModelUnavailable):
+                await model.complete("s", "", "question")
+        assert model.breaker.state == "open"
+        # Short-circuited without reaching the model
+        local.failure_rate = 0.0
+        with pytest.raises(ChatModelUnavailable):
+            await model.complete("s", "", "question")
+        assert model.counters["short_circuited"] == 1
+
+        await asyncio.sleep(0.06)
+        assert model.breaker.state == "half_open"
+        await model.complete("s", "", "question")
+        assert model.breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+def test_failed_trial_reopens_breaker():
+    local = LocalChatModel(failure_rate=1.0)
+    model = guarded(local)
+
+    async def scenario():
+        for _ in range(2):
+            with pytest.raises(ChatModelUnavailable):
+                await model.complete("s", "", "question")
+        await asyncio.sleep(0.06)
+        with pytest.raises(ChatModelUnavailable):
+            await model.complete("s", "", "question")
+        assert model.breaker.state == "open"
+
+    asyncio.run(scenario())
+
+def test_breaker_ignores_calls_started_before_it_opened():
+    breaker = CircuitBreaker(0.5, 0.0, window=4, min_calls=2)
+    slow = breaker.allow()
+    for _ in range(2):
+        breaker.record(breaker.allow(), False)
+    assert breaker.opened_at is not None
+
+    # A call admitted while closed finishing now neither closes the breaker...
+    breaker.record(slow, True)
+    assert breaker.opened_at is not None
+    trial = breaker.allow()
+    assert trial is not None
+    # ...nor, failing, ends the running trial
+    breaker.record(slow, False)
+    assert breaker.trial == trial
+    assert breaker.allow() is None
+
+    breaker.record(trial, True)
+    assert breaker.state == "closed"
+
+def test_abandoned_trial_lets_another_through():
+    breaker = CircuitBreaker(0.5, 0.0, window=4, min_calls=2)
+    for _ in range(2):
+        breaker.record(breaker.allow(), False)
+    trial = breaker.allow()
+    assert breaker.allow() is None
+    breaker.abandon(trial)
+    assert breaker.allow() is not None
+
+def test_saturated_model_rejects_at_once():
+    model = guarded(LocalChatModel(token_delay_seconds=0.02), max_concurrency=1)
+
+    async def scenario():
+        running = asyncio.create_task(model.complete("s", "", "une question lente"))
+        await asyncio.sleep(0)
+        assert model.saturated()
+        # Mapped to a 503 with Retry-After by the chat routes
+        with pytest.raises(ChatModelSaturated):
+            await model.complete("s", "", "question")
+        await running
+
+    asyncio.run(scenario())
+    assert model.counters["rejected"] == 1
+    assert model.in_flight == 0
+
+def test_deadline_covers_the_whole_reply():
+    model = guarded(LocalChatModel(token_delay_seconds=0.05), timeout_seconds=0.12)
+
+    async def consume():
+        return [chunk async for chunk in model.stream("s", "", "un deux trois quatre")]
+
+    with pytest.raises(ChatModelUnavailable):
+        asyncio.run(consume())
+    assert model.counters["timeouts"] == 1
+    assert model.in_flight == 0
+
+    with pytest.raises(ChatModelUnavailable):
+        asyncio.run(model.complete("s", "", "un deux trois quatre"))
+    assert model.counters["timeouts"] == 2
@@ -0,0 +1,52 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("cachetools")
+
+from search_index import SearchIndex, within_one_edit
+
+VEHICLES = [
+    {"_id": "a", "name": "Clio", "brand": "Renault", "features": ["GPS"], "description": "Citadine essence"},
+    {"_id": "b", "name": "208", "brand": "Peugeot", "features": ["Climatisation", "GPS"], "description": "Citadine"},
+    {"_id": "c", "name": "Classe C", "brand": "Mercedes", "features": ["Climatisation"], "description": "Berline"},
+    {"_id": "d", "name": "Mégane", "brand": "Renault", "features": [], "description": "Berline diesel"}
+]
+
+@pytest.fixture
+def index():
+    index = SearchIndex()
+    index.replace_all(VEHICLES)
+    return index
+
+def ids(results):
+    return [vehicle_id for vehicle_id, _ in results]
+
+def test_within_one_edit_counts_adjacent_swaps():
+    assert within_one_edit("mercedse", "mercedes")
+    assert within_one_edit("clio", "clim")
+    assert not within_one_edit("abc", "cab")
+
+def test_accents_and_prefixes(index):
+    assert ids(index.search("megane", 10)) == ["d"]
+    assert ids(index.search("merc", 10)) == ["c"]
+
+def test_typos_and_transpositions(index):
+    assert ids(index.search("peugoet", 10)) == ["b"]
+    assert ids(index.search("mercedse", 10)) == ["c"]
+
+def test_prefix_match_outranks_typo_match(index):
+    # "clim" is a prefix of Climatisation and one edit from Clio
+    results = ids(index.search("clim", 10))
+    assert set(results[:2]) == {"b", "c"}
+    assert results[2] == "a"
+
+def test_every_token_must_match(index):
+    assert ids(index.search("renault berline", 10)) == ["d"]
+    assert index.search("renault peugeot", 10) == []
+
+def test_limit_and_changes(index):
+    assert len(index.search("gps", 1)) == 1
+    index.remove("a")
+    assert ids(index.search("clio", 10)) == []
+    index.put("e", {"name": "Clio", "brand": "Renault", "features": ["GPS"]})
+    assert ids(index.search("clio gps", 10)) == ["e"]